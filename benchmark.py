@@ -0,0 +1,415 @@
+"""
+PDF抽出・再構成パイプラインのベンチマーク
+
+合成したPDF（文字多め・画像多め・ページ多め・日本語多め・複数フォント）を PyMuPDF で作り、
+Firestore を使わずに process_pdf と各描画エンジン（WeasyPrint / PyMuPDF）を実行して、
+処理段階ごとの時間・ピークメモリ・出力サイズと、PyMuPDF 出力の WeasyPrint との一致率を JSON に書き出す。
+
+使い方:
+    python benchmark.py                              # bench_results.json に書く
+    python benchmark.py --repeat 5 --out new.json
+    python benchmark.py --baseline bench_baseline.json --threshold 0.2
+        → 基準より 20% 以上遅くなったケース・段階があれば一覧を出して終了コード 1
+    python benchmark.py --save-baseline bench_baseline.json
+    python benchmark.py --parity-min 0.99
+        → PyMuPDF 出力の本文一致率が 99% 未満のケースがあれば終了コード 1
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+import pymupdf as fitz
+
+SAMPLE_EN = ("The quick brown fox jumps over the lazy dog while the students read "
+             "the handout carefully and take notes in the margin. ")
+SAMPLE_JA = ("吾輩は猫である。名前はまだ無い。どこで生れたかとんと見当がつかぬ。"
+             "何でも薄暗いじめじめした所でニャーニャー泣いていた事だけは記憶している。")
+MULTI_FONTS = ["helv", "hebo", "tiro", "tibo", "cour", "cobo"]
+
+
+# --- 合成PDFコーパス ---
+
+def _image_bytes(seed, size=160):
+    """seed ごとに中身の違う PNG を作る（画像の重複排除が効かないように）"""
+    pix = fitz.Pixmap(fitz.csRGB, fitz.IRect(0, 0, size, size), False)
+    pix.clear_with((seed * 37) % 256)
+    for x in range(0, size, 8):
+        for y in range(0, size, 8):
+            pix.set_pixel(x, y, ((x + seed) % 256, (y * seed) % 256, (x * y) % 256))
+    return pix.tobytes("png")
+
+
+def make_text_heavy(pages=20):
+    doc = fitz.open()
+    for _ in range(pages):
+        page = doc.new_page()
+        y = 50
+        while y < 800:
+            page.insert_text((40, y), SAMPLE_EN[:90], fontsize=9)
+            y += 12
+    return doc
+
+
+def make_image_heavy(pages=10, per_page=4):
+    doc = fitz.open()
+    logo = _image_bytes(0, 64)
+    for p in range(pages):
+        page = doc.new_page()
+        # 全ページ共通のロゴ（重複排除の対象）と、ページごとに違う画像
+        page.insert_image(fitz.Rect(40, 20, 100, 60), stream=logo)
+        for j in range(per_page):
+            top = 80 + j * 180
+            page.insert_image(fitz.Rect(60, top, 260, top + 160),
+                              stream=_image_bytes(p * per_page + j + 1))
+            page.insert_text((280, top + 20), f"Figure {p + 1}-{j + 1}", fontsize=11)
+    return doc
+
+
+def make_many_page(pages=300):
+    doc = fitz.open()
+    for p in range(pages):
+        page = doc.new_page()
+        page.insert_text((50, 60), f"Page {p + 1}", fontsize=16)
+        page.insert_text((50, 100), SAMPLE_EN[:80], fontsize=10)
+    return doc
+
+
+def make_cjk_heavy(pages=20):
+    doc = fitz.open()
+    for _ in range(pages):
+        page = doc.new_page()
+        y = 50
+        while y < 800:
+            page.insert_text((40, y), SAMPLE_JA[:40], fontsize=10, fontname="japan")
+            y += 16
+    return doc
+
+
+def make_multi_font(pages=20):
+    doc = fitz.open()
+    for _ in range(pages):
+        page = doc.new_page()
+        y = 50
+        i = 0
+        while y < 800:
+            font = MULTI_FONTS[i % len(MULTI_FONTS)]
+            size = 8 + (i % 5) * 2
+            page.insert_text((40, y), SAMPLE_EN[:70], fontsize=size, fontname=font)
+            y += size + 6
+            i += 1
+    return doc
+
+
+CORPUS = {
+    "text_heavy": make_text_heavy,
+    "image_heavy": make_image_heavy,
+    "many_page": make_many_page,
+    "cjk_heavy": make_cjk_heavy,
+    "multi_font": make_multi_font,
+}
+
+SETTINGS = {"fontSelect": "Kosugi Maru", "fontSize": 2, "lineHeight": 1.5}
+
+
+# --- main.py の読み込み（Firestore はスタブにする） ---
+
+class _StubDocument:
+    exists = False
+
+    def to_dict(self):
+        return None
+
+
+class _StubDocRef:
+    def get(self):
+        return _StubDocument()
+
+    def set(self, data):
+        pass
+
+
+class _StubCollection:
+    def document(self, doc_id):
+        return _StubDocRef()
+
+    def on_snapshot(self, callback):
+        return None
+
+
+class _StubFirestore:
+    def collection(self, name):
+        return _StubCollection()
+
+
+def load_app(workdir):
+    """Firebase を初期化せずに main を import し、出力先を workdir に向ける"""
+    import firebase_admin
+    from firebase_admin import credentials, firestore
+
+    credentials.Certificate = lambda *args, **kwargs: None
+    firebase_admin.initialize_app = lambda *args, **kwargs: None
+    firestore.client = lambda *args, **kwargs: _StubFirestore()
+    os.environ.setdefault("GOOGLE_APPLICATION_CREDENTIALS_JSON", "{}")
+    # import 時に保持による削除・ウォームアップのスレッドを立てない（preload と同じく読み込みだけ済ませる）
+    os.environ.setdefault("PDFREMAKER_PRELOAD", "1")
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    cwd = os.getcwd()
+    os.chdir(workdir)  # logs/ を作業ディレクトリ側に作らせる
+    try:
+        import main
+    finally:
+        os.chdir(cwd)
+    main.METRICS_FOLDER = os.path.join(workdir, "metrics")
+    os.makedirs(main.METRICS_FOLDER, exist_ok=True)
+    return main
+
+
+def _dir_bytes(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
+def _stage_totals(main):
+    """
+    全プロセス（このプロセスとページ並列のワーカー）の METRICS_FOLDER/<pid>.json を合算した段階ごとの累計秒数。
+    ワーカーの値はプールが続く限り累積するので、ケースの前後の差を取って使う
+    """
+    main.flush_metrics(force=True)
+    totals = {}
+    for entry in os.listdir(main.METRICS_FOLDER):
+        if not entry.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(main.METRICS_FOLDER, entry), "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for name, labels, hist in data.get("histograms", []):
+            if name == "pdfremaker_stage_seconds":
+                totals[labels["stage"]] = totals.get(labels["stage"], 0.0) + hist["sum"]
+    return totals
+
+
+def _peak_memory(main, name, pdf_bytes, output_folder):
+    """
+    時間の計測とは別に、tracemalloc を有効にして初回処理のピークメモリを測る。
+    並列抽出のワーカーの分は tracemalloc に見えないので、この回だけページ抽出を直列にする
+    """
+    shutil.rmtree(output_folder, ignore_errors=True)
+    os.makedirs(output_folder)
+    workers = main.PARALLEL_WORKERS
+    main.PARALLEL_WORKERS = 1
+    tracemalloc.start()
+    try:
+        with main.app.test_request_context("/"):
+            main.process_pdf(pdf_bytes, SETTINGS, pdf_name=f"{name}.pdf")
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        main.PARALLEL_WORKERS = workers
+    return peak
+
+
+def run_case(main, name, pdf_bytes, workdir):
+    """1ケースを空の出力フォルダで実行し、計測値を返す"""
+    output_folder = os.path.join(workdir, "output")
+    shutil.rmtree(output_folder, ignore_errors=True)
+    os.makedirs(output_folder)
+    main.OUTPUT_FOLDER = output_folder
+    before = _stage_totals(main)
+
+    start = time.perf_counter()
+    with main.app.test_request_context("/"):
+        main.process_pdf(pdf_bytes, SETTINGS, pdf_name=f"{name}.pdf")
+    cold = time.perf_counter() - start
+
+    # 同じPDF・同じ設定の2回目（結果キャッシュ）
+    start = time.perf_counter()
+    with main.app.test_request_context("/"):
+        main.process_pdf(pdf_bytes, SETTINGS, pdf_name=f"{name}.pdf")
+    warm = time.perf_counter() - start
+
+    after = _stage_totals(main)
+    stages = {stage: round(seconds - before.get(stage, 0.0), 6)
+              for stage, seconds in after.items() if seconds > before.get(stage, 0.0)}
+
+    # 描画エンジン単体（NEO テキストから PDF を作るところだけ）と、両者の出力の比較
+    layout = None
+    for entry in os.listdir(output_folder):
+        path = os.path.join(output_folder, entry, main.LAYOUT_FILE)
+        if os.path.isfile(path):
+            layout = main.read_layout(path)
+    renderer_seconds = {"weasyprint": None, "pymupdf": None}
+    parity = None
+    if layout is not None:
+        nodes = main.parse_neo(main.render_layout(layout["pages"], SETTINGS)[0])
+        outputs = {}
+        for renderer, create_pdf in (("weasyprint", main.create_pdf_with_weasyprint),
+                                     ("pymupdf", main.create_pdf_with_pymupdf)):
+            outputs[renderer] = os.path.join(workdir, f"{name}_{renderer}.pdf")
+            start = time.perf_counter()
+            ok, _ = create_pdf(nodes, outputs[renderer], main.app_root,
+                               firebase_settings=SETTINGS)
+            if ok:
+                renderer_seconds[renderer] = time.perf_counter() - start
+        if all(renderer_seconds.values()):
+            parity = main.check_render_parity(outputs["weasyprint"], outputs["pymupdf"])
+            parity["bytes"] = [os.path.getsize(outputs["weasyprint"]),
+                               os.path.getsize(outputs["pymupdf"])]
+
+    recreated = [os.path.join(root, f) for root, _, files in os.walk(output_folder)
+                 for f in files if f.endswith("_recreated.pdf")]
+    output_bytes = _dir_bytes(output_folder)
+    recreated_bytes = sum(os.path.getsize(p) for p in recreated)
+    peak = _peak_memory(main, name, pdf_bytes, output_folder)
+    return {
+        "input_bytes": len(pdf_bytes),
+        "cold_seconds": round(cold, 6),
+        "warm_seconds": round(warm, 6),
+        "weasyprint_seconds": (round(renderer_seconds["weasyprint"], 6)
+                               if renderer_seconds["weasyprint"] is not None else None),
+        "pymupdf_seconds": (round(renderer_seconds["pymupdf"], 6)
+                            if renderer_seconds["pymupdf"] is not None else None),
+        "parity": parity,
+        "stages": stages,
+        "peak_python_memory_bytes": peak,
+        "output_bytes": output_bytes,
+        "recreated_pdf_bytes": recreated_bytes,
+    }
+
+
+def _median_result(results):
+    """複数回の結果を、時間はケース・段階ごとの中央値、それ以外は最後の値でまとめる"""
+    merged = dict(results[-1])
+    for key in ("cold_seconds", "warm_seconds", "weasyprint_seconds", "pymupdf_seconds"):
+        values = [r[key] for r in results if r[key] is not None]
+        merged[key] = round(statistics.median(values), 6) if values else None
+    stages = {}
+    for stage in results[-1]["stages"]:
+        stages[stage] = round(statistics.median(
+            r["stages"].get(stage, 0.0) for r in results), 6)
+    merged["stages"] = stages
+    merged["peak_python_memory_bytes"] = max(r["peak_python_memory_bytes"] for r in results)
+    return merged
+
+
+def compare(results, baseline, threshold):
+    """基準より threshold（割合）以上遅くなった項目を返す"""
+    regressions = []
+    for case, current in results["cases"].items():
+        base = baseline.get("cases", {}).get(case)
+        if not base:
+            continue
+        pairs = [(key, current.get(key), base.get(key))
+                 for key in ("cold_seconds", "warm_seconds", "weasyprint_seconds",
+                             "pymupdf_seconds")]
+        pairs += [(f"stages.{stage}", value, base.get("stages", {}).get(stage))
+                  for stage, value in current["stages"].items()]
+        for key, value, base_value in pairs:
+            if value is None or not base_value:
+                continue
+            ratio = value / base_value
+            if ratio > 1 + threshold:
+                regressions.append({"case": case, "metric": key, "baseline": base_value,
+                                    "current": value, "ratio": round(ratio, 3)})
+    return regressions
+
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description="PDF Remaker パイプラインのベンチマーク")
+    parser.add_argument("--cases", nargs="*", default=list(CORPUS),
+                        choices=list(CORPUS), help="実行するケース（既定: 全部）")
+    parser.add_argument("--repeat", type=int, default=3, help="各ケースの実行回数（中央値を採用）")
+    parser.add_argument("--out", default="bench_results.json", help="結果JSONの出力先")
+    parser.add_argument("--baseline", help="比較する基準JSON")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="この割合以上遅くなったら回帰とみなす（既定 0.2 = 20%%）")
+    parser.add_argument("--save-baseline", help="結果を基準JSONとしても保存する")
+    parser.add_argument("--parity-min", type=float, default=0.98,
+                        help="PyMuPDF 出力の本文一致率（WeasyPrint 比）がこれ未満なら失敗（既定 0.98）")
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix="pdfremaker_bench_")
+    try:
+        main = load_app(workdir)
+        results = {
+            "meta": {
+                "timestamp": datetime.now(timezone.utc).isoformat(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "pymupdf": fitz.VersionBind,
+                "repeat": args.repeat,
+                "settings": SETTINGS,
+            },
+            "cases": {},
+        }
+        for name in args.cases:
+            doc = CORPUS[name]()
+            pdf_bytes = doc.tobytes()
+            doc.close()
+            runs = [run_case(main, name, pdf_bytes, workdir) for _ in range(args.repeat)]
+            results["cases"][name] = _median_result(runs)
+            r = results["cases"][name]
+            print(f"{name:12s} cold {r['cold_seconds']:.3f}s  warm {r['warm_seconds']:.3f}s  "
+                  f"peak {r['peak_python_memory_bytes'] / 1e6:.1f}MB  "
+                  f"output {r['output_bytes'] / 1e6:.2f}MB")
+            if r["parity"]:
+                print(f"{'':12s} weasyprint {r['weasyprint_seconds']:.3f}s  "
+                      f"pymupdf {r['pymupdf_seconds']:.3f}s  "
+                      f"text match {r['parity']['text_match']:.1%}  "
+                      f"pages {r['parity']['pages'][0]}/{r['parity']['pages'][1]}")
+        # プロセス全体の最大常駐メモリ（Linux は KB 単位）
+        results["meta"]["max_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    exit_code = 0
+    parity_failures = [name for name, r in results["cases"].items()
+                       if r["parity"] is None or r["parity"]["text_match"] < args.parity_min]
+    results["parity_failures"] = parity_failures
+    for name in parity_failures:
+        parity = results["cases"][name]["parity"]
+        print(f"⚠️ 出力不一致: {name} " + (f"text match {parity['text_match']:.1%} "
+                                          f"missing {parity['missing_chars']!r}"
+                                          if parity else "（どちらかの描画に失敗）"))
+    if parity_failures:
+        exit_code = 1
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        results["regressions"] = regressions
+        for r in regressions:
+            print(f"⚠️ 回帰: {r['case']} {r['metric']} {r['baseline']:.3f}s → "
+                  f"{r['current']:.3f}s (x{r['ratio']})")
+        if regressions:
+            exit_code = 1
+        else:
+            print(f"✅ 基準からの回帰なし（しきい値 {args.threshold:.0%}）")
+
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"結果を書き出しました: {args.out}")
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
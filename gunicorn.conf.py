@@ -0,0 +1,33 @@
+"""
+gunicorn 設定（Procfile から読み込む）
+
+preload_app: マスターで main を import し、PyMuPDF・WeasyPrint の import とフォントの読み込みを
+fork 前に1回だけ済ませる（ワーカーはそれを共有するので起動・再起動が速い）。
+Firestore（gRPC）とバックグラウンドスレッドは fork を跨げないので、post_fork で各ワーカーが開始する。
+PDFREMAKER_PRELOAD=0 にすると従来どおり各ワーカーがそれぞれ読み込む。
+worker_exit: 再起動（max_requests・デプロイ）で終わるワーカーの最後の計測値を metrics/<pid>.json に書き出す。
+
+worker_class: /jobs/<id>/events（SSE）は接続を最長 JOB_EVENTS_MAX_SECONDS 保持するので、
+sync ワーカーだとその間ほかのリクエスト（/outputs・アップロード）が止まる。
+gthread にして1ワーカーで GUNICORN_THREADS 本のリクエストを並行に扱う。
+"""
+import os
+import sys
+
+os.environ.setdefault("PDFREMAKER_PRELOAD", "1")
+preload_app = os.environ["PDFREMAKER_PRELOAD"] == "1"
+
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", "8"))
+
+
+def post_fork(server, worker):
+    if preload_app:
+        import main
+        main.start_background_workers()
+
+
+def worker_exit(server, worker):
+    main = sys.modules.get("main")
+    if main is not None:
+        main.flush_metrics(force=True)
@@ -9,38 +9,87 @@ git push
 """
 
 # Flask関連
-from flask import Flask, request, jsonify, send_file, render_template
+from flask import (Flask, Request, request, jsonify, send_file, render_template,
+                   stream_template, url_for)
 from werkzeug.utils import secure_filename
 
 # 標準ライブラリ
 import os
 import re
 import tempfile
+import multiprocessing
 import html
 import html as pyhtml
 import json
 from datetime import datetime, timedelta, timezone
 import shutil
-from bs4 import BeautifulSoup
 import time
 import mimetypes
+import threading
+import uuid
+import hashlib
+import zlib
+import mmap
+import fcntl
+import struct
+import zipfile
+import io
+import gzip
+import importlib.util
+from collections import Counter, OrderedDict, namedtuple
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future
+from concurrent.futures.process import BrokenProcessPool
+
+# デバッグ・ログ関連
+import logging
+from logging.handlers import RotatingFileHandler
+
+startup_started = time.perf_counter()
+import_timings = {}  # module -> import にかかった秒数（/ready で返す）
+import_lock = threading.Lock()
+
+
+class LazyModule:
+    """
+    最初に属性へアクセスしたときに import するモジュールの代理。
+    PyMuPDF・WeasyPrint・Firebase は import だけで数百ミリ秒〜秒かかるので、ワーカー起動時には読まない。
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            with import_lock:
+                if self._module is None:
+                    start = time.perf_counter()
+                    module = importlib.import_module(self._name)
+                    seconds = time.perf_counter() - start
+                    import_timings[self._name] = round(seconds, 4)
+                    logging.getLogger("pdf_remaker").info(
+                        "📦 import %s: %.3f s", self._name, seconds)
+                    self._module = module
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
 
 # PDF操作関連
-import pymupdf as fitz
-from weasyprint import HTML, CSS
-from weasyprint.urls import path2url
+fitz = LazyModule("pymupdf")
+weasyprint = LazyModule("weasyprint")
+weasyprint_fonts = LazyModule("weasyprint.text.fonts")
+weasyprint_urls = LazyModule("weasyprint.urls")
 
-# フォント関連
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.cidfonts import UnicodeCIDFont
+# 読み順の計算（段組み検出）
+np = LazyModule("numpy")
 
 # Firebase関連
-import firebase_admin
-from firebase_admin import credentials, firestore
-
-# デバッグ・ログ関連
-import logging
-from logging.handlers import RotatingFileHandler
+firebase_admin = LazyModule("firebase_admin")
+credentials = LazyModule("firebase_admin.credentials")
+firestore = LazyModule("firebase_admin.firestore")
 
 
 # ログ設定
@@ -147,17 +196,213 @@ def cleanup_old_logs(base_dir: str, days_to_keep: int, logger_obj):
 # ログ初期化
 logger = setup_logging()
 
-# 古いログを自動削除
+# 古いログの削除は起動を待たせないよう保持スレッド（_retention_loop）で行う
 days_to_keep = int(os.environ.get("LOG_DAYS_TO_KEEP", "7"))  # 7日保持
-cleanup_old_logs("logs", days_to_keep, logger)
 
 # Flask・環境設定
 print("(;^ω^) 起動中static.")
-print(f"DEBUG: fitz module path: {fitz.__file__}")
-print(f"DEBUG: fitz.open available: {hasattr(fitz, 'open')}")
 
 app_root = os.path.dirname(os.path.abspath(__file__))
 
+# メトリクス（処理段階ごとの所要時間・件数）
+# プロセスごとに METRICS_FOLDER/<pid>.json へ書き出し、/metrics で全プロセス分を合算する。
+# gunicorn の複数ワーカーやページ並列のワーカープロセスの分もまとめて見えるようにするため。
+METRICS_FOLDER = os.path.join(app_root, "metrics")
+METRICS_FLUSH_INTERVAL = 5  # 秒
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+METRIC_HELP = {
+    "pdfremaker_stage_seconds": "処理段階ごとの所要時間",
+    "pdfremaker_errors_total": "処理段階ごとのエラー数",
+    "pdfremaker_uploads_total": "アップロード数（結果別）",
+    "pdfremaker_upload_bytes_total": "受け付けたアップロードのバイト数",
+    "pdfremaker_pages_extracted_total": "抽出したページ数",
+    "pdfremaker_images_total": "抽出した画像数（stored=新規保存 / reused=既存を再利用）",
+    "pdfremaker_output_bytes_total": "生成した再構成PDFのバイト数",
+    "pdfremaker_settings_cache_total": "生徒設定キャッシュの参照数（結果別）",
+}
+os.makedirs(METRICS_FOLDER, exist_ok=True)
+
+metrics_lock = threading.Lock()
+metric_counters = {}  # (name, labels) -> 値
+metric_histograms = {}  # (name, labels) -> {"buckets": [...], "sum", "count"}
+metrics_flushed_at = 0.0
+metrics_dirty = False  # 最後に書き出してから値が変わった
+
+
+def _reset_metrics():
+    """fork した子プロセスは親の値を引き継がず、自分の分だけを数える"""
+    global metrics_lock, metrics_flushed_at, metrics_dirty
+    metrics_lock = threading.Lock()
+    metric_counters.clear()
+    metric_histograms.clear()
+    metrics_flushed_at = 0.0
+    metrics_dirty = False
+
+
+os.register_at_fork(after_in_child=_reset_metrics)
+
+
+def _metric_key(name, labels):
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def inc_metric(name, value=1, **labels):
+    global metrics_dirty
+    key = _metric_key(name, labels)
+    with metrics_lock:
+        metric_counters[key] = metric_counters.get(key, 0) + value
+        metrics_dirty = True
+    flush_metrics()
+
+
+def observe_metric(name, seconds, **labels):
+    global metrics_dirty
+    key = _metric_key(name, labels)
+    with metrics_lock:
+        hist = metric_histograms.setdefault(
+            key, {"buckets": [0] * len(METRIC_BUCKETS), "sum": 0.0, "count": 0})
+        for i, bound in enumerate(METRIC_BUCKETS):
+            if seconds <= bound:
+                hist["buckets"][i] += 1
+        hist["sum"] += seconds
+        hist["count"] += 1
+        metrics_dirty = True
+    flush_metrics()
+
+
+@contextmanager
+def timed(stage):
+    """with timed("weasyprint"): ... の所要時間を記録し、例外なら errors_total も数える"""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        inc_metric("pdfremaker_errors_total", stage=stage)
+        raise
+    finally:
+        observe_metric("pdfremaker_stage_seconds", time.perf_counter() - start,
+                       stage=stage)
+
+
+job_progress = threading.local()  # ジョブを処理中のスレッドだけ reporter を持つ
+
+
+def _clear_job_progress():
+    """
+    ジョブのスレッドから fork した子（プロセスプールのワーカー）は fork したスレッドの reporter を引き継ぐ。
+    そのまま後の別ジョブの処理で呼ぶと古いジョブの状態を書き換えるので、子では外しておく
+    """
+    job_progress.reporter = None
+
+
+os.register_at_fork(after_in_child=_clear_job_progress)
+
+
+def report_progress(stage, **fields):
+    """
+    処理中のジョブに進捗を知らせる（/jobs/<id>/events で流す）。ジョブ外では何もしない。
+    プロセスプールのワーカーでは fork 時に reporter を外しているので何もせず、進捗は親が結果を受け取るたびに送る。
+    stage は extract / neo / render。fields は前回の値に上書きでまとめる。
+    """
+    reporter = getattr(job_progress, "reporter", None)
+    if reporter is not None:
+        reporter(stage, fields)
+
+
+def flush_metrics(force=False):
+    """
+    このプロセスの値を METRICS_FOLDER/<pid>.json に書く（METRICS_FLUSH_INTERVAL 秒に1回まで）。
+    間引いた分は _metrics_flush_loop が後で書くので、以後に計測が無くても /metrics に反映される
+    """
+    global metrics_flushed_at, metrics_dirty
+    now = time.monotonic()
+    with metrics_lock:
+        if not force and now - metrics_flushed_at < METRICS_FLUSH_INTERVAL:
+            return
+        metrics_flushed_at = now
+        metrics_dirty = False
+        snapshot = {
+            "counters": [[name, dict(labels), value]
+                         for (name, labels), value in metric_counters.items()],
+            "histograms": [[name, dict(labels), hist]
+                           for (name, labels), hist in metric_histograms.items()],
+        }
+    path = os.path.join(METRICS_FOLDER, f"{os.getpid()}.json")
+    tmp_path = f"{path}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(snapshot, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    except OSError:
+        logger.exception("flush_metrics: failed to write %s", path)
+
+
+def _metrics_flush_loop():
+    while True:
+        time.sleep(METRICS_FLUSH_INTERVAL)
+        if metrics_dirty:
+            flush_metrics(force=True)
+
+
+def start_metrics_flusher():
+    """計測が止まったワーカーの最後の値も METRICS_FLUSH_INTERVAL 秒以内に書き出す"""
+    thread = threading.Thread(target=_metrics_flush_loop, name="metrics_flush", daemon=True)
+    thread.start()
+    return thread
+
+
+def collect_metrics():
+    """全プロセスのファイルを合算して Prometheus のテキスト形式にする"""
+    flush_metrics(force=True)
+    counters, histograms = {}, {}
+    for name in os.listdir(METRICS_FOLDER):
+        if not name.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(METRICS_FOLDER, name), "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for metric, labels, value in data.get("counters", []):
+            key = _metric_key(metric, labels)
+            counters[key] = counters.get(key, 0) + value
+        for metric, labels, hist in data.get("histograms", []):
+            key = _metric_key(metric, labels)
+            total = histograms.setdefault(
+                key, {"buckets": [0] * len(METRIC_BUCKETS), "sum": 0.0, "count": 0})
+            total["buckets"] = [a + b for a, b in zip(total["buckets"], hist["buckets"])]
+            total["sum"] += hist["sum"]
+            total["count"] += hist["count"]
+
+    def fmt_labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(
+            f'{k}="{v.replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+            for k, v in pairs) + "}"
+
+    lines = []
+    for metric in sorted({name for name, _ in counters}):
+        lines.append(f"# HELP {metric} {METRIC_HELP.get(metric, metric)}")
+        lines.append(f"# TYPE {metric} counter")
+        for (name, labels), value in sorted(counters.items()):
+            if name == metric:
+                lines.append(f"{metric}{fmt_labels(labels)} {value}")
+    for metric in sorted({name for name, _ in histograms}):
+        lines.append(f"# HELP {metric} {METRIC_HELP.get(metric, metric)}")
+        lines.append(f"# TYPE {metric} histogram")
+        for (name, labels), hist in sorted(histograms.items()):
+            if name != metric:
+                continue
+            for bound, count in zip(METRIC_BUCKETS, hist["buckets"]):
+                lines.append(f"{metric}_bucket{fmt_labels(labels, [('le', str(bound))])} {count}")
+            lines.append(f"{metric}_bucket{fmt_labels(labels, [('le', '+Inf')])} {hist['count']}")
+            lines.append(f"{metric}_sum{fmt_labels(labels)} {hist['sum']:.6f}")
+            lines.append(f"{metric}_count{fmt_labels(labels)} {hist['count']}")
+    return "\n".join(lines) + "\n"
+
+
 # フォント設定
 FONT_FILE_MAP = {
     "Noto Serif JP": "static/fonts/NotoSerifJP-Regular.ttf",
@@ -192,93 +437,855 @@ def get_font_path(app_root, font_family_name="IPAexGothic"):
 
 
 font_path = get_font_path(app_root, "IPAexGothic")
-font_url = path2url(font_path) if font_path else None
-
-# Firebase 初期化
-try:
-    service_key_json = os.environ.get("GOOGLE_APPLICATION_CREDENTIALS_JSON")
-    if service_key_json:
-        # Render等のサーバ環境
-        with tempfile.NamedTemporaryFile(delete=False,
-                                         suffix=".json",
-                                         mode="w") as temp_file:
-            temp_file.write(service_key_json)
-            temp_file_path = temp_file.name
-        cred = credentials.Certificate(temp_file_path)
-        firebase_admin.initialize_app(cred)
-        logger.info("✅ Firebase初期化: 環境変数から読み込み成功")
-    else:
-        # ローカル環境
-        cred = credentials.Certificate("serAccoCaMnNeMg.json")
-        firebase_admin.initialize_app(cred)
-        logger.info("✅ Firebase初期化: serAccoCaMnNeMg.jsonから読み込み成功")
 
-    db = firestore.client()
-    config_ref = db.collection("messages")
-    logger.info("✅ Firestore接続成功")
+# フォント名が見つからない・文字が足りないときに試す順番
+FONT_FALLBACK_ORDER = ["IPAexゴシック", "Noto Sans JP", "Kosugi Maru",
+                       "IPAex明朝", "Noto Serif JP"]
+
 
-except Exception as e:
-    logger.critical(f"Firebase初期化エラー: {e}", exc_info=True)
-    raise SystemExit("Firebase初期化に失敗しました。")
+def load_font_registry(app_root):
+    """
+    FONT_FILE_MAP を解決し、フォントファイルごとの収録文字（cmap）を読む（get_font_registry から1回だけ呼ぶ）。
+    戻り値: (name -> path or None, path -> {"family", "coverage"})
+    """
+    names, files = {}, {}
+    for name, font_file in FONT_FILE_MAP.items():
+        path = os.path.abspath(os.path.join(app_root, font_file))
+        if not os.path.isfile(path):
+            logger.warning("load_font_registry: font file missing for %s: %s",
+                           name, path)
+            names[name] = None
+            continue
+        names[name] = path
+        if path in files:
+            continue
+        try:
+            coverage = frozenset(fitz.Font(fontfile=path).valid_codepoints())
+        except Exception:
+            logger.exception("load_font_registry: failed to read cmap of %s", path)
+            coverage = frozenset()
+        files[path] = {
+            "family": "remaker-" + os.path.splitext(os.path.basename(path))[0],
+            "coverage": coverage
+        }
+    logger.info("✅ フォントレジストリ: %d 名 / %d ファイル", len(names), len(files))
+    return names, files
+
+
+font_registry = None  # load_font_registry の結果。PyMuPDF が要るので最初に使うときに読む
+font_files = None
+font_registry_lock = threading.Lock()
+font_render_state = threading.local()  # スレッドごとの FontConfiguration と @font-face CSS
+
+
+def get_font_registry():
+    """(name -> path or None, path -> {"family", "coverage"}) を返す。初回だけフォントファイルを読む"""
+    global font_registry, font_files
+    if font_registry is None:
+        with font_registry_lock:
+            if font_registry is None:
+                names, files = load_font_registry(app_root)
+                font_files = files
+                # ロックの外では font_registry を見て判定するので、最後に入れる
+                font_registry = names
+    return font_registry, font_files
+
+
+def resolve_font_family(font_name, text=""):
+    """
+    フォント名と実際のテキストから、@font-face 登録済みのファミリー名を選ぶ。
+    指定フォントで表示できない文字があれば、欠ける文字が最も少ないフォールバックを使う。
+    使えるフォントが無ければ None
+    """
+    registry, files = get_font_registry()
+    candidates = []
+    for name in [font_name] + FONT_FALLBACK_ORDER:
+        path = registry.get(name)
+        if path and path not in candidates:
+            candidates.append(path)
+    if not candidates:
+        candidates = list(files)
+    if not candidates:
+        return None
+
+    chars = {ord(c) for c in text if not c.isspace()}
+    best, best_missing = None, None
+    for path in candidates:
+        missing = len(chars - files[path]["coverage"])
+        if missing == 0:
+            return files[path]["family"]
+        if best_missing is None or missing < best_missing:
+            best, best_missing = path, missing
+    return files[best]["family"]
+
+
+def get_font_stylesheet():
+    """
+    登録済みフォントの @font-face を読み込んだ CSS と FontConfiguration を返す。
+    WeasyPrint の FontConfiguration はスレッド間で共有できないので、スレッドごとに1回だけ作って使い回す。
+    """
+    state = font_render_state
+    if getattr(state, "css", None) is None:
+        font_config = weasyprint_fonts.FontConfiguration()
+        rules = "\n".join(
+            f"@font-face {{ font-family: '{info['family']}'; src: url('{weasyprint_urls.path2url(path)}'); }}"
+            for path, info in get_font_registry()[1].items())
+        state.css = weasyprint.CSS(string=rules, font_config=font_config)
+        state.font_config = font_config
+    return state.css, state.font_config
+
+# Firebase 初期化（最初に Firestore を使うときにワーカーごとに1回だけ行う）
+db = None
+db_lock = threading.Lock()
+
+
+def get_db():
+    """
+    Firestore クライアントを返す。初回は Firebase を初期化して接続する。
+    gRPC は fork を跨いで使えないので、gunicorn のマスター（preload）では呼ばないこと。
+    失敗したら RuntimeError（次の呼び出しで再試行する）
+    """
+    global db, settings_watch
+    if db is not None:
+        return db
+    with db_lock:
+        if db is not None:
+            return db
+        try:
+            with timed("firebase_init"):
+                service_key_json = os.environ.get("GOOGLE_APPLICATION_CREDENTIALS_JSON")
+                if service_key_json:
+                    # Render等のサーバ環境（一時ファイルに書かずに dict で渡す）
+                    cred = credentials.Certificate(json.loads(service_key_json))
+                    source = "環境変数"
+                else:
+                    # ローカル環境
+                    cred = credentials.Certificate("serAccoCaMnNeMg.json")
+                    source = "serAccoCaMnNeMg.json"
+                try:
+                    firebase_admin.get_app()
+                except ValueError:
+                    firebase_admin.initialize_app(cred)
+                logger.info("✅ Firebase初期化: %sから読み込み成功", source)
+                client = firestore.client()
+            logger.info("✅ Firestore接続成功")
+        except Exception as e:
+            logger.critical(f"Firebase初期化エラー: {e}", exc_info=True)
+            raise RuntimeError("Firebase初期化に失敗しました。") from e
+        db = client
+    settings_watch = start_settings_listener()
+    return db
+
+
+# 生徒設定キャッシュ（Firestore 読み込みの前段に置く読み通しキャッシュ）
+SETTINGS_CACHE_TTL = float(os.environ.get("SETTINGS_CACHE_TTL", "60"))  # 秒
+SETTINGS_CACHE_MAX = int(os.environ.get("SETTINGS_CACHE_MAX", "512"))  # 保持件数（LRU）
+SETTINGS_CACHE_LISTEN = os.environ.get("SETTINGS_CACHE_LISTEN", "0") == "1"  # スナップショット監視
+# 書き込んだワーカー以外のキャッシュも捨てさせる印（ID ごとのファイルの mtime）。
+# 読み出し時に、取得より後に印が付いていればキャッシュを使わない
+SETTINGS_STAMP_FOLDER = os.path.join(app_root, "settings_stamps")
+SETTINGS_STAMP_SLACK_NS = 50_000_000  # ファイルの mtime は粗い時計（1 tick ほど遅れる）で付くので、その分の余裕
+os.makedirs(SETTINGS_STAMP_FOLDER, exist_ok=True)
+
+settings_cache = OrderedDict()  # (collection, doc_id) -> (expires_at, data or None, 取得開始の time_ns)
+settings_cache_lock = threading.Lock()
+settings_cache_stats = {"hits": 0, "misses": 0, "evictions": 0,
+                        "invalidations": 0}
+
+
+def _fetch_document(collection_name, doc_id):
+    """Firestore から直接読む。存在しなければ None、通信エラーは例外のまま返す"""
+    logger.info(
+        f"get_document: loading document '{doc_id}' from collection '{collection_name}'"
+    )
+    doc = get_db().collection(collection_name).document(doc_id).get()
+    if doc.exists:
+        return doc.to_dict()
+    logger.warning(f"get_document: document '{doc_id}' not found.")
+    return None
+
+
+def _settings_stamp_path(key):
+    return os.path.join(SETTINGS_STAMP_FOLDER,
+                        hashlib.sha1("/".join(key).encode("utf-8")).hexdigest())
+
+
+def _settings_entry_stale(key, entry):
+    """取得を始めた後に（別のワーカーで）invalidate_document された"""
+    try:
+        stamped = os.stat(_settings_stamp_path(key)).st_mtime_ns
+    except OSError:
+        return False
+    return stamped >= entry[2] - SETTINGS_STAMP_SLACK_NS
+
+
+def invalidate_document(collection_name, doc_id):
+    """
+    キャッシュから1件外す（書き込み直後や変更通知で呼ぶ）。
+    印のファイルも更新して、ほかの gunicorn ワーカーが持っている分も次の参照で読み直させる
+    """
+    key = (collection_name, doc_id)
+    with settings_cache_lock:
+        if settings_cache.pop(key, None) is not None:
+            settings_cache_stats["invalidations"] += 1
+    path = _settings_stamp_path(key)
+    try:
+        with open(path, "a"):
+            os.utime(path, None)
+    except OSError:
+        logger.exception("invalidate_document: failed to touch %s", path)
+
+
+def sweep_settings_stamps():
+    """SETTINGS_CACHE_TTL より古い印を消す（それより前に取得したキャッシュは期限切れになっている）"""
+    now = time.time()
+    for name in os.listdir(SETTINGS_STAMP_FOLDER):
+        path = os.path.join(SETTINGS_STAMP_FOLDER, name)
+        try:
+            if now - os.path.getmtime(path) > SETTINGS_CACHE_TTL + 1:
+                os.remove(path)
+        except OSError:
+            continue
+
+
+def get_settings_cache_stats():
+    with settings_cache_lock:
+        return dict(settings_cache_stats, size=len(settings_cache),
+                    max_size=SETTINGS_CACHE_MAX, ttl=SETTINGS_CACHE_TTL)
 
 
 def get_firestore_config(user_id="default_user"):
     logger.info("get_firestore_config: loading config for user_id=%s", user_id)
-    try:
-        doc = config_ref.document(user_id).get()
-        if doc.exists:
-            data = doc.to_dict()
-            logger.debug("get_firestore_config: found document %s -> %s",
-                         user_id, data)
-            return data
-        else:
-            # Firestoreにまだ設定がない場合、デフォルトを作成
-            default_config = {
-                "fontSize": 16,
-                "lineHeight": 1.6,
-                "fontSelect": "Kosugi Maru"
-            }
-            config_ref.document(user_id).set(default_config)
-            logger.info(
-                "get_firestore_config: created default config for new user_id=%s",
-                user_id)
-            return default_config
-    except Exception as e:
-        logger.exception(
-            "get_firestore_config: Firestore access failed for user_id=%s",
-            user_id)
-        # エラー時には安全なデフォルトを返す
-        return {"fontSize": 16, "lineHeight": 1.6, "fontSelect": "Kosugi Maru"}
+    data = get_document("messages", user_id)
+    if data:
+        logger.debug("get_firestore_config: found document %s -> %s",
+                     user_id, data)
+        return data
+    # 読み込み経路では書き込まない。Firestoreに設定がない・取得失敗時はデフォルトを返す
+    return {"fontSize": 16, "lineHeight": 1.6, "fontSelect": "Kosugi Maru"}
 
 
 def get_document(collection_name, doc_id):
-    try:
-        logger.info(
-            f"get_document: loading document '{doc_id}' from collection '{collection_name}'"
-        )
-        doc_ref = db.collection(collection_name).document(doc_id)
-        doc = doc_ref.get()
-        if doc.exists:
-            return doc.to_dict()
+    """
+    ドキュメントを dict で返す（存在しない・エラー時は None）。
+    SETTINGS_CACHE_TTL 秒の間はキャッシュから返す（別のワーカーで書き込まれていれば読み直す）。
+    エラーはキャッシュしない。
+    """
+    key = (collection_name, doc_id)
+    now, fetched_ns = time.monotonic(), time.time_ns()
+    with settings_cache_lock:
+        entry = settings_cache.get(key)
+    hit = entry is not None and entry[0] > now and not _settings_entry_stale(key, entry)
+    with settings_cache_lock:
+        if hit:
+            if key in settings_cache:
+                settings_cache.move_to_end(key)
+            settings_cache_stats["hits"] += 1
         else:
-            logger.warning(f"get_document: document '{doc_id}' not found.")
-            return None
+            settings_cache_stats["misses"] += 1
+    inc_metric("pdfremaker_settings_cache_total", result="hit" if hit else "miss")
+    if hit:
+        return dict(entry[1]) if entry[1] is not None else None
+
+    try:
+        with timed("firestore"):
+            data = _fetch_document(collection_name, doc_id)
     except Exception as e:
         logger.exception("Firestoreアクセス中にエラーが発生しました")
         return None
 
+    with settings_cache_lock:
+        _settings_cache_put(key, data, now, fetched_ns)
+    return dict(data) if data is not None else None
+
+
+def _settings_cache_put(key, data, now, fetched_ns):
+    """settings_cache_lock を持った状態で呼ぶ。fetched_ns は Firestore から読み始めた時刻"""
+    settings_cache[key] = (now + SETTINGS_CACHE_TTL, data, fetched_ns)
+    settings_cache.move_to_end(key)
+    while len(settings_cache) > SETTINGS_CACHE_MAX:
+        settings_cache.popitem(last=False)
+        settings_cache_stats["evictions"] += 1
+
+
+def _fetch_documents(collection_name, doc_ids):
+    """Firestore の get_all で複数件を1回で読む。{doc_id: dict or None}"""
+    logger.info("get_documents: loading %d documents from collection '%s' in one call",
+                len(doc_ids), collection_name)
+    client = get_db()
+    refs = [client.collection(collection_name).document(doc_id) for doc_id in doc_ids]
+    found = dict.fromkeys(doc_ids)
+    for doc in client.get_all(refs):
+        if doc.exists:
+            found[doc.id] = doc.to_dict()
+    missing = [doc_id for doc_id, data in found.items() if data is None]
+    if missing:
+        logger.warning("get_documents: documents not found: %s", ", ".join(missing))
+    return found
+
+
+def get_documents(collection_name, doc_ids):
+    """
+    get_document の複数件版。{doc_id: dict or None} を返す。
+    キャッシュに無い分だけを1回の get_all でまとめて読む。エラー時はその分を None にしてキャッシュしない。
+    """
+    now, fetched_ns = time.monotonic(), time.time_ns()
+    result = {}
+    misses = []
+    with settings_cache_lock:
+        entries = {doc_id: settings_cache.get((collection_name, doc_id)) for doc_id in doc_ids}
+    for doc_id, entry in entries.items():
+        key = (collection_name, doc_id)
+        if entry is not None and entry[0] > now and not _settings_entry_stale(key, entry):
+            result[doc_id] = dict(entry[1]) if entry[1] is not None else None
+        else:
+            misses.append(doc_id)
+    with settings_cache_lock:
+        for doc_id in result:
+            if (collection_name, doc_id) in settings_cache:
+                settings_cache.move_to_end((collection_name, doc_id))
+        settings_cache_stats["hits"] += len(result)
+        settings_cache_stats["misses"] += len(misses)
+    inc_metric("pdfremaker_settings_cache_total", len(result), result="hit")
+    inc_metric("pdfremaker_settings_cache_total", len(misses), result="miss")
+    if misses:
+        try:
+            with timed("firestore"):
+                fetched = _fetch_documents(collection_name, misses)
+        except Exception:
+            logger.exception("Firestoreアクセス中にエラーが発生しました")
+            fetched = None
+        if fetched is not None:
+            with settings_cache_lock:
+                for doc_id, data in fetched.items():
+                    _settings_cache_put((collection_name, doc_id), data, now, fetched_ns)
+        for doc_id in misses:
+            data = fetched.get(doc_id) if fetched else None
+            result[doc_id] = dict(data) if data is not None else None
+    return {doc_id: result[doc_id] for doc_id in doc_ids}
+
+
+def _on_settings_snapshot(col_snapshot, changes, read_time):
+    """Firestore の変更通知を受けたら該当 ID のキャッシュを捨てる"""
+    for change in changes:
+        invalidate_document("messages", change.document.id)
+
+
+def start_settings_listener():
+    """SETTINGS_CACHE_LISTEN=1 のとき、messages コレクションの変更を監視する"""
+    if not SETTINGS_CACHE_LISTEN:
+        return None
+    try:
+        watch = get_db().collection("messages").on_snapshot(_on_settings_snapshot)
+        logger.info("✅ 生徒設定のスナップショット監視を開始しました")
+        return watch
+    except Exception:
+        logger.exception("start_settings_listener: 監視を開始できませんでした（TTLのみで運用）")
+        return None
+
+
+settings_watch = None  # get_db が接続したときに start_settings_listener で開始する
+
 
 app = Flask(__name__)
 app_root = os.path.dirname(os.path.abspath(__file__))
-JAPANESE_FONT_NAME = 'HeiseiKakuGo-W5'
-pdfmetrics.registerFont(UnicodeCIDFont(JAPANESE_FONT_NAME))
-student_font = JAPANESE_FONT_NAME
-student_font_size = 12
-student_line_height = 4
 UPLOAD_FOLDER = os.path.join(app.root_path, "uploads")
 OUTPUT_FOLDER = os.path.join(app.root_path, "output")
+JOB_FOLDER = os.path.join(app.root_path, "jobs")
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(OUTPUT_FOLDER, exist_ok=True)
+os.makedirs(JOB_FOLDER, exist_ok=True)
+
+# アップロード取り込み設定
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_MB", "100")) * 1024 * 1024  # 上限
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+
+# ログ閲覧設定
+LOG_PAGE_SIZE = 200  # 1ページの件数
+LOG_READ_BLOCK = 64 * 1024  # 末尾から読むときのブロックサイズ
+LOG_LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40, "CRITICAL": 50}
+LOG_LINE_PATTERN = re.compile(r"^\d{4}-\d{2}-\d{2} [\d:,]+ \[(\w+)\] ")  # setup_logging の書式
+LOG_DATE_PATTERN = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+LOG_CURSOR_PATTERN = re.compile(r"^\d+\.\d+:\d+$")  # inode.先頭行の crc32:オフセット
+
+# 非同期ジョブ設定
+JOB_MAX_WORKERS = int(os.environ.get("JOB_MAX_WORKERS", "2"))  # 同時処理数
+JOB_MAX_PENDING = int(os.environ.get("JOB_MAX_PENDING", "20"))  # 待ち行列の上限
+JOB_MAX_KEEP = int(os.environ.get("JOB_MAX_KEEP", "200"))  # メモリに保持する件数
+JOB_RESULT_TTL = int(os.environ.get("JOB_RESULT_TTL_HOURS", "24")) * 3600  # 終わったジョブの状態・結果HTMLを残す時間
+STREAM_MAX_ACTIVE = int(os.environ.get("STREAM_MAX_ACTIVE", str(JOB_MAX_WORKERS)))  # 同時に流せるストリーミング表示の数
+JOB_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+JOB_PROGRESS_SAVE_INTERVAL = 0.5  # 進捗をディスクに書く間隔（秒）。段階が変わったときはすぐ書く
+JOB_EVENTS_POLL_INTERVAL = 0.5  # /jobs/<id>/events が進捗を見に行く間隔（秒）
+JOB_EVENTS_MAX_SECONDS = 60  # 1回の接続で流す最長時間（秒）。切れたらブラウザが再接続する
+JOB_EVENTS_HEARTBEAT = 15  # 変化が無いときに接続維持のコメントを送る間隔（秒）
+JOB_ORPHANED_ERROR = "処理していたワーカーが終了したため、処理が中断されました。もう一度アップロードしてください。"
+
+job_executor = ThreadPoolExecutor(max_workers=JOB_MAX_WORKERS,
+                                  thread_name_prefix="pdf_job")
+jobs = {}
+jobs_lock = threading.Lock()
+# ストリーミング表示はリクエストのスレッドで処理するので、同時実行数をここで絞る（空きが無ければジョブに回す）
+stream_slots = threading.BoundedSemaphore(STREAM_MAX_ACTIVE)
+
+# ページ並列抽出設定
+PARALLEL_WORKERS = int(os.environ.get("PDF_PARALLEL_WORKERS", str(os.cpu_count() or 1)))
+PARALLEL_PAGE_THRESHOLD = int(os.environ.get("PDF_PARALLEL_PAGE_THRESHOLD", "50"))  # このページ数以上で並列化
+page_pool = None
+page_pool_lock = threading.Lock()
+
+# 結果キャッシュ設定（PDFの中身 + 生徒設定 をキーにする）
+CACHE_SETTING_KEYS = ("fontSelect", "fontSize", "lineHeight")
+RESULT_MANIFEST = "result.json"
+LAYOUT_FILE = "layout.bin"  # 生徒設定に依存しない抽出結果（バイナリ形式）
+LAYOUT_DOC_ID_PATTERN = re.compile(r"^[^/\\]+_[0-9a-f]{16}$")  # 出力フォルダ名（ファイル名_PDFハッシュ）
+RENDER_DIR_PATTERN = re.compile(r"^render_[0-9a-f]{12}$")
+PAGE_RANGE_PATTERN = re.compile(r"^(\d+)\s*(-\s*(\d*))?$")  # "3" / "3-10" / "3-"
+SOURCE_FILE = "source.pdf"  # 未抽出ページが残るとき、後から抽出するために残す元PDF
+LAZY_INITIAL_PAGES = int(os.environ.get("LAZY_INITIAL_PAGES", "5"))  # lazy モードで最初に処理するページ数
+EXTRACT_MAX_ATTEMPTS = 3  # 他リクエストの抽出を待ったあと、足りないページを抽出し直す回数の上限
+FRAGMENT_PAGES = int(os.environ.get("FRAGMENT_PAGES", "5"))  # 結果ページがスクロール時に1回で読み込むページ数
+FRAGMENT_MAX_PAGES = 50  # /fragments が1回に返す最大ページ数
+FRAGMENT_VIEWS = ("styled", "neo", "og", "sorted", "images")  # 結果ページのページ単位の表示
+STREAM_FIRST_PAGES = 1  # ストリーミング表示で最初に抽出するページ数（以降は倍々に増やす）
+STREAM_MAX_CHUNK_PAGES = int(os.environ.get("STREAM_MAX_CHUNK_PAGES", "64"))  # 1回に抽出するページ数の上限
+
+# 配信時のキャッシュ設定（/outputs・/download・/text・ジョブ結果）
+IMMUTABLE_MAX_AGE = 365 * 86400  # 内容ハッシュで決まるパスのキャッシュ期間（秒）
+FILE_ETAG_CACHE_MAX = 2048  # 計算済みの内容ハッシュ（ETag）を覚えておく件数
+PRECOMPRESS_MIN_BYTES = 1024  # これより小さいファイルは圧縮版を作らない
+PRECOMPRESS_TYPES = ("text/", "application/json", "application/javascript", "image/svg+xml")
+IMAGE_DIGEST_PATTERN = re.compile(r"^[0-9a-f]{64}$")  # 画像ストアのファイル名（内容の sha256）
+
+# 再構成PDFの描画エンジン
+PDF_RENDERERS = ("weasyprint", "pymupdf")
+PDF_RENDERER = os.environ.get("PDF_RENDERER", "auto")  # weasyprint / pymupdf / auto（ページ数で選ぶ）
+PDF_RENDERER_AUTO_PAGES = int(os.environ.get("PDF_RENDERER_AUTO_PAGES", "30"))  # auto でこのページ数以上なら pymupdf
+PYMUPDF_PAGE_SIZE = (595.28, 841.89)  # A4（pt）。WeasyPrint の既定と同じ
+PYMUPDF_PAGE_MARGIN = 56.25 + 28.35  # WeasyPrint の既定余白 75px + body の padding 1cm（pt）
+
+# 読み順（段組み検出）設定
+READING_ORDER = os.environ.get("READING_ORDER", "columns")  # columns: 段組みを検出して列ごとに読む / legacy: 従来の (y0, x0) 順
+COLUMN_MIN_GUTTER = float(os.environ.get("COLUMN_MIN_GUTTER", "12"))  # 列と列の間とみなす最小の空き（pt）
+COLUMN_MIN_WIDTH_RATIO = 0.2  # 本文幅に対する1列の最小幅（番号だけの列などを段組みと誤認しない）
+COLUMN_SPAN_TOLERANCE = 2.0  # 列境界をこれ以上またぐ要素は段をまたぐ（見出し・表など）とみなす（pt）
+
+# クラス一括処理（1つのPDFを複数の生徒設定で再構成する）
+BATCH_MAX_STUDENTS = int(os.environ.get("BATCH_MAX_STUDENTS", "60"))  # 1回に指定できる生徒数
+BATCH_ID_SEPARATOR = re.compile(r"[\s,、]+")  # 生徒IDの区切り（改行・空白・カンマ）
+BATCH_ARCHIVE_PREFIX = "batch_"  # 文書フォルダ直下に置く一括ダウンロード用 zip
+
+# 起動時の読み込み設定
+WARMUP_ON_START = os.environ.get("WARMUP_ON_START", "1") == "1"  # 起動直後に裏で重い依存を読み込む
+PRELOAD = os.environ.get("PDFREMAKER_PRELOAD", "0") == "1"  # gunicorn --preload のマスターで読み込まれている
+warm_state = {"ready": False, "started_at": None, "finished_at": None, "error": None}
+retention_thread = None  # start_background_workers で開始
+
+# 出力・アップロードの保持設定（バックグラウンドで削除する）
+RETENTION_QUOTA_BYTES = int(os.environ.get("RETENTION_QUOTA_MB", "2048")) * 1024 * 1024  # 容量上限
+RETENTION_MAX_AGE = int(os.environ.get("RETENTION_MAX_AGE_DAYS", "30")) * 86400  # 最終アクセスからの保持期間
+RETENTION_INTERVAL = int(os.environ.get("RETENTION_INTERVAL_SEC", "600"))  # 掃除の間隔
+RETENTION_GRACE = int(os.environ.get("RETENTION_GRACE_SEC", "600"))  # 直近に使われたものは消さない
+RETENTION_LOCK_FILE = ".retention.lock"
+METRICS_STALE_AGE = int(os.environ.get("METRICS_STALE_AGE_SEC", "86400"))  # 終了したプロセスの計測ファイルを残す時間
+ACCESS_MARKER = ".last_access"  # 文書フォルダの最終アクセス時刻（mtime）
+ACCESS_TOUCH_INTERVAL = 60
+access_touched = {}  # rel_dir -> 最後に ACCESS_MARKER を更新した時刻
+access_lock = threading.Lock()
+IMAGE_STORE_DIR = "images"  # OUTPUT_FOLDER 配下の画像ストア（内容ハッシュで共有）
+IMAGE_DIGEST_KEYS = ("Width", "Height", "BitsPerComponent", "ColorSpace", "Decode", "Filter",
+                     "DecodeParms", "ImageMask", "Matte")  # 同じ生バイトでも見え方を変える画像辞書のキー
+IMAGE_DIGEST_REF_DEPTH = 4  # パレット・ICC など参照先をたどる深さ
+PDF_REF_PATTERN = re.compile(r"(\d+) (\d+) R\b")
+IMAGE_PASSTHROUGH = os.environ.get("IMAGE_PASSTHROUGH", "1") == "1"  # JPEG等を再エンコードせずそのまま保存
+PASSTHROUGH_IMAGE_EXTS = ("jpeg", "png")  # ブラウザ・WeasyPrint がそのまま読める形式
+inflight = {}  # cache_key -> Future（同一キーの同時処理をまとめる）
+inflight_lock = threading.Lock()
+
+
+class UploadSpool:
+    """
+    multipart のファイル部分を UPLOAD_FOLDER の一時ファイルに直接書きながら sha256 とサイズを数える。
+    ingest_upload が引き取らなかったもの（PDF 以外・エラー）はリクエストの終わりに close で消える
+    """
+
+    def __init__(self):
+        fd, self.path = tempfile.mkstemp(suffix=".pdf", dir=UPLOAD_FOLDER)
+        self.file = os.fdopen(fd, "w+b")
+        self.digest = hashlib.sha256()
+        self.size = 0
+        self.kept = False
+
+    def write(self, data):
+        self.digest.update(data)
+        self.size += len(data)
+        return self.file.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+    def close(self):
+        self.file.close()
+        if not self.kept:
+            discard_upload({"path": self.path})
+
+
+class UploadRequest(Request):
+    """multipart のファイル部分をメモリに置かず、UploadSpool で UPLOAD_FOLDER に書く Request"""
+
+    def _get_file_stream(self, total_content_length, content_type,
+                         filename=None, content_length=None):
+        return UploadSpool()
+
+
+app.request_class = UploadRequest
+app.config["MAX_CONTENT_LENGTH"] = MAX_UPLOAD_BYTES
+
+
+class UploadTooLarge(Exception):
+    """アップロードが MAX_UPLOAD_BYTES を超えた（413 で返す）"""
+
+
+def ingest_upload(file_storage, filename):
+    """
+    アップロードを UPLOAD_FOLDER のファイルとして取り込む（メモリ上に bytes は作らない）。
+    UploadRequest が受信しながら書いたファイルとハッシュをそのまま引き取り、
+    それ以外のストリームならチャンクごとにハッシュを取りながらファイルに書く。
+    戻り値: {"name", "digest", "size", "data": None, "path": str}
+    MAX_UPLOAD_BYTES を超えたら UploadTooLarge
+    """
+    limit_error = f"ファイルが大きすぎます（上限 {MAX_UPLOAD_BYTES // (1024 * 1024)}MB）"
+    stream = file_storage.stream
+    if isinstance(stream, UploadSpool):
+        if stream.size > MAX_UPLOAD_BYTES:
+            raise UploadTooLarge(limit_error)
+        stream.flush()
+        stream.kept = True
+        return {"name": filename, "digest": stream.digest.hexdigest(), "size": stream.size,
+                "data": None, "path": stream.path}
+
+    digest = hashlib.sha256()
+    size = 0
+    fd, path = tempfile.mkstemp(suffix=".pdf", dir=UPLOAD_FOLDER)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            while True:
+                chunk = stream.read(UPLOAD_CHUNK_BYTES)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > MAX_UPLOAD_BYTES:
+                    raise UploadTooLarge(limit_error)
+                digest.update(chunk)
+                f.write(chunk)
+    except BaseException:
+        discard_upload({"path": path})
+        raise
+    return {"name": filename, "digest": digest.hexdigest(), "size": size,
+            "data": None, "path": path}
+
+
+def discard_upload(upload):
+    """ingest_upload が一時ファイルに書いた分を消す"""
+    path = upload.get("pdf_path", upload.get("path"))
+    if path and os.path.isfile(path):
+        try:
+            os.remove(path)
+        except OSError:
+            logger.exception("discard_upload: failed to remove %s", path)
+
+
+def _job_public_state(job):
+    """ステータス API 用にジョブ情報を切り出す（結果HTMLは含めない）"""
+    return {
+        k: job.get(k)
+        for k in ["job_id", "status", "pdf_name", "student_id", "student_ids", "pages",
+                  "lazy", "renderer", "error", "progress", "owner",
+                  "created_at", "started_at", "finished_at"]
+    }
+
+
+def _process_token(pid):
+    """
+    pid のプロセスを識別する文字列（pid:起動時刻）。プロセスが無ければ None。
+    pid は再利用されるので、/proc で起動時刻も見て別のプロセスと区別する（/proc が無ければ pid だけ）
+    """
+    try:
+        with open(f"/proc/{pid}/stat", "r") as f:
+            return f"{pid}:{f.read().rsplit(')', 1)[1].split()[19]}"
+    except (OSError, IndexError):
+        pass
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return None
+    except PermissionError:
+        pass
+    return str(pid)
+
+
+def _job_owner_alive(job):
+    """ジョブを処理しているワーカーが動いているか。owner の無い古い状態ファイルは動いているとみなす"""
+    owner = job.get("owner")
+    if not owner:
+        return True
+    return _process_token(int(owner.split(":")[0])) == owner
+
+
+def _fail_orphaned_job(job, state_path):
+    """
+    待ち・処理中のままワーカーが終了した（max_requests による再起動・デプロイなど）ジョブを error にして書き戻す。
+    そのままだと /jobs/<id>/events がいつまでも進捗を流し続ける
+    """
+    job = dict(job, status="error", error=JOB_ORPHANED_ERROR, finished_at=time.time())
+    tmp_path = state_path + ".tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(job, f, ensure_ascii=False)
+        os.replace(tmp_path, state_path)
+    except OSError:
+        logger.exception("job %s: 状態の保存に失敗しました", job.get("job_id"))
+    logger.warning("job %s: owner %s is gone; marked as error", job.get("job_id"), job.get("owner"))
+    return job
+
+
+def _save_job_state(job):
+    """
+    ジョブ状態をディスクにも書き出す。
+    gunicorn の別ワーカーにポーリングが届いても状態を返せるようにするため。
+    """
+    state_path = os.path.join(JOB_FOLDER, f"{job['job_id']}.json")
+    tmp_path = state_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(_job_public_state(job), f, ensure_ascii=False)
+    os.replace(tmp_path, state_path)
+
+    if job.get("result_html") is not None:
+        with open(os.path.join(JOB_FOLDER, f"{job['job_id']}.html"),
+                  "w", encoding="utf-8") as f:
+            f.write(job["result_html"])
+
+
+def _update_job(job_id, **fields):
+    with jobs_lock:
+        job = jobs.get(job_id)
+        if job is None:
+            return
+        job.update(fields)
+        snapshot = dict(job)
+    try:
+        _save_job_state(snapshot)
+    except Exception:
+        logger.exception("job %s: 状態の保存に失敗しました", job_id)
+
+
+def _report_job_progress(job_id, stage, fields):
+    """report_progress の実体。メモリ上の進捗は毎回更新し、ディスクへは段階が変わったときか一定間隔で書く"""
+    now = time.monotonic()
+    with jobs_lock:
+        job = jobs.get(job_id)
+        if job is None:
+            return
+        progress = job.get("progress") or {}
+        changed = progress.get("stage") != stage
+        job["progress"] = dict(progress, stage=stage, **fields)
+        if not changed and now - job.get("progress_saved_at", 0.0) < JOB_PROGRESS_SAVE_INTERVAL:
+            return
+        job["progress_saved_at"] = now
+        snapshot = dict(job)
+    try:
+        _save_job_state(snapshot)
+    except Exception:
+        logger.exception("job %s: 進捗の保存に失敗しました", job_id)
+
+
+def _run_job(job_id):
+    """ワーカースレッドで Firestore 取得 → process_pdf を実行する"""
+    with jobs_lock:
+        job = dict(jobs[job_id])
+    _update_job(job_id, status="running", started_at=time.time())
+    job_progress.reporter = lambda stage, fields: _report_job_progress(job_id, stage, fields)
+    logger.info("job %s: started (%s, %d bytes)", job_id, job["pdf_name"],
+                job["pdf_size"])
+
+    try:
+        if job["student_ids"]:
+            # クラス一括: 設定はまとめて1回で読み、抽出も1回だけにする
+            student_settings = get_documents("messages", job["student_ids"])
+            with app.test_request_context("/"), timed("process_batch"):
+                result_html = process_batch(job["pdf_data"] or job["pdf_path"],
+                                            student_settings,
+                                            pages=job["pages"],
+                                            pdf_name=job["pdf_name"],
+                                            pdf_digest=job["pdf_digest"],
+                                            renderer=job["renderer"])
+            _update_job(job_id, status="done", result_html=result_html,
+                        finished_at=time.time())
+            logger.info("job %s: done (%d students)", job_id, len(student_settings))
+            return
+
+        firebase_settings = None
+        if job["student_id"]:
+            firebase_settings = get_document("messages", job["student_id"])
+            if not firebase_settings:
+                logger.info("job %s: no firebase settings found for id=%s; using defaults",
+                            job_id, job["student_id"])
+
+        # render_template / url_for のためにリクエストコンテキストを用意する
+        with app.test_request_context("/"), timed("process_pdf"):
+            result_html = process_pdf(job["pdf_data"] or job["pdf_path"],
+                                      firebase_settings,
+                                      pages=job["pages"], lazy=job["lazy"],
+                                      pdf_name=job["pdf_name"],
+                                      pdf_digest=job["pdf_digest"],
+                                      renderer=job["renderer"])
+
+        _update_job(job_id, status="done", result_html=result_html,
+                    finished_at=time.time())
+        logger.info("job %s: done", job_id)
+
+    except Exception as e:
+        logger.exception("job %s: error processing %s", job_id, job["pdf_name"])
+        _update_job(job_id, status="error", error=str(e),
+                    finished_at=time.time())
+
+    finally:
+        job_progress.reporter = None
+        # アップロードの中身は処理が終われば不要（メモリ・一時ファイルとも解放する）
+        _update_job(job_id, pdf_data=None, pdf_path=None)
+        discard_upload(job)
+
+
+def _trim_jobs():
+    """完了済みジョブを古い順にメモリから外す（ディスク上の状態は残る）"""
+    with jobs_lock:
+        finished = [j for j in jobs.values() if j["status"] in ("done", "error")]
+        overflow = len(jobs) - JOB_MAX_KEEP
+        for job in sorted(finished, key=lambda j: j["created_at"])[:max(0, overflow)]:
+            jobs.pop(job["job_id"], None)
+
+
+def expire_jobs():
+    """
+    最後の更新（終わったジョブなら完了時）から JOB_RESULT_TTL を過ぎたジョブの
+    jobs/<id>.json・jobs/<id>.html とメモリ上の記録を消す。
+    待ち・処理中かどうかはディスク上の状態で見る（別のワーカーのジョブも消さない）。
+    処理していたワーカーが終了していれば error にする（その時刻から JOB_RESULT_TTL 後に消える）
+    """
+    now = time.time()
+    with jobs_lock:
+        for job_id, job in list(jobs.items()):
+            if job["status"] in ("done", "error") and now - job["finished_at"] > JOB_RESULT_TTL:
+                jobs.pop(job_id, None)
+
+    active = set()
+    for name in os.listdir(JOB_FOLDER):
+        if not name.endswith(".json"):
+            continue
+        path = os.path.join(JOB_FOLDER, name)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                job = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if job.get("status") in ("queued", "running"):
+            if _job_owner_alive(job):
+                active.add(name[:-len(".json")])
+            else:
+                _fail_orphaned_job(job, path)
+
+    removed = 0
+    for name in os.listdir(JOB_FOLDER):
+        if name.split(".")[0] in active:
+            continue
+        path = os.path.join(JOB_FOLDER, name)
+        try:
+            if now - os.path.getmtime(path) <= JOB_RESULT_TTL:
+                continue
+            os.remove(path)
+            removed += 1
+        except OSError:
+            continue
+    if removed:
+        logger.info("🧹 jobs: removed %d expired job files", removed)
+    return removed
+
+
+def submit_job(upload, student_id="", pages="", lazy=False, student_ids=None, renderer=""):
+    """
+    PDF処理ジョブを登録してジョブIDを返す（upload は ingest_upload の戻り値）。
+    student_ids（リスト）を渡すとクラス一括処理のジョブになる。renderer は描画エンジンの指定（空なら既定）。
+    待ち行列が上限を超えている場合は None を返す。
+    """
+    with jobs_lock:
+        pending = sum(1 for j in jobs.values()
+                      if j["status"] in ("queued", "running"))
+        if pending >= JOB_MAX_PENDING:
+            return None
+        job_id = uuid.uuid4().hex
+        jobs[job_id] = {
+            "job_id": job_id,
+            "status": "queued",
+            "pdf_data": upload["data"],
+            "pdf_path": upload["path"],
+            "pdf_name": upload["name"],
+            "pdf_digest": upload["digest"],
+            "pdf_size": upload["size"],
+            "student_id": student_id,
+            "student_ids": student_ids,
+            "pages": pages,
+            "lazy": lazy,
+            "renderer": renderer,
+            "error": None,
+            "progress": None,
+            "owner": _process_token(os.getpid()),
+            "result_html": None,
+            "created_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+        }
+        snapshot = dict(jobs[job_id])
+
+    _save_job_state(snapshot)
+    job_executor.submit(_run_job, job_id)
+    _trim_jobs()
+    logger.info("submit_job: queued job %s for %s", job_id, upload["name"])
+    return job_id
+
+
+def get_job(job_id):
+    """ジョブ状態を返す。メモリに無ければディスクから読む。存在しなければ None"""
+    if not JOB_ID_PATTERN.match(job_id or ""):
+        return None
+    with jobs_lock:
+        job = jobs.get(job_id)
+        if job is not None:
+            return _job_public_state(job)
+
+    state_path = os.path.join(JOB_FOLDER, f"{job_id}.json")
+    if not os.path.isfile(state_path):
+        return None
+    with open(state_path, "r", encoding="utf-8") as f:
+        job = json.load(f)
+    if job["status"] in ("queued", "running") and not _job_owner_alive(job):
+        job = _fail_orphaned_job(job, state_path)
+    return job
+
+
+def get_job_result(job_id):
+    """完了済みジョブの result.html を返す。未完了・不明なら None"""
+    if not JOB_ID_PATTERN.match(job_id or ""):
+        return None
+    with jobs_lock:
+        job = jobs.get(job_id)
+        if job is not None and job.get("result_html") is not None:
+            return job["result_html"]
+
+    result_path = os.path.join(JOB_FOLDER, f"{job_id}.html")
+    if not os.path.isfile(result_path):
+        return None
+    with open(result_path, "r", encoding="utf-8") as f:
+        return f.read()
 
 
 # 戻る
@@ -301,7 +1308,8 @@ def update_firestore():
         if not doc_id:
             return jsonify({"message": "IDが指定されていません。"}), 400
 
-        db.collection("messages").document(doc_id).set(data)
+        get_db().collection("messages").document(doc_id).set(data)
+        invalidate_document("messages", doc_id)
         logger.info(f"Firestore updated for id={doc_id}")
         return jsonify({"message": f"{doc_id} の設定を登録しました！"})
 
@@ -310,6 +1318,18 @@ def update_firestore():
         return jsonify({"message": "Firestore更新中に内部エラーが発生しました。"}), 500
 
 
+# Prometheus 形式のメトリクス（全ワーカー分を合算）
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    return collect_metrics(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+
+# 生徒設定キャッシュの状態（監視用）
+@app.route("/settings_cache/stats", methods=["GET"])
+def settings_cache_stats_api():
+    return jsonify(get_settings_cache_stats())
+
+
 # Firestoreのメッセージ取得
 @app.route("/get_message", methods=["GET"])
 def get_message_api():
@@ -354,138 +1374,693 @@ def upload_pdf():
         logger.warning(f"upload_pdf: uploaded file is not a PDF: {filename}")
         return "PDFファイルをアップロードしてください。"
 
-    # student_id設定確認
+    # student_id設定確認（Firestore の取得はジョブ側で行う）
     student_id = request.form.get("student_id", "").strip()
     logger.info(f"upload_pdf: student_id={student_id or '<none>'}")
 
-    firebase_settings = None
-    if student_id:
-        firebase_settings = get_document("messages", student_id)
-        if firebase_settings:
-            logger.info(f"upload_pdf: applying firebase settings for id={student_id}")
-        else:
-            logger.info(f"upload_pdf: no firebase settings found for id={student_id}; using defaults")
-
+    # ページ指定（例: 3-10,15）と lazy モード
+    pages = request.form.get("pages", "").strip()
+    lazy = request.form.get("lazy", "") in ("1", "on", "true")
+    if pages and not all(PAGE_RANGE_PATTERN.match(part.strip())
+                         for part in pages.replace("、", ",").split(",") if part.strip()):
+        logger.warning(f"upload_pdf: invalid page range: {pages}")
+        return f"ページ指定が不正です: {pages}", 400
+
+    # 描画エンジン（空・auto ならページ数で自動選択）
+    renderer = request.form.get("renderer", "").strip().lower()
+    if renderer not in ("", "auto") + PDF_RENDERERS:
+        return f"描画エンジンの指定が不正です: {renderer}", 400
+
+    # ストリーミング表示（処理できたページから順に結果ページを流す）
+    stream = request.form.get("stream", "") in ("1", "on", "true")
+
+    # upload はジョブかストリーミング表示に渡せたらそちらが片付ける。渡せなければ finally で消す
+    upload = None
+    handed_off = False
     try:
         filename = secure_filename(filename)
-        filepath = os.path.join(UPLOAD_FOLDER, filename)
-        uploaded_file.save(filepath)
-        logger.info(f"upload_pdf: saved file to {filepath}")
+        with timed("upload_ingest"):
+            upload = ingest_upload(uploaded_file, filename)
+        inc_metric("pdfremaker_upload_bytes_total", upload["size"])
+        logger.info("upload_pdf: ingested %s (%d bytes)", filename, upload["size"])
+
+        # 枠が空いていればこのリクエストで処理して流す。埋まっていれば通常のジョブにする
+        if stream and stream_slots.acquire(blocking=False):
+            inc_metric("pdfremaker_uploads_total", status="streamed")
+            logger.info("upload_pdf: streaming result for %s", filename)
+            try:
+                response = stream_result(upload, student_id, pages, lazy, renderer)
+            except Exception:
+                stream_slots.release()
+                raise
+            handed_off = True
+            return response
 
-        result_html = process_pdf(filepath, firebase_settings)
-        logger.info(f"upload_pdf: process_pdf completed for {filepath}")
-        return result_html
+        job_id = submit_job(upload, student_id, pages, lazy, renderer=renderer)
+        handed_off = job_id is not None
+
+    except UploadTooLarge as e:
+        logger.warning(f"upload_pdf: rejected {filename}: {e}")
+        inc_metric("pdfremaker_uploads_total", status="too_large")
+        return str(e), 413
 
     except Exception as e:
-        logger.exception(f"upload_pdf: error processing uploaded file {filename}")
+        logger.exception(f"upload_pdf: error queuing uploaded file {filename}")
+        inc_metric("pdfremaker_uploads_total", status="error")
         return f"処理中にエラーが発生しました: {e}", 500
 
+    finally:
+        if upload and not handed_off:
+            discard_upload(upload)
 
-@app.route('/outputs/<path:filepath>')
-def serve_output_file(filepath):
-    try:
-        logger.info(f"serve_output_file: request for {filepath}")
-        safe_path = os.path.normpath(filepath)
-        full_path = os.path.join(OUTPUT_FOLDER, safe_path)
-        full_path = os.path.abspath(full_path)
-        output_folder_abs = os.path.abspath(OUTPUT_FOLDER)
+    if job_id is None:
+        logger.warning("upload_pdf: job queue is full")
+        inc_metric("pdfremaker_uploads_total", status="queue_full")
+        return "現在混み合っています。しばらくしてから再度お試しください。", 503
 
-        # 出力フォルダ外へのアクセスを防ぐ
-        if not (full_path.startswith(output_folder_abs + os.path.sep) or full_path == output_folder_abs):
-            return jsonify({"message": "不正なパスです"}), 400
+    inc_metric("pdfremaker_uploads_total", status="accepted")
 
-        if not os.path.isfile(full_path):
-            return jsonify({"message": "ファイルが見つかりません。"}), 404
+    # API クライアントには JSON、ブラウザには待機ページを返す
+    if request.accept_mimetypes.best == "application/json":
+        return jsonify({
+            "job_id": job_id,
+            "status_url": url_for("job_status", job_id=job_id),
+            "result_url": url_for("job_result", job_id=job_id)
+        }), 202
+    return render_template("job.html", page_name="upload", job_id=job_id,
+                           pdf_name=filename), 202
 
-        # MIMEタイプを推測して inline で返す（iframe 表示用）
-        mimetype, _ = mimetypes.guess_type(full_path)
-        if mimetype is None:
-            mimetype = "application/octet-stream"
 
-        logger.info(f"serve_output_file: sending file {full_path} with mimetype {mimetype}")
-        return send_file(full_path, mimetype=mimetype, as_attachment=False)
+@app.errorhandler(413)
+def upload_too_large(e):
+    inc_metric("pdfremaker_uploads_total", status="too_large")
+    return f"ファイルが大きすぎます（上限 {MAX_UPLOAD_BYTES // (1024 * 1024)}MB）", 413
 
-    except Exception as e:
-        logger.exception("ファイル送信中にエラーが発生しました")
-        return jsonify({"message": "内部エラーが発生しました。ログをご確認ください。"}), 500
 
+@app.route("/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({"error": "ジョブが見つかりません"}), 404
+    return jsonify(job | {"result_url": url_for("job_result", job_id=job_id)})
 
-@app.route("/result")
-def result_page():
-    try:
-        # ここで実際のデータを渡してレンダリング
-        pdf_name = request.args.get("pdf_name", "output.pdf")
-        dir_name = request.args.get("dir_name", "output")
 
-        # ダミーデータ（テスト用）
-        styled_neo_html = "<p>スタイル付きNEOテキストの例</p>"
-        neo_content = "<p>NEOタグ付きテキストの例</p>"
-        og_tagged_content = "<p>OGタグ付きテキストの例</p>"
-        sorted_content = "<p>時系列ソートの例</p>"
-        image_gallery_html = "<p>抽出画像の例</p>"
-        imgs = []
+@app.route("/jobs/<job_id>/result", methods=["GET"])
+def job_result(job_id):
+    job = get_job(job_id)
+    if job is None:
+        return "ジョブが見つかりません。", 404
+    if job["status"] == "error":
+        return f"処理中にエラーが発生しました: {job.get('error')}", 500
+    if job["status"] != "done":
+        return jsonify({"status": job["status"]}), 202
 
-        return render_template(
-            "result.html",
-            pdf_name=pdf_name,
-            dir_name=dir_name,
-            styled_neo_html=styled_neo_html,
-            neo_content=neo_content,
-            og_tagged_content=og_tagged_content,
-            sorted_content=sorted_content,
-            image_gallery_html=image_gallery_html,
-            imgs=imgs,
-            download_html="""
-                <a href='/outputs/{0}' target='_blank'>PDFを開く</a>
-            """.format(pdf_name)
-        )
+    result_html = get_job_result(job_id)
+    if result_html is None:
+        return "処理結果が見つかりません。", 404
+    # 完了したジョブの結果は変わらない
+    return conditional_text(f"job-{job_id}", lambda: result_html, "text/html; charset=utf-8")
 
-    except Exception as e:
-        logger.exception("result_page: エラーが発生しました")
-        return f"エラーが発生しました: {e}", 500
 
+def _sse(event, data):
+    """Server-Sent Events の1件分"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
 
-@app.route("/logs")
-def view_logs():
-    try:
-        log_base_dir = "logs"
-        log_dirs = sorted(
-            [d for d in os.listdir(log_base_dir) if os.path.isdir(os.path.join(log_base_dir, d))],
-            reverse=True
-        )
 
-        all_logs = []
-        for d in log_dirs:
-            log_dir = os.path.join(log_base_dir, d)
-            app_log_path = os.path.join(log_dir, "app.log")
-            error_log_path = os.path.join(log_dir, "error.log")
-
-            app_log = ""
-            error_log = ""
-            if os.path.exists(app_log_path):
-                with open(app_log_path, "r", encoding="utf-8", errors="ignore") as f:
-                    app_log = f.read()
-            if os.path.exists(error_log_path):
-                with open(error_log_path, "r", encoding="utf-8", errors="ignore") as f:
-                    error_log = f.read()
-
-            all_logs.append({
-                "date": d,
-                "app_log": app_log,
-                "error_log": error_log,
-            })
+@app.route("/jobs/<job_id>/events", methods=["GET"])
+def job_events(job_id):
+    """
+    ジョブの進捗を Server-Sent Events で流す（event: progress / done / error）。
+    ワーカーが書いた状態を JOB_EVENTS_POLL_INTERVAL ごとに見て、変わったときだけ送る。
+    gunicorn のワーカーを占有し続けないよう JOB_EVENTS_MAX_SECONDS で切り、ブラウザの再接続に任せる。
+    """
+    if get_job(job_id) is None:
+        return jsonify({"error": "ジョブが見つかりません"}), 404
+    result_url = url_for("job_result", job_id=job_id)
+
+    def generate():
+        yield f"retry: {int(JOB_EVENTS_POLL_INTERVAL * 1000)}\n\n"
+        deadline = time.monotonic() + JOB_EVENTS_MAX_SECONDS
+        last_state, last_sent = None, time.monotonic()
+        while time.monotonic() < deadline:
+            job = get_job(job_id)
+            if job is None:
+                return
+            if job["status"] == "done":
+                yield _sse("done", {"result_url": result_url})
+                return
+            if job["status"] == "error":
+                yield _sse("error", {"error": job.get("error")})
+                return
+
+            state = {"status": job["status"], "progress": job.get("progress")}
+            if state != last_state:
+                yield _sse("progress", state)
+                last_state, last_sent = state, time.monotonic()
+            elif time.monotonic() - last_sent >= JOB_EVENTS_HEARTBEAT:
+                yield ": keep-alive\n\n"
+                last_sent = time.monotonic()
+            time.sleep(JOB_EVENTS_POLL_INTERVAL)
+
+    response = app.response_class(generate(), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+
+# クラス一括処理: 1つのPDFを複数の生徒設定で再構成する
+@app.route("/batch", methods=["GET", "POST"])
+def batch_upload():
+    if request.method != "POST":
+        return render_template("batch.html", page_name="upload",
+                               max_students=BATCH_MAX_STUDENTS)
 
-        # どのフォルダにもログがない場合
-        if not any(l["app_log"] or l["error_log"] for l in all_logs):
-            message = "現在ログファイルはありません。"
-        else:
-            message = ""
+    uploaded_file = request.files.get("file")
+    filename = uploaded_file.filename if uploaded_file else ""
+    if not filename:
+        return "ファイルが選択されていません。", 400
+    if not filename.lower().endswith(".pdf"):
+        logger.warning(f"batch_upload: uploaded file is not a PDF: {filename}")
+        return "PDFファイルをアップロードしてください。", 400
+
+    # 生徒ID（改行・空白・カンマ区切り）。重複は除き、入力順を保つ
+    student_ids = list(dict.fromkeys(
+        i for i in BATCH_ID_SEPARATOR.split(request.form.get("student_ids", "")) if i))
+    if not student_ids:
+        return "生徒IDを1つ以上入力してください。", 400
+    if len(student_ids) > BATCH_MAX_STUDENTS:
+        return f"生徒IDは1回に{BATCH_MAX_STUDENTS}件までです（{len(student_ids)}件）。", 400
+
+    pages = request.form.get("pages", "").strip()
+    if pages and not all(PAGE_RANGE_PATTERN.match(part.strip())
+                         for part in pages.replace("、", ",").split(",") if part.strip()):
+        return f"ページ指定が不正です: {pages}", 400
+
+    renderer = request.form.get("renderer", "").strip().lower()
+    if renderer not in ("", "auto") + PDF_RENDERERS:
+        return f"描画エンジンの指定が不正です: {renderer}", 400
+
+    # upload はジョブに渡せたらジョブが片付ける。渡せなければ finally で消す
+    upload = None
+    job_id = None
+    try:
+        filename = secure_filename(filename)
+        with timed("upload_ingest"):
+            upload = ingest_upload(uploaded_file, filename)
+        inc_metric("pdfremaker_upload_bytes_total", upload["size"])
+        logger.info("batch_upload: ingested %s (%d bytes) for %d students", filename,
+                    upload["size"], len(student_ids))
+        job_id = submit_job(upload, pages=pages, student_ids=student_ids, renderer=renderer)
+
+    except UploadTooLarge as e:
+        logger.warning(f"batch_upload: rejected {filename}: {e}")
+        inc_metric("pdfremaker_uploads_total", status="too_large")
+        return str(e), 413
+
+    except Exception as e:
+        logger.exception(f"batch_upload: error queuing uploaded file {filename}")
+        inc_metric("pdfremaker_uploads_total", status="error")
+        return f"処理中にエラーが発生しました: {e}", 500
+
+    finally:
+        if upload and job_id is None:
+            discard_upload(upload)
+
+    if job_id is None:
+        logger.warning("batch_upload: job queue is full")
+        inc_metric("pdfremaker_uploads_total", status="queue_full")
+        return "現在混み合っています。しばらくしてから再度お試しください。", 503
+
+    inc_metric("pdfremaker_uploads_total", status="accepted")
+
+    if request.accept_mimetypes.best == "application/json":
+        return jsonify({
+            "job_id": job_id,
+            "status_url": url_for("job_status", job_id=job_id),
+            "result_url": url_for("job_result", job_id=job_id)
+        }), 202
+    return render_template("job.html", page_name="upload", job_id=job_id,
+                           pdf_name=filename), 202
+
+
+file_etag_cache = OrderedDict()  # (path, mtime_ns, size) -> 内容の sha256
+file_etag_lock = threading.Lock()
+
+
+def file_etag(path):
+    """
+    ファイル内容の sha256（強い ETag に使う）。画像ストアはファイル名がそのまま内容ハッシュ。
+    それ以外は (パス, mtime, サイズ) ごとに1回だけ計算して覚えておく。
+    """
+    stem = os.path.splitext(os.path.basename(path))[0]
+    if IMAGE_DIGEST_PATTERN.match(stem):
+        return stem
+    st = os.stat(path)
+    key = (path, st.st_mtime_ns, st.st_size)
+    with file_etag_lock:
+        digest = file_etag_cache.get(key)
+        if digest is not None:
+            file_etag_cache.move_to_end(key)
+            return digest
+
+    digest = compute_pdf_digest(path)  # PDF に限らずファイル内容の sha256
+    with file_etag_lock:
+        file_etag_cache[key] = digest
+        while len(file_etag_cache) > FILE_ETAG_CACHE_MAX:
+            file_etag_cache.popitem(last=False)
+    return digest
+
+
+def is_content_addressed(rel_path):
+    """
+    同じ URL の中身が変わらない成果物か。画像ストア（内容ハッシュ）と、
+    PDFハッシュ・設定ハッシュで決まる描画結果・一括 zip・元PDF が該当する（layout.bin は追記されるので除く）
+    """
+    parts = rel_path.replace(os.path.sep, "/").split("/")
+    if parts[0] == IMAGE_STORE_DIR:
+        return True
+    if not LAYOUT_DOC_ID_PATTERN.match(parts[0]):
+        return False
+    if len(parts) == 3:
+        return bool(RENDER_DIR_PATTERN.match(parts[1]))
+    return len(parts) == 2 and (parts[1] == SOURCE_FILE
+                                or parts[1].startswith(BATCH_ARCHIVE_PREFIX))
+
+
+def _write_precompressed(path, variant, encoding):
+    """path の圧縮版を variant に書く。brotli モジュールが無ければ br は作らない"""
+    if encoding == "br" and importlib.util.find_spec("brotli") is None:
+        return False
+    with open(path, "rb") as f:
+        data = f.read()
+    if encoding == "br":
+        data = importlib.import_module("brotli").compress(data)
+    else:
+        data = gzip.compress(data, mtime=0)
+    _write_file_atomic(variant, data)
+    return True
+
+
+def precompressed_variant(path, mimetype):
+    """
+    クライアントが受け付ける圧縮形式（br → gzip の順）の事前圧縮ファイルを (path, encoding) で返す。無ければ (None, None)。
+    テキスト系の成果物は、初めて要求されたときに隣に作っておく（元ファイルより古ければ作り直す）。
+    """
+    if not mimetype.startswith(PRECOMPRESS_TYPES) or os.path.getsize(path) < PRECOMPRESS_MIN_BYTES:
+        return None, None
+    for encoding, suffix in (("br", ".br"), ("gzip", ".gz")):
+        if not request.accept_encodings[encoding]:
+            continue
+        variant = path + suffix
+        try:
+            fresh = os.path.getmtime(variant) >= os.path.getmtime(path)
+        except OSError:
+            fresh = False
+        if fresh or _write_precompressed(path, variant, encoding):
+            return variant, encoding
+    return None, None
+
+
+def send_output(full_path, rel_path, as_attachment=False):
+    """
+    成果物ファイルを強い ETag（内容ハッシュ）と Last-Modified 付きで返す。
+    If-None-Match / If-Modified-Since の 304 と Range の 206 は send_file（conditional）が処理する。
+    内容ハッシュで決まるパスは immutable で長期キャッシュさせ、それ以外は毎回 ETag で確認させる。
+    """
+    mimetype = mimetypes.guess_type(full_path)[0] or "application/octet-stream"
+    etag = file_etag(full_path)
+    send_path, encoding = precompressed_variant(full_path, mimetype)
+    if encoding:
+        etag = f"{etag}-{encoding}"  # 表現（圧縮形式）ごとに別の ETag にする
+
+    rv = send_file(send_path or full_path, mimetype=mimetype, as_attachment=as_attachment,
+                   download_name=os.path.basename(full_path), etag=etag, conditional=True,
+                   last_modified=os.path.getmtime(full_path))
+    if encoding:
+        rv.headers["Content-Encoding"] = encoding
+    if mimetype.startswith(PRECOMPRESS_TYPES):
+        rv.vary.add("Accept-Encoding")
+    if is_content_addressed(rel_path):
+        rv.headers["Cache-Control"] = f"public, max-age={IMMUTABLE_MAX_AGE}, immutable"
+    else:
+        rv.headers["Cache-Control"] = "no-cache"
+    return rv
+
+
+def conditional_text(etag, make_text, content_type="text/plain; charset=utf-8"):
+    """
+    その場で作るテキストを ETag で条件付きに返す。If-None-Match が一致すれば make_text を呼ばずに 304。
+    クライアントが受け付ければ gzip で返す（表現ごとに ETag を分ける）。
+    """
+    use_gzip = bool(request.accept_encodings["gzip"])
+    if use_gzip:
+        etag = f"{etag}-gzip"
+    if request.if_none_match.contains(etag):
+        rv = app.response_class(status=304)
+    else:
+        body = make_text().encode("utf-8")
+        rv = app.response_class(gzip.compress(body, compresslevel=6) if use_gzip else body,
+                                content_type=content_type)
+        if use_gzip:
+            rv.headers["Content-Encoding"] = "gzip"
+    rv.set_etag(etag)
+    rv.vary.add("Accept-Encoding")
+    rv.headers["Cache-Control"] = "no-cache"
+    return rv
+
+
+@app.route('/outputs/<path:filepath>')
+def serve_output_file(filepath):
+    try:
+        logger.info(f"serve_output_file: request for {filepath}")
+        safe_path = os.path.normpath(filepath)
+        full_path = os.path.join(OUTPUT_FOLDER, safe_path)
+        full_path = os.path.abspath(full_path)
+        output_folder_abs = os.path.abspath(OUTPUT_FOLDER)
+
+        # 出力フォルダ外へのアクセスを防ぐ
+        if not (full_path.startswith(output_folder_abs + os.path.sep) or full_path == output_folder_abs):
+            return jsonify({"message": "不正なパスです"}), 400
+
+        if not os.path.isfile(full_path):
+            return jsonify({"message": "ファイルが見つかりません。"}), 404
+
+        # LRU 削除用に文書フォルダの最終アクセスを記録
+        rel_path = os.path.relpath(full_path, output_folder_abs)
+        touch_access(rel_path.split(os.path.sep)[0])
+
+        # inline で返す（iframe 表示用）。キャッシュ検証・Range は send_output に任せる
+        logger.info(f"serve_output_file: sending file {full_path}")
+        return send_output(full_path, rel_path)
+
+    except Exception as e:
+        logger.exception("ファイル送信中にエラーが発生しました")
+        return jsonify({"message": "内部エラーが発生しました。ログをご確認ください。"}), 500
+
+
+# NEO / OG / SORTED テキストをレイアウトからその場で作って返す
+def load_doc_layout(doc_id, page_numbers=None):
+    """
+    /text・/fragments 共通。出力フォルダ doc_id のレイアウトを読み、
+    ページ指定があって lazy モードで未抽出のページがあれば、初めて開かれたときに抽出して保存する。
+    見つからない・抽出に失敗したときは {"error", "status"} を返す
+    """
+    doc_dir = os.path.join(OUTPUT_FOLDER, doc_id)
+    layout = read_layout(os.path.join(doc_dir, LAYOUT_FILE), page_numbers)
+    if layout is None:
+        return {"error": "ファイルが見つかりません。", "status": 404}
+    touch_access(doc_id)
+
+    source_path = os.path.join(doc_dir, SOURCE_FILE)
+    if page_numbers and None in layout["pages"] and os.path.isfile(source_path):
+        logger.info("load_doc_layout: extracting page %d of %s on first view",
+                    page_numbers[0] + 1, doc_id)
+        layout = ensure_layout(source_path, doc_dir, doc_id, page_numbers)
+        if layout.get("error"):
+            return {"error": layout["error"], "status": 500}
+    return layout
+
+
+def load_render_settings(doc_dir, render_dir):
+    """描画結果 render_dir の生徒設定（NEO の作り直し用）。無ければ {"error", "status"}"""
+    if not RENDER_DIR_PATTERN.match(render_dir):
+        return {"error": "render を指定してください", "status": 400}
+    manifest = load_result_manifest(doc_dir, render_dir)
+    if manifest is None:
+        return {"error": "ファイルが見つかりません。", "status": 404}
+    # 以前の manifest は未設定の値を None で持っているので落とす
+    return {k: v for k, v in manifest["settings"].items() if v is not None}
+
+
+@app.route("/text/<doc_id>/<kind>")
+def layout_text(doc_id, kind):
+    if kind not in ("neo", "og", "sorted") or not LAYOUT_DOC_ID_PATTERN.match(doc_id):
+        return jsonify({"message": "不正なパスです"}), 400
+
+    page_numbers = None
+    page = request.args.get("page", "").strip()
+    if page:
+        if not page.isdigit() or int(page) < 1:
+            return jsonify({"message": "page は1以上の整数で指定してください"}), 400
+        page_numbers = [int(page) - 1]
+
+    doc_dir = os.path.join(OUTPUT_FOLDER, doc_id)
+    layout = load_doc_layout(doc_id, page_numbers)
+    if layout.get("error"):
+        return jsonify({"message": layout["error"]}), layout["status"]
+
+    # NEO は生徒設定で変わるので、どの描画結果の設定を使うか render= で指定する
+    settings = None
+    if kind == "neo":
+        settings = load_render_settings(doc_dir, request.args.get("render", ""))
+        if settings.get("error"):
+            return jsonify({"message": settings["error"]}), settings["status"]
+
+    # テキストはレイアウト（追記されると mtime が変わる）・種類・ページ・描画設定・読み順で決まる。
+    # 変わっていなければ作り直さずに 304 を返す
+    layout_mtime = os.stat(os.path.join(doc_dir, LAYOUT_FILE)).st_mtime_ns
+    etag = hashlib.sha256(
+        f"{doc_id}:{kind}:{page}:{request.args.get('render', '') if kind == 'neo' else ''}:"
+        f"{READING_ORDER}:{layout_mtime}".encode("utf-8")).hexdigest()[:32]
+    return conditional_text(
+        etag, lambda: render_layout(layout["pages"], settings)[("neo", "og", "sorted").index(kind)])
+
+
+@app.route("/fragments/<doc_id>/<view>")
+def result_fragments(doc_id, view):
+    """
+    結果ページの表示（styled / neo / og / sorted / images）をページ単位で返す。
+    pages= はアップロード時と同じ書式（例: "6-10"）で、最大 FRAGMENT_MAX_PAGES ページ。
+    styled / neo は render= の描画結果の生徒設定で作る。
+    format=html ならページごとの <section> をつなげたHTML、それ以外は {"view", "pages": [{"page", "html"}]}
+    """
+    if view not in FRAGMENT_VIEWS or not LAYOUT_DOC_ID_PATTERN.match(doc_id):
+        return jsonify({"message": "不正なパスです"}), 400
+
+    doc_dir = os.path.join(OUTPUT_FOLDER, doc_id)
+    stored = read_layout(os.path.join(doc_dir, LAYOUT_FILE), [])
+    if stored is None:
+        return jsonify({"message": "ファイルが見つかりません。"}), 404
+    try:
+        page_numbers = parse_page_range(request.args.get("pages", "1"), stored["page_count"])
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 400
+    if len(page_numbers) > FRAGMENT_MAX_PAGES:
+        return jsonify({"message": f"一度に取得できるのは {FRAGMENT_MAX_PAGES} ページまでです"}), 400
+
+    layout = load_doc_layout(doc_id, page_numbers)
+    if layout.get("error"):
+        return jsonify({"message": layout["error"]}), layout["status"]
+
+    render_dir = request.args.get("render", "") if view in ("styled", "neo") else ""
+    settings = None
+    if render_dir:
+        settings = load_render_settings(doc_dir, render_dir)
+        if settings.get("error"):
+            return jsonify({"message": settings["error"]}), settings["status"]
+    elif view in ("styled", "neo"):
+        return jsonify({"message": "render を指定してください"}), 400
+
+    as_html = request.args.get("format") == "html"
+    layout_mtime = os.stat(os.path.join(doc_dir, LAYOUT_FILE)).st_mtime_ns
+    etag = hashlib.sha256(
+        f"{doc_id}:{view}:{page_numbers}:{render_dir}:{as_html}:"
+        f"{READING_ORDER}:{layout_mtime}".encode("utf-8")).hexdigest()[:32]
+
+    def make_fragments():
+        fragments = [{"page": page["number"] + 1, "html": render_fragment(page, view, settings)}
+                     for page in layout["pages"] if page is not None]
+        if as_html:
+            return "".join(fragment_section(f["page"], f["html"]) for f in fragments)
+        return json.dumps({"view": view, "pages": fragments}, ensure_ascii=False)
+
+    return conditional_text(etag, make_fragments,
+                            "text/html; charset=utf-8" if as_html else "application/json")
+
+
+@app.route("/result")
+def result_page():
+    try:
+        # ここで実際のデータを渡してレンダリング
+        pdf_name = request.args.get("pdf_name", "output.pdf")
+        dir_name = request.args.get("dir_name", "output")
+
+        # ダミーデータ（テスト用）
+        fragments = {
+            "styled": fragment_section(1, "<p>スタイル付きNEOテキストの例</p>"),
+            "neo": fragment_section(1, "NEOタグ付きテキストの例"),
+            "og": fragment_section(1, "OGタグ付きテキストの例"),
+            "sorted": fragment_section(1, "時系列ソートの例"),
+            "images": fragment_section(1, "<p>抽出画像の例</p>"),
+        }
+        imgs = []
 
         return render_template(
+            "result.html",
+            pdf_name=pdf_name,
+            dir_name=dir_name,
+            fragments=fragments,
+            fragment_pages=[],
+            fragment_chunk=FRAGMENT_PAGES,
+            imgs=imgs,
+            download_html="""
+                <a href='/outputs/{0}' target='_blank'>PDFを開く</a>
+            """.format(pdf_name)
+        )
+
+    except Exception as e:
+        logger.exception("result_page: エラーが発生しました")
+        return f"エラーが発生しました: {e}", 500
+
+
+def _log_file_chain(log_dir, name):
+    """app.log, app.log.1, app.log.2 ... のうち存在するものを新しい順に返す"""
+    chain = []
+    path = os.path.join(log_dir, name)
+    while os.path.isfile(path):
+        chain.append(path)
+        path = os.path.join(log_dir, f"{name}.{len(chain)}")
+    return chain
+
+
+def iter_lines_reversed(path, end=None):
+    """
+    ファイルを末尾（end バイト目）から LOG_READ_BLOCK ずつ読み、
+    (行の開始オフセット, 行) を新しい順に返す。ファイル全体は読み込まない。
+    """
+    with open(path, "rb") as f:
+        pos = f.seek(0, os.SEEK_END) if end is None else min(end, f.seek(0, os.SEEK_END))
+        tail = b""
+        while pos > 0:
+            size = min(LOG_READ_BLOCK, pos)
+            pos -= size
+            f.seek(pos)
+            block = f.read(size) + tail
+            lines = block.split(b"\n")
+            # 先頭は前のブロックに続く可能性があるので持ち越す
+            tail = lines.pop(0)
+            offset = pos + len(block)
+            for line in reversed(lines):
+                offset -= len(line) + 1
+                yield offset + 1, line.decode("utf-8", errors="ignore")
+        if tail:
+            yield 0, tail.decode("utf-8", errors="ignore")
+
+
+def iter_log_entries(log_dir, name, cursor=None):
+    """
+    ローテーション済みファイルを含めて、ログを新しい順に1件ずつ返す。
+    複数行（トレースバック等）は1件にまとめる。
+    戻り値: (カーソル "ファイルの識別子:オフセット", レベル, テキスト)。
+    cursor を渡すとその位置より古いものから返す。識別子は inode と先頭行の crc32 で、
+    ローテーションで app.log.N の番号が変わっても同じファイルを指す（消えたファイルの inode が
+    使い回されても先頭行で区別する）。そのファイルが無くなっていれば何も返さない。
+    """
+    chain = []  # (パス, 識別子)
+    for path in _log_file_chain(log_dir, name):
+        try:
+            with open(path, "rb") as f:
+                first_line = f.readline(LOG_READ_BLOCK)
+                chain.append((path, f"{os.fstat(f.fileno()).st_ino}.{zlib.crc32(first_line)}"))
+        except OSError:
+            continue
+    start_index, start_end = 0, None
+    if cursor:
+        file_id, end = cursor.split(":")
+        start_end = int(end)
+        start_index = next((i for i, (_, fid) in enumerate(chain) if fid == file_id), None)
+        if start_index is None:
+            return
+
+    for index in range(start_index, len(chain)):
+        path, file_id = chain[index]
+        end = start_end if index == start_index else None
+        continuation = []
+        for offset, line in iter_lines_reversed(path, end):
+            if not line.strip() and not continuation:
+                continue
+            m = LOG_LINE_PATTERN.match(line)
+            if not m:
+                continuation.append(line)
+                continue
+            text = "\n".join([line] + continuation[::-1])
+            continuation = []
+            yield f"{file_id}:{offset}", m.group(1), text
+        if continuation:
+            yield f"{file_id}:0", None, "\n".join(continuation[::-1])
+
+
+class LogPager:
+    """
+    ストリーミング中に、最後に出した件の位置（次ページのカーソル）を覚えておく。
+    limit 件を出した後にもう1件条件に合うものがあるときだけ次ページがある
+    """
+
+    def __init__(self):
+        self.next_cursor = None
+
+    def entries(self, source, min_level, query, limit):
+        count = 0
+        last_cursor = None
+        for cursor, level, text in source:
+            if min_level and LOG_LEVELS.get(level, 0) < min_level:
+                continue
+            if query and query not in text:
+                continue
+            if count >= limit:
+                self.next_cursor = last_cursor
+                return
+            yield {"level": level or "", "text": text}
+            count += 1
+            last_cursor = cursor
+
+
+@app.route("/logs")
+def view_logs():
+    try:
+        log_base_dir = "logs"
+        log_dates = sorted(
+            [d for d in os.listdir(log_base_dir)
+             if os.path.isdir(os.path.join(log_base_dir, d)) and LOG_DATE_PATTERN.match(d)],
+            reverse=True
+        )
+
+        # どのフォルダにもログがない場合
+        if not log_dates:
+            return render_template("logs.html", page_name="logs",
+                                   message="現在ログファイルはありません。")
+
+        # フィルタ（日付・ファイル・レベル・文字列）とページ位置
+        date = request.args.get("date", log_dates[0])
+        if date not in log_dates:
+            date = log_dates[0]
+        name = request.args.get("file", "app.log")
+        if name not in ("app.log", "error.log"):
+            name = "app.log"
+        level = request.args.get("level", "").upper()
+        query = request.args.get("q", "").strip()
+        cursor = request.args.get("before", "")
+        if cursor and not LOG_CURSOR_PATTERN.match(cursor):
+            cursor = ""
+
+        pager = LogPager()
+        entries = pager.entries(
+            iter_log_entries(os.path.join(log_base_dir, date), name, cursor or None),
+            LOG_LEVELS.get(level, 0), query, LOG_PAGE_SIZE)
+
+        # 1件ずつ読みながらHTMLを流す（全件をメモリに載せない）
+        return stream_template(
             "logs.html",
             page_name="logs",
-            message=message,
-            all_logs=all_logs
+            message="",
+            log_dates=log_dates,
+            date=date,
+            file=name,
+            level=level,
+            query=query,
+            levels=list(LOG_LEVELS),
+            entries=entries,
+            pager=pager
         )
 
     except Exception as e:
@@ -502,87 +2077,123 @@ def philosophy():
 @app.route("/download/<filename>")
 def download_file(filename):
     try:
-        file_path = os.path.join(OUTPUT_FOLDER, filename)
+        output_folder_abs = os.path.abspath(OUTPUT_FOLDER)
+        file_path = os.path.abspath(os.path.join(output_folder_abs, os.path.normpath(filename)))
+        # 出力フォルダ外へのアクセスを防ぐ
+        if not file_path.startswith(output_folder_abs + os.path.sep):
+            return "不正なパスです。", 400
         if not os.path.isfile(file_path):
             return "指定されたファイルが存在しません。", 404
 
         logger.info(f"download_file: {filename} を送信します")
-        return send_file(file_path, as_attachment=True)
+        return send_output(file_path, os.path.relpath(file_path, output_folder_abs), as_attachment=True)
 
     except Exception as e:
         logger.exception("download_file: 送信エラー")
         return f"ファイル送信中にエラーが発生しました: {e}", 500
 
 
-def convert_neo_to_html(neo_content: str,
-                        font_size=16,
-                        line_height=1.6,
-                        font_select="IPAexGothic",
-                        app_root=".") -> str:
-    """
-    NEOタグ形式テキストをHTMLへ変換し、フォント・行間・サイズを反映する
-    """
+# NEOタグ（[フォント:..][サイズ:..][ウェイト:..]テキスト / [行間]値 / [画像:パス:x:y:w:h]）
+NEO_STYLE_TAG_RE = re.compile(r"\[(フォント|サイズ|ウェイト):(.*?)\]")
+NEO_IMAGE_RE = re.compile(
+    r"\[画像:(.*?):([\d\.]+):([\d\.]+):([\d\.]+):([\d\.]+)\]")
+NEO_GAP_PREFIX = "[行間]"
+
+# パース結果のノード。font/size/weight は行頭タグが無ければ直前の値（最初は None）
+NeoText = namedtuple("NeoText", "text font size weight")
+NeoGap = namedtuple("NeoGap", "value")
+NeoImage = namedtuple("NeoImage", "path x y width height")
 
-    html_lines = []
-    current_font = font_select
-    current_size = font_size
-    current_weight = "normal"
-    current_line_height = line_height
 
-    # 各行を解析
+def iter_neo_nodes(neo_content):
+    """
+    NEOテキストを1行ずつ読み、NeoText / NeoGap / NeoImage を順に返す。
+    フォント・サイズ・ウェイトは次のタグが来るまで引き継ぐ。
+    """
+    font = size = weight = None
     for line in neo_content.splitlines():
         line = line.strip()
         if not line:
             continue
 
-        # フォント指定
-        if line.startswith("[フォント:"):
-            font_match = re.search(r"\[フォント:(.*?)\]", line)
-            size_match = re.search(r"\[サイズ:(.*?)\]", line)
-            weight_match = re.search(r"\[ウェイト:(.*?)\]", line)
-            text_match = re.search(r"\](.+)", line)
+        # 行間
+        if line.startswith(NEO_GAP_PREFIX):
+            try:
+                yield NeoGap(float(line[len(NEO_GAP_PREFIX):].strip()))
+            except ValueError:
+                pass
+            continue
+
+        # 画像
+        if line.startswith("[画像:"):
+            m = NEO_IMAGE_RE.match(line)
+            if m:
+                yield NeoImage(m.group(1), *(float(v) for v in m.groups()[1:]))
+            continue
 
-            if font_match:
-                current_font = font_match.group(1).strip()
-            if size_match:
+        # 行頭のスタイルタグを読み、残りを本文にする
+        pos = 0
+        while True:
+            m = NEO_STYLE_TAG_RE.match(line, pos)
+            if not m:
+                break
+            name, value = m.group(1), m.group(2).strip()
+            if name == "フォント":
+                font = value
+            elif name == "サイズ":
                 try:
-                    current_size = float(size_match.group(1).strip())
-                except Exception:
+                    size = float(value)
+                except ValueError:
                     pass
-            if weight_match:
-                current_weight = weight_match.group(1).strip()
+            else:
+                weight = value
+            pos = m.end()
 
-            text_content = text_match.group(1).strip() if text_match else ""
-            html_lines.append(
-                f'<p style="font-family:{current_font}; font-size:{current_size}px; font-weight:{current_weight}; line-height:{current_line_height};">'
-                f'{html.escape(text_content)}</p>')
+        text = line[pos:].strip()
+        if text:
+            yield NeoText(text, font, size, weight)
+
+
+def parse_neo(neo_content):
+    """NEOテキストをノードのリストにする（HTMLプレビューとPDF生成で共有する）"""
+    return list(iter_neo_nodes(neo_content))
+
+
+def convert_neo_to_html(neo_content,
+                        font_size=16,
+                        line_height=1.6,
+                        font_select="IPAexGothic",
+                        app_root=".") -> str:
+    """
+    NEOタグ形式テキスト（またはパース済みノードのリスト）をHTMLへ変換し、
+    フォント・行間・サイズを反映する
+    """
+    nodes = parse_neo(neo_content) if isinstance(neo_content, str) else neo_content
 
+    html_lines = []
+    current_line_height = line_height
+
+    for node in nodes:
         # 行間設定
-        elif line.startswith("[行間]"):
-            try:
-                current_line_height = float(line.replace("[行間]", "").strip())
-            except Exception:
-                pass
+        if isinstance(node, NeoGap):
+            current_line_height = node.value
 
         # 画像挿入
-        elif line.startswith("[画像:"):
-            img_match = re.match(
-                r"\[画像:(.*?):([\d\.]+):([\d\.]+):([\d\.]+):([\d\.]+)\]", line)
-            if img_match:
-                img_path = img_match.group(1)
-                img_rel_path = img_path.replace(app_root, "").replace(
-                    "/home/runner/workspace", "").lstrip("/")
-                img_width = img_match.group(4)
-                img_height = img_match.group(5)
-                html_lines.append(
-                    f'<img src="/{img_rel_path}" style="width:{img_width}px; height:{img_height}px; display:block; margin:8px auto;">'
-                )
+        elif isinstance(node, NeoImage):
+            img_rel_path = node.path.replace(app_root, "").replace(
+                "/home/runner/workspace", "").lstrip("/")
+            html_lines.append(
+                f'<img src="/{img_rel_path}" loading="lazy" style="width:{node.width:.2f}px; height:{node.height:.2f}px; display:block; margin:8px auto;">'
+            )
 
-        # 通常テキスト
+        # テキスト
         else:
+            current_font = node.font or font_select
+            current_size = node.size if node.size is not None else font_size
+            current_weight = node.weight or "normal"
             html_lines.append(
                 f'<p style="font-family:{current_font}; font-size:{current_size}px; font-weight:{current_weight}; line-height:{current_line_height};">'
-                f'{html.escape(line)}</p>')
+                f'{html.escape(node.text)}</p>')
 
     # HTML全体
     html_output = f"""
@@ -619,120 +2230,70 @@ def create_pdf_with_weasyprint(neo_content,
                                app_root,
                                firebase_settings=None):
     """
-    neo_content を解析して HTML を作り、必要なフォントをすべて @font-face で定義して
-    WeasyPrint に渡して PDF を生成する（画像は file:// 経由で埋め込み）。
-    """
-    print("=== NEO解析内容 (先頭800文字) ===")
-    print(neo_content[:800])
-
-    try:
-        # 使われているフォント名を収集
-        font_names = set(re.findall(r'\[フォント:(.*?)\]', neo_content))
-        # デフォルトフォントも入れておく
-        if firebase_settings and firebase_settings.get("fontSelect"):
-            font_names.add(firebase_settings.get("fontSelect"))
-        if not font_names:
-            font_names.add("IPAexGothic")
-
-        # 各フォント名をファイルパスに解決して @font-face を作る
-        font_face_rules = []
-        for fname in sorted(font_names):
-            # get_font_path は既に定義されている関数を使う
-            path = get_font_path(app_root, fname)
-            if not path:
-                # フォントが見つからなければ ipaex を fallback として使う
-                path = get_font_path(app_root, "IPAex明朝") or get_font_path(
-                    app_root, "IPAexゴシック")
-            if path:
-                # file:// フルパスで指定
-                font_face_rules.append(
-                    f"@font-face {{ font-family: '{fname}'; src: url('file://{path}'); }}"
-                )
-            else:
-                print(f"⚠️ フォントファイル見つからず: {fname}")
+    neo_content を解析して HTML を作り、フォントレジストリの @font-face を読み込んだ
+    共有スタイルシートと一緒に WeasyPrint に渡して PDF を生成する（画像は file:// 経由で埋め込み）。
+    """
+    if isinstance(neo_content, str):
+        print("=== NEO解析内容 (先頭800文字) ===")
+        print(neo_content[:800])
+
+    try:
+        nodes = parse_neo(neo_content) if isinstance(neo_content, str) else neo_content
+
+        default_font = firebase_settings.get(
+            "fontSelect") if firebase_settings else "IPAexGothic"
+        default_size = firebase_settings.get(
+            "fontSize") if firebase_settings else 16
 
         # HTML ブロックを作る
         html_blocks = []
-        current_font = None
-        current_size = None
-        current_weight = None
         current_lineheight = None
 
-        for raw_line in neo_content.splitlines():
-            line = raw_line.strip()
-            if not line:
-                continue
-
-            # 行間はここでは無視（必要なら current_lineheight を取り込む）
-            if line.startswith("[行間]"):
-                # 任意処理：行間を CSS 単位に変換したい場合はここで current_lineheight に格納
-                try:
-                    current_lineheight = float(
-                        line.replace("[行間]", "").strip())
-                except Exception:
-                    current_lineheight = None
+        for node in nodes:
+            # 行間: neo の行間は px ベースなので line-height に簡易変換する
+            if isinstance(node, NeoGap):
+                current_lineheight = node.value
                 continue
 
             # 画像タグ
-            if line.startswith("[画像:"):
-                parts = re.findall(
-                    r"\[画像:(.*?):([\d\.]+):([\d\.]+):([\d\.]+):([\d\.]+)\]",
-                    line)
-                if parts:
-                    img_path, x, y, w, h = parts[0]
-                    # 画像はローカルファイル経由で埋め込む（WeasyPrint が file:// をサポート）
-                    img_file_url = f"file://{os.path.abspath(img_path)}"
-                    html_blocks.append(
-                        f'<div style="text-align:center; margin: 1em 0;"><img src="{img_file_url}" style="max-width:90%;"></div>'
-                    )
-                continue
-
-            # フォント/サイズ/ウェイトタグを探す
-            font_match = re.search(r"\[フォント:(.*?)\]", line)
-            size_match = re.search(r"\[サイズ:(.*?)\]", line)
-            weight_match = re.search(r"\[ウェイト:(.*?)\]", line)
-
-            text = re.sub(r"\[.*?\]", "", line).strip()
-            if not text:
+            if isinstance(node, NeoImage):
+                # 画像はローカルファイル経由で埋め込む（WeasyPrint が file:// をサポート）
+                img_file_url = f"file://{os.path.abspath(node.path)}"
+                html_blocks.append(
+                    f'<div style="text-align:center; margin: 1em 0;"><img src="{img_file_url}" style="max-width:90%;"></div>'
+                )
                 continue
 
             # 決定したフォント情報を使って p タグを作る
-            used_font = font_match.group(1).strip() if font_match else (
-                firebase_settings.get("fontSelect")
-                if firebase_settings else "IPAexGothic")
-            used_size = size_match.group(1).strip() if size_match else (
-                str(firebase_settings.get("fontSize"))
-                if firebase_settings else "16")
-            used_weight = weight_match.group(
-                1).strip() if weight_match else "normal"
+            used_font = node.font or default_font
+            used_size = node.size if node.size is not None else default_size
+            used_weight = node.weight or "normal"
 
             # line-height の反映（もし current_lineheight があれば）
             lh_css = "line-height:1.6;"
             if current_lineheight:
-                # neo の行間が px ベースだったら相当に大きくなるので簡易変換
-                try:
-                    # 小〜中程度の値に落とす（必要に応じて調整）
-                    lh_val = max(1.0, float(current_lineheight) / 20.0)
-                    lh_css = f"line-height:{lh_val};"
-                except Exception:
-                    pass
+                # 小〜中程度の値に落とす（必要に応じて調整）
+                lh_val = max(1.0, current_lineheight / 20.0)
+                lh_css = f"line-height:{lh_val};"
+
+            # レジストリから実際に埋め込むフォントを選ぶ（収録文字で判定）
+            family = resolve_font_family(used_font, node.text)
+            family_css = f"'{family}', sans-serif" if family else "sans-serif"
 
             # escape
-            esc_text = pyhtml.escape(text)
+            esc_text = pyhtml.escape(node.text)
             html_blocks.append(
-                f"<p style=\"font-family:'{used_font}'; font-size:{used_size}px; font-weight:{used_weight}; {lh_css} margin:0.3em 0;\">{esc_text}</p>"
+                f"<p style=\"font-family:{family_css}; font-size:{used_size}px; font-weight:{used_weight}; {lh_css} margin:0.3em 0;\">{esc_text}</p>"
             )
 
         body_html = "\n".join(html_blocks)
 
-        # 最終 HTML テンプレート（フォント定義を head に埋め込む）
-        css_font_defs = "\n".join(font_face_rules)
+        # 最終 HTML テンプレート（フォント定義は共有スタイルシート側）
         html_template = f"""
         <html lang="ja">
         <head>
             <meta charset="utf-8">
             <style>
-                {css_font_defs}
                 body {{
                     padding: 1cm;
                     word-wrap: break-word;
@@ -749,7 +2310,12 @@ def create_pdf_with_weasyprint(neo_content,
 
         # WeasyPrint に書かせる
         # base_url は app_root にしておく（ファイル参照の解決に使われる）
-        HTML(string=html_template, base_url=app_root).write_pdf(output_path)
+        font_css, font_config = get_font_stylesheet()
+        report_progress("render", renderer="weasyprint", state="started")
+        with timed("weasyprint"):
+            weasyprint.HTML(string=html_template, base_url=app_root).write_pdf(
+                output_path, stylesheets=[font_css], font_config=font_config)
+        report_progress("render", renderer="weasyprint", state="finished")
 
         print(f"✅ PDF生成成功: {output_path}")
         return True, None
@@ -759,221 +2325,1618 @@ def create_pdf_with_weasyprint(neo_content,
         return False, str(e)
 
 
-def process_pdf(pdf_path: str, firebase_settings: dict | None = None):
-    pdf_name = os.path.basename(pdf_path)
+def create_pdf_with_pymupdf(neo_content,
+                            output_path,
+                            app_root,
+                            firebase_settings=None):
+    """
+    create_pdf_with_weasyprint と同じ NEO ノード・生徒設定から、PyMuPDF の Story で直接 PDF を書く。
+    フォントはレジストリのファイルを埋め込み（保存時にサブセット化）、画像は画像ストアから読む。
+    レイアウトエンジンを通さない分速いが、CSS は MuPDF が対応する範囲（フォント・サイズ・行間・余白）だけ使う。
+    """
     try:
-        doc = fitz.open(pdf_path)
-        assert isinstance(doc, fitz.Document)
+        nodes = parse_neo(neo_content) if isinstance(neo_content, str) else neo_content
+
+        default_font = firebase_settings.get(
+            "fontSelect") if firebase_settings else "IPAexGothic"
+        default_size = firebase_settings.get(
+            "fontSize") if firebase_settings else 16
+
+        mediabox = fitz.Rect(0, 0, *PYMUPDF_PAGE_SIZE)
+        where = mediabox + (PYMUPDF_PAGE_MARGIN, PYMUPDF_PAGE_MARGIN,
+                            -PYMUPDF_PAGE_MARGIN, -PYMUPDF_PAGE_MARGIN)
+
+        # フォント・画像は Archive 経由でファイル名だけで参照する
+        archive_dirs = set()
+        font_rules = []
+        for path, info in get_font_registry()[1].items():
+            archive_dirs.add(os.path.dirname(path))
+            for weight in ("normal", "bold"):
+                font_rules.append(
+                    f"@font-face {{ font-family: '{info['family']}'; font-weight: {weight}; "
+                    f"src: url('{os.path.basename(path)}'); }}")
+
+        html_blocks = []
+        current_lineheight = None
+        for node in nodes:
+            if isinstance(node, NeoGap):
+                current_lineheight = node.value
+                continue
+
+            if isinstance(node, NeoImage):
+                if not os.path.isfile(node.path):
+                    continue
+                archive_dirs.add(os.path.dirname(os.path.abspath(node.path)))
+                # WeasyPrint 側の max-width:90% に合わせ、ページからはみ出さないよう縮める
+                scale = min(1.0, where.width * 0.9 / node.width if node.width else 1.0,
+                            where.height / node.height if node.height else 1.0)
+                html_blocks.append(
+                    f'<p style="text-align:center; margin:1em 0;">'
+                    f'<img src="{pyhtml.escape(os.path.basename(node.path))}" '
+                    f'width="{node.width * scale:.1f}" height="{node.height * scale:.1f}"/></p>')
+                continue
+
+            used_font = node.font or default_font
+            used_size = node.size if node.size is not None else default_size
+            used_weight = node.weight or "normal"
+            lh_val = max(1.0, current_lineheight / 20.0) if current_lineheight else 1.6
+            family = resolve_font_family(used_font, node.text)
+            family_css = f"'{family}', sans-serif" if family else "sans-serif"
+            # WeasyPrint と同じ見た目にするため px を pt（0.75倍）に直す
+            html_blocks.append(
+                f"<p style=\"font-family:{family_css}; font-size:{float(used_size) * 0.75:.2f}pt; "
+                f"font-weight:{used_weight}; line-height:{lh_val}; margin:0.3em 0;\">"
+                f"{pyhtml.escape(node.text)}</p>")
+
+        archive = fitz.Archive()
+        for folder in sorted(archive_dirs):
+            archive.add(folder)
+
+        report_progress("render", renderer="pymupdf", state="started")
+        with timed("pymupdf_render"):
+            story = fitz.Story(html="".join(html_blocks), user_css="\n".join(font_rules),
+                               archive=archive)
+            buffer = io.BytesIO()
+            writer = fitz.DocumentWriter(buffer)
+            more = True
+            while more:
+                device = writer.begin_page(mediabox)
+                more, _ = story.place(where)
+                story.draw(device)
+                writer.end_page()
+            writer.close()
+
+            # Story は使ったフォントを丸ごと埋め込むので、使った文字だけに絞ってから保存する
+            with fitz.open("pdf", buffer.getvalue()) as doc:
+                doc.subset_fonts()
+                doc.save(output_path, garbage=3, deflate=True)
+        report_progress("render", renderer="pymupdf", state="finished")
+
+        logger.info("create_pdf_with_pymupdf: wrote %s", output_path)
+        return True, None
+
     except Exception as e:
-        return f"PDFを開けません: {e}"
+        logger.exception("create_pdf_with_pymupdf: failed to render %s", output_path)
+        return False, str(e)
 
-    basename = os.path.splitext(os.path.basename(pdf_path))[0]
-    dir_name = os.path.join(OUTPUT_FOLDER, basename)
-    os.makedirs(dir_name, exist_ok=True)
 
-    # Firebase設定を取得
-    fs_font_override = firebase_settings.get(
-        "fontSelect") if firebase_settings else None
-    fs_size_add = float(firebase_settings.get("fontSize",
-                                              0)) if firebase_settings else 0.0
+def choose_renderer(requested="", page_count=0):
+    """要求（空なら PDF_RENDERER）から実際に使う描画エンジンを決める。auto はページ数で選ぶ"""
+    renderer = (requested or PDF_RENDERER).strip().lower()
+    if renderer in PDF_RENDERERS:
+        return renderer
+    return "pymupdf" if page_count >= PDF_RENDERER_AUTO_PAGES else "weasyprint"
 
-    # 出力ファイルパス
-    output_file_OG = os.path.join(dir_name, f"{basename}_OG.txt")
-    output_file_NEO = os.path.join(dir_name, f"{basename}_NEO.txt")
-    output_file_SORTED = os.path.join(dir_name, f"{basename}_SORTED.txt")
 
-    neo, sorted_txt, imgs, og_tagged = [], [], [], []
+def check_render_parity(expected_path, actual_path):
+    """
+    2つの再構成PDF（WeasyPrint の出力と PyMuPDF の出力など）を比べる。
+    text_match は本文の文字（空白を除く、順不同）の一致率。欠けた文字は豆腐・フォント漏れの目安になる。
+    """
+    def summarize(path):
+        with fitz.open(path) as doc:
+            chars = Counter(c for page in doc for c in page.get_text() if not c.isspace())
+            return {"pages": len(doc), "chars": chars,
+                    "images": sum(len(page.get_images()) for page in doc)}
+
+    expected, actual = summarize(expected_path), summarize(actual_path)
+    total = max(sum(expected["chars"].values()), sum(actual["chars"].values()))
+    common = sum((expected["chars"] & actual["chars"]).values())
+    return {
+        "text_match": round(common / total, 4) if total else 1.0,
+        "missing_chars": "".join(sorted(set(expected["chars"]) - set(actual["chars"])))[:50],
+        "pages": [expected["pages"], actual["pages"]],
+        "images": [expected["images"], actual["images"]],
+    }
+
+
+def build_page_span_index(page):
+    """
+    page.get_text("dict") を1回だけ呼び、テキストブロックごとの span 一覧を作る。
+    戻り値: [{"bbox", "text", "spans": [{"text", "font", "size", "flags", "bbox"}]}]
+    """
+    index = []
+    for blk in page.get_text("dict")["blocks"]:
+        if blk["type"] != 0:
+            continue
+        spans = []
+        for ln in blk["lines"]:
+            for span in ln["spans"]:
+                spans.append({
+                    "text": span["text"],
+                    "font": span.get("font", "Unknown"),
+                    "size": span.get("size", 12.0),
+                    "flags": span.get("flags", 0),
+                    "bbox": span.get("bbox")
+                })
+        index.append({
+            "bbox": blk["bbox"],
+            "text": "".join(sp["text"] for sp in spans).strip(),
+            "spans": spans
+        })
+    return index
 
-    # ページごとの抽出
-    for i, page in enumerate(doc):
-        sorted_txt.append(f"\n--- Page {i+1} ---\n")
-        elements = []
-
-        # テキスト抽出
-        for blk in page.get_text("dict")["blocks"]:
-            if blk["type"] == 0:
-                text = "".join(span["text"] for ln in blk["lines"]
-                               for span in ln["spans"]).strip()
-                if text:
-                    elements.append({
-                        "type": "text",
-                        "bbox": blk["bbox"],
-                        "content": text
-                    })
-
-        # 画像抽出
-        for j, img in enumerate(page.get_images(full=True)):
+
+def lookup_og_font(spans):
+    """ブロック内で最初に中身のある span から元PDFのフォント・サイズ・ウェイトを返す"""
+    for span in spans:
+        if span["text"].strip():
+            og_font = span["font"] or "Unknown"
+            og_weight = "bold" if "Bold" in og_font else "normal"
+            return og_font, span["size"], og_weight
+    return "Unknown", 12.0, "normal"
+
+
+def _write_file_atomic(path, data):
+    """別プロセスと同時に書いても壊れないよう一時ファイル経由で置く"""
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def _encode_image(doc, xref, smask=0):
+    """
+    画像を書き出せる形 (拡張子, バイト列) にする。
+    IMAGE_PASSTHROUGH が有効で、ブラウザと WeasyPrint がそのまま読める形式（JPEG/PNG, Gray/RGB, アルファなし）
+    なら埋め込みストリームをそのまま使い、それ以外（CMYK・SMask・特殊フィルタ）は Pixmap でデコードして PNG にする。
+    """
+    if IMAGE_PASSTHROUGH and not smask:
+        info = doc.extract_image(xref)
+        if (info and info.get("ext") in PASSTHROUGH_IMAGE_EXTS
+                and info.get("colorspace") in (1, 3) and not info.get("smask")):
+            return info["ext"], info["image"]
+
+    pix = fitz.Pixmap(doc, xref)
+    if pix.colorspace and pix.colorspace.n >= 4:
+        pix = fitz.Pixmap(fitz.csRGB, pix)
+    if smask and not pix.alpha:
+        try:
+            pix = fitz.Pixmap(pix, fitz.Pixmap(doc, smask))
+        except Exception as e:
+            # サイズ違いなどでマスクを合成できなければ不透明のまま出す
+            logger.info("_encode_image: smask %s not applied to xref %s: %s",
+                        smask, xref, e)
+    return "png", pix.tobytes("png")
+
+
+def _resolve_pdf_refs(doc, text, digest, depth=0):
+    """
+    PDFオブジェクトの文字列中の「N 0 R」を参照先の中身（ストリームなら生バイトも）に置き換えて digest に入れる。
+    オブジェクト番号は文書ごとに違うので、番号ではなく中身で同じかどうかを決める
+    """
+    pos = 0
+    for m in PDF_REF_PATTERN.finditer(text):
+        digest.update(text[pos:m.start()].encode("utf-8", "surrogatepass"))
+        pos = m.end()
+        ref = int(m.group(1))
+        if depth >= IMAGE_DIGEST_REF_DEPTH or not 0 < ref < doc.xref_length():
+            digest.update(m.group(0).encode())
+            continue
+        digest.update(b"<<ref:")
+        _resolve_pdf_refs(doc, doc.xref_object(ref, compressed=True), digest, depth + 1)
+        if doc.xref_is_stream(ref):
+            digest.update(b"stream:")
+            digest.update(doc.xref_stream_raw(ref) or b"")
+        digest.update(b">>")
+    digest.update(text[pos:].encode("utf-8", "surrogatepass"))
+
+
+def _update_image_digest(doc, xref, digest):
+    """画像の生ストリームに、そのデコードに効く辞書の値（幅・高さ・色空間・Decode・フィルタなど）を添えて入れる"""
+    for key in IMAGE_DIGEST_KEYS:
+        kind, value = doc.xref_get_key(xref, key)
+        if kind == "null":
+            continue
+        digest.update(f"/{key} ".encode())
+        _resolve_pdf_refs(doc, value, digest)
+        digest.update(b"\n")
+    digest.update(b"stream:")
+    digest.update(doc.xref_stream_raw(xref) or b"")
+
+
+def store_page_image(doc, xref, smask=0):
+    """
+    画像を内容ハッシュで IMAGE_STORE に1回だけ保存し、(絶対パス, /outputs 用相対パス) を返す。
+    ハッシュは埋め込みストリームの生バイトと画像辞書（IMAGE_DIGEST_KEYS）で取るので、
+    既に保存済みならデコードもしない。生バイトが同じでも幅・高さ・色空間などが違えば別の画像になる。
+    """
+    digest = hashlib.sha256()
+    _update_image_digest(doc, xref, digest)
+    if smask:
+        digest.update(b"smask:")
+        _update_image_digest(doc, smask, digest)
+    digest = digest.hexdigest()
+
+    store_dir = os.path.join(OUTPUT_FOLDER, IMAGE_STORE_DIR, digest[:2])
+    for ext in PASSTHROUGH_IMAGE_EXTS:
+        full = os.path.join(store_dir, f"{digest}.{ext}")
+        if os.path.isfile(full):
+            inc_metric("pdfremaker_images_total", result="reused")
+            break
+    else:
+        ext, data = _encode_image(doc, xref, smask)
+        os.makedirs(store_dir, exist_ok=True)
+        full = os.path.join(store_dir, f"{digest}.{ext}")
+        _write_file_atomic(full, data)
+        inc_metric("pdfremaker_images_total", result="stored")
+
+    rel = "/".join([IMAGE_STORE_DIR, digest[:2], os.path.basename(full)])
+    return full, rel
+
+
+def extract_page(doc, i, page, image_cache=None):
+    """
+    1ページ分のテキスト・画像を抽出し、生徒設定に依存しないレイアウトを返す。
+    戻り値: {"elements": [...座標順...], "imgs": [...]}
+      text 要素: {"type": "text", "bbox", "text", "font", "size", "weight"}（元PDFの値）
+      image 要素: {"type": "image", "bbox", "path", "url"}
+    prev_y に相当する行間は描画時に bbox から求めるので、ページ単位で独立に処理できる。
+    image_cache（xref -> (full, rel)）を渡すと、同じ文書内で使い回される画像は1回だけ処理する。
+    """
+    if image_cache is None:
+        image_cache = {}
+    elements, imgs = [], []
+
+    # テキスト抽出（ページ解析は1回だけ）
+    with timed("text_extraction"):
+        span_index = build_page_span_index(page)
+        for blk in span_index:
+            if blk["text"]:
+                og_font, og_size, og_weight = lookup_og_font(blk["spans"])
+                elements.append({
+                    "type": "text",
+                    "bbox": list(blk["bbox"]),
+                    "text": blk["text"],
+                    "font": og_font,
+                    "size": og_size,
+                    "weight": og_weight
+                })
+
+    # 画像抽出（xref ごと・内容ごとに重複排除）
+    with timed("image_extraction"):
+        for img in page.get_images(full=True):
             try:
-                xref = img[0]
-                pix = fitz.Pixmap(doc, xref)
-                if pix.n >= 5:
-                    pix = fitz.Pixmap(fitz.csRGB, pix)
-                name = f"image_p{i+1}_{j}.png"
-                full = os.path.join(dir_name, name)
-                pix.save(full)
-                rel = os.path.join(basename, name).replace("\\", "/")
+                xref, smask = img[0], img[1]
+                if xref not in image_cache:
+                    image_cache[xref] = store_page_image(doc, xref, smask)
+                full, rel = image_cache[xref]
                 imgs.append(rel)
                 bbox = page.get_image_info(xref)[0]["bbox"]
                 elements.append({
                     "type": "image",
-                    "bbox": bbox,
-                    "content": full
+                    "bbox": list(bbox),
+                    "path": full,
+                    "url": rel
                 })
             except Exception as e:
+                inc_metric("pdfremaker_errors_total", stage="image_extraction")
                 print("画像抽出失敗:", e)
 
-        # 座標順ソート
-        elements.sort(key=lambda x: (x["bbox"][1], x["bbox"][0]))
-
-        prev_y = None
-        for el in elements:
-            y = el["bbox"][1]
-
-            # 行間処理
-            if prev_y is not None:
-                gap = y - prev_y
-                if gap > 0:
-                    line_gap = gap
-                    # Firestoreの倍率反映（NEO用）
-                    if firebase_settings and firebase_settings.get(
-                            "lineHeight"):
-                        try:
-                            multiplier = float(firebase_settings["lineHeight"])
-                            line_gap = gap * multiplier
-                        except Exception:
-                            pass
-                    # それぞれに反映
-                    neo.append(f"[行間]{line_gap:.2f}\n")  # 生徒設定適用後
-                    og_tagged.append(f"[行間]{gap:.2f}\n")  # 元PDF値
+    inc_metric("pdfremaker_pages_extracted_total")
 
-            # テキスト要素
-            if el["type"] == "text":
-                text = el["content"]
+    # 座標順ソート
+    elements.sort(key=lambda x: (x["bbox"][1], x["bbox"][0]))
 
-                # 元PDFフォント情報を取得 (OG用)
-                try:
-                    found_span = None
-                    for blk in page.get_text("dict")["blocks"]:
-                        if blk["type"] == 0:
-                            for line in blk["lines"]:
-                                for span in line["spans"]:
-                                    if span["text"].strip(
-                                    ) and span["text"].strip() in text:
-                                        found_span = span
-                                        break
-                                if found_span:
-                                    break
-                        if found_span:
-                            break
-
-                    if found_span:
-                        og_font = found_span.get("font", "Unknown")
-                        og_size = found_span.get("size", 12.0)
-                        og_weight = "bold" if "Bold" in og_font else "normal"
-                    else:
-                        og_font, og_size, og_weight = "Unknown", 12.0, "normal"
+    return {"elements": elements, "imgs": imgs}
+
+
+def open_pdf(pdf_source):
+    """パス（str）でもメモリ上のバイト列でも PDF を開く"""
+    if isinstance(pdf_source, (bytes, bytearray)):
+        return fitz.open(stream=pdf_source, filetype="pdf")
+    return fitz.open(pdf_source)
+
+
+def _extract_page_range(pdf_source, page_numbers):
+    """プロセスプール用: ワーカー側でドキュメントを開き直して page_numbers のページを抽出する"""
+    doc = open_pdf(pdf_source)
+    image_cache = {}
+    try:
+        return [
+            extract_page(doc, i, doc[i], image_cache)
+            for i in page_numbers
+        ]
+    finally:
+        doc.close()
+        # ワーカープロセスの計測値を /metrics に反映させる
+        flush_metrics(force=True)
 
-                except Exception:
-                    og_font, og_size, og_weight = "Unknown", 12.0, "normal"
+
+def _init_page_worker(output_folder, metrics_folder):
+    """プロセスプールのワーカー起動時: 出力先を親にそろえる（親で差し替えられていても同じ場所に書く）"""
+    global OUTPUT_FOLDER, METRICS_FOLDER
+    OUTPUT_FOLDER, METRICS_FOLDER = output_folder, metrics_folder
+
+
+def _get_page_pool():
+    """
+    ページ抽出・一括描画用のプロセスプール。スレッドの動いているプロセスから fork すると
+    ロックや reporter などの状態を引き継ぐので、forkserver（無ければ spawn）でワーカーを作る。
+    """
+    global page_pool
+    with page_pool_lock:
+        if page_pool is None:
+            method = ("forkserver" if "forkserver" in multiprocessing.get_all_start_methods()
+                      else "spawn")
+            page_pool = ProcessPoolExecutor(max_workers=PARALLEL_WORKERS,
+                                            mp_context=multiprocessing.get_context(method),
+                                            initializer=_init_page_worker,
+                                            initargs=(OUTPUT_FOLDER, METRICS_FOLDER))
+            logger.info("page_pool: started %d worker processes (%s)", PARALLEL_WORKERS, method)
+        return page_pool
+
+
+def extract_pages(doc, pdf_source, page_numbers=None):
+    """
+    page_numbers（0始まり、省略時は全ページ）を抽出して、その順のレイアウトのリストを返す。
+    ページ数が PARALLEL_PAGE_THRESHOLD 以上ならページ範囲に分割してプロセスプールで並列処理する。
+    ワーカーにはPDFのパスだけを渡す（メモリ上のPDFは一時ファイルに書いてから渡し、終われば消す）。
+    """
+    global page_pool
+    if page_numbers is None:
+        page_numbers = list(range(len(doc)))
+    page_count = len(page_numbers)
+    if PARALLEL_WORKERS > 1 and page_count >= PARALLEL_PAGE_THRESHOLD:
+        # ワーカー数の数倍に分割して、重いページの偏りをならす
+        chunk = max(1, -(-page_count // (PARALLEL_WORKERS * 4)))
+        logger.info("extract_pages: parallel mode (%d pages, %d per shard, %d workers)",
+                    page_count, chunk, PARALLEL_WORKERS)
+        spill_path = None
+        try:
+            # シャードごとにPDF全体を pickle して送らないよう、パスで渡す
+            if isinstance(pdf_source, (bytes, bytearray)):
+                fd, spill_path = tempfile.mkstemp(suffix=".pdf", dir=UPLOAD_FOLDER)
+                with os.fdopen(fd, "wb") as f:
+                    f.write(pdf_source)
+            pool = _get_page_pool()
+            futures = [
+                pool.submit(_extract_page_range, spill_path or pdf_source,
+                            page_numbers[start:start + chunk])
+                for start in range(0, page_count, chunk)
+            ]
+            results = []
+            images = 0
+            for future in futures:
+                shard = future.result()
+                results.extend(shard)
+                images += sum(1 for page in shard for el in page["elements"]
+                              if el["type"] == "image")
+                report_progress("extract", pages_done=len(results), pages_total=page_count,
+                                page_count=len(doc), images=images)
+            return results
+        except BrokenProcessPool:
+            logger.exception("extract_pages: process pool broken; falling back to serial mode")
+            with page_pool_lock:
+                page_pool = None
+        finally:
+            if spill_path:
+                discard_upload({"path": spill_path})
+
+    image_cache = {}
+    results = []
+    images = 0
+    for i in page_numbers:
+        results.append(extract_page(doc, i, doc[i], image_cache))
+        images += sum(1 for el in results[-1]["elements"] if el["type"] == "image")
+        report_progress("extract", pages_done=len(results), pages_total=page_count,
+                        page_count=len(doc), images=images)
+    return results
+
+
+def detect_columns(boxes):
+    """
+    boxes（n×4 の ndarray: x0, y0, x1, y1）から列の境界の x 座標（昇順）を返す。段組みでなければ空。
+    要素の x 区間を左端でソートして和集合をとり（O(n log n)）、COLUMN_MIN_GUTTER 以上の空きを列間の候補にする。
+    本文幅の過半を占める要素（段をまたぐ見出しなど）は空きを埋めてしまうので候補探しから外す。
+    """
+    left, right = boxes[:, 0].min(), boxes[:, 2].max()
+    content_width = right - left
+    narrow = boxes[(boxes[:, 2] - boxes[:, 0]) <= content_width * 0.5]
+    if len(narrow) < 2:
+        return np.empty(0)
+
+    order = np.argsort(narrow[:, 0], kind="stable")
+    starts = narrow[order, 0]
+    reach = np.maximum.accumulate(narrow[order, 2])  # ここまでの要素の右端の最大
+    is_gutter = starts[1:] - reach[:-1] >= COLUMN_MIN_GUTTER
+    candidates = (starts[1:][is_gutter] + reach[:-1][is_gutter]) / 2
+
+    # 細すぎる列（設問番号の並びなど）ができる境界は捨てる。候補は列の数しかないので素直にループする
+    min_width = content_width * COLUMN_MIN_WIDTH_RATIO
+    bounds, prev = [], left
+    for x in candidates.tolist():
+        if x - prev >= min_width:
+            bounds.append(x)
+            prev = x
+    if bounds and right - bounds[-1] < min_width:
+        bounds.pop()
+    return np.array(bounds)
+
+
+def reading_order(elements, mode=None):
+    """
+    要素（bbox を持つ dict）のリストを読み順に並べた新しいリストを返す。
+    columns: 段組みを検出し、段をまたぐ要素で区切った帯ごとに「列 → 行 → 左から」の順に読む。
+             上下に重なる要素は同じ行として x 順にする（ルビ・表のセルなど）。
+    legacy: 従来どおり (y0, x0) 順。
+    """
+    mode = mode or READING_ORDER
+    if mode == "legacy" or len(elements) < 2:
+        return sorted(elements, key=lambda x: (x["bbox"][1], x["bbox"][0]))
+
+    boxes = np.array([el["bbox"] for el in elements], dtype=float)
+    x0, y0, x1, y1 = boxes.T
+
+    # 列: 左端・右端が同じ列に入らない要素は段をまたぐ（列 -1 として帯の先頭に置く）
+    bounds = detect_columns(boxes)
+    first_col = np.searchsorted(bounds, x0 + COLUMN_SPAN_TOLERANCE)
+    last_col = np.searchsorted(bounds, x1 - COLUMN_SPAN_TOLERANCE)
+    spanning = first_col != last_col
+    column = np.where(spanning, -1, first_col)
+
+    # 帯: 段をまたぐ要素の上端で縦に区切る（その要素自身は区切った直後の帯に入る）
+    band = np.searchsorted(np.sort(y0[spanning]), y0, side="right")
+
+    # 行: 帯・列ごとに上から並べ、直前の要素の中央より下から始まる要素で改行する
+    order = np.lexsort((x0, y0, column, band))
+    top, bottom = y0[order], y1[order]
+    new_line = np.ones(len(order), dtype=bool)
+    new_line[1:] = ((band[order][1:] != band[order][:-1])
+                    | (column[order][1:] != column[order][:-1])
+                    | (top[1:] >= (top[:-1] + bottom[:-1]) / 2))
+    line = np.cumsum(new_line)
+    order = order[np.lexsort((x0[order], line))]
+    return [elements[i] for i in order.tolist()]
+
+
+def compute_line_gaps(elements):
+    """読み順に並んだ要素の、直前の要素の下端から上端までの空き（先頭は nan）"""
+    if not elements:
+        return []
+    boxes = np.array([el["bbox"] for el in elements], dtype=float)
+    gaps = np.full(len(elements), np.nan)
+    gaps[1:] = boxes[1:, 1] - boxes[:-1, 3]
+    return gaps.tolist()
+
+
+def render_layout(pages, firebase_settings=None):
+    """
+    抽出済みレイアウトに生徒設定を適用して (neo, og_tagged, sorted) の各テキストを返す。
+    PyMuPDF には触らないので、設定変更時はここからやり直すだけで済む。
+    未抽出のページ（None）は飛ばす。ページ番号は各ページの "number"（0始まり）を使う。
+    """
+    # Firebase設定を取得
+    fs_font_override = firebase_settings.get(
+        "fontSelect") if firebase_settings else None
+    # 生徒IDなしの描画結果の設定は値が無い（None）ので、未設定と同じに扱う
+    fs_size_add = float(firebase_settings.get("fontSize")
+                        or 0) if firebase_settings else 0.0
+    multiplier = None
+    if firebase_settings and firebase_settings.get("lineHeight"):
+        try:
+            multiplier = float(firebase_settings["lineHeight"])
+        except Exception:
+            pass
+
+    neo, sorted_txt, og_tagged = [], [], []
+
+    for i, page in enumerate(pages):
+        if page is None:
+            continue
+        i = page.get("number", i)
+        sorted_txt.append(f"\n--- Page {i+1} ---\n")
+
+        # 読み順に並べ、行間（直前の要素の下端からの空き）はページ単位でまとめて求める
+        elements = reading_order(page["elements"])
+        for el, gap in zip(elements, compute_line_gaps(elements)):
+            # 行間処理（先頭は nan なので比較が偽になる）
+            if gap > 0:
+                # Firestoreの倍率反映（NEO用）
+                line_gap = gap * multiplier if multiplier is not None else gap
+                # それぞれに反映
+                neo.append(f"[行間]{line_gap:.2f}\n")  # 生徒設定適用後
+                og_tagged.append(f"[行間]{gap:.2f}\n")  # 元PDF値
+
+            # テキスト要素
+            if el["type"] == "text":
+                text = el["text"]
 
                 # Firestore設定反映後のフォント (NEO用)
                 font = fs_font_override or "IPAexGothic, sans-serif"
-                size = og_size + fs_size_add  # 元サイズに加算
+                size = el["size"] + fs_size_add  # 元サイズに加算
 
                 # 出力
                 neo.append(
                     f"[フォント:{font}][サイズ:{size:.2f}][ウェイト:normal]{text}\n")
                 og_tagged.append(
-                    f"[フォント:{og_font}][サイズ:{og_size:.2f}][ウェイト:{og_weight}]{text}\n"
+                    f"[フォント:{el['font']}][サイズ:{el['size']:.2f}][ウェイト:{el['weight']}]{text}\n"
                 )
                 sorted_txt.append(f"テキスト: {text}\n")
 
-                prev_y = el["bbox"][3]
-
             # 画像要素
             elif el["type"] == "image":
                 bbox = el["bbox"]
-                img_tag = f"[画像:{el['content']}:{bbox[0]:.2f}:{bbox[1]:.2f}:{bbox[2]-bbox[0]:.2f}:{bbox[3]-bbox[1]:.2f}]\n"
+                img_tag = f"[画像:{el['path']}:{bbox[0]:.2f}:{bbox[1]:.2f}:{bbox[2]-bbox[0]:.2f}:{bbox[3]-bbox[1]:.2f}]\n"
                 neo.append(img_tag)
                 og_tagged.append(img_tag)
-                sorted_txt.append(f"[画像] {el['content']} | BBOX: {bbox}\n\n")
-                prev_y = bbox[3]
-
-    # 出力内容を結合
-    neo_content = "".join(neo)
-    og_tagged_content = "".join(og_tagged)
-    sorted_content = "".join(sorted_txt)
-
-    # ファイル保存
-    with open(output_file_NEO, "w", encoding="utf-8") as f:
-        f.write(neo_content)
-    with open(output_file_SORTED, "w", encoding="utf-8") as f:
-        f.write(sorted_content)
-    with open(output_file_OG, "w", encoding="utf-8") as f:
-        f.write(og_tagged_content)
+                sorted_txt.append(f"[画像] {el['path']} | BBOX: {tuple(bbox)}\n\n")
+
+    return "".join(neo), "".join(og_tagged), "".join(sorted_txt)
+
+
+def compute_pdf_digest(pdf_source):
+    """アップロードされたPDFのバイト列のハッシュ（ファイル名は関係しない）"""
+    if isinstance(pdf_source, (bytes, bytearray)):
+        return hashlib.sha256(pdf_source).hexdigest()
+    digest = hashlib.sha256()
+    with open(pdf_source, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def compute_settings_digest(firebase_settings=None, page_numbers=None, renderer="weasyprint"):
+    """結果に効く生徒設定（と一部ページだけ描画する場合はそのページ、描画エンジン）を取り出したハッシュ"""
+    settings = firebase_settings or {}
+    effective = {k: settings.get(k) for k in CACHE_SETTING_KEYS}
+    if page_numbers is not None:
+        effective["pages"] = list(page_numbers)
+    # 既存の WeasyPrint の描画結果はそのまま使えるよう、それ以外のときだけキーに入れる
+    if renderer != "weasyprint":
+        effective["renderer"] = renderer
+    # 読み順が変わると NEO も変わる（legacy 以外で描いた結果は別物として扱う）
+    if READING_ORDER != "legacy":
+        effective["order"] = READING_ORDER
+    return hashlib.sha256(
+        json.dumps(effective, sort_keys=True, ensure_ascii=False,
+                   default=str).encode("utf-8")).hexdigest()
+
+
+def _write_json_atomic(path, data):
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def _read_json(path):
+    """JSONファイルを読む。無い・壊れていれば None"""
+    if not os.path.isfile(path):
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception:
+        logger.exception("_read_json: failed to read %s", path)
+        return None
+
+
+# レイアウトのバイナリ形式（layout.bin, little endian）
+#   ヘッダ:   magic "PRLY", version u16, 予約 u16, ページ数 u32, 文字列表の位置 u64
+#   ページ表: (ページ数 + 1) 個の u64。i ページ目のレコードの位置（0 は未抽出のページ）。最後は終端
+#   ページ:   要素数 u32 と要素の並び
+#     text:  kind=0 u8, bbox 4×f32, フォント番号 u32, サイズ f32, 太字 u8, 本文長 u32, 本文 utf-8
+#     image: kind=1 u8, bbox 4×f32, 画像URL番号 u32
+#   文字列表: 件数 u32 と (長さ u32, utf-8) の並び。フォント名と画像URLを1回だけ持つ
+LAYOUT_MAGIC = b"PRLY"
+LAYOUT_VERSION = 1
+_LAYOUT_HEADER = struct.Struct("<4sHHIQ")
+_LAYOUT_ELEMENT = struct.Struct("<B4f")
+_LAYOUT_TEXT = struct.Struct("<IfBI")
+_U32 = struct.Struct("<I")
+_U64 = struct.Struct("<Q")
+
+
+def write_layout(path, pages):
+    """抽出済みページをバイナリ形式でアトミックに書き出す（未抽出のページは None）"""
+    strings, string_ids = [], {}
+
+    def intern(value):
+        if value not in string_ids:
+            string_ids[value] = len(strings)
+            strings.append(value)
+        return string_ids[value]
+
+    body = bytearray()
+    offsets = []
+    base = _LAYOUT_HEADER.size + _U64.size * (len(pages) + 1)
+    for page in pages:
+        if page is None:
+            offsets.append(0)
+            continue
+        offsets.append(base + len(body))
+        body += _U32.pack(len(page["elements"]))
+        for el in page["elements"]:
+            if el["type"] == "text":
+                data = el["text"].encode("utf-8")
+                body += _LAYOUT_ELEMENT.pack(0, *el["bbox"])
+                body += _LAYOUT_TEXT.pack(intern(el["font"]), el["size"],
+                                          el["weight"] == "bold", len(data))
+                body += data
+            else:
+                body += _LAYOUT_ELEMENT.pack(1, *el["bbox"])
+                body += _U32.pack(intern(el["url"]))
+    offsets.append(base + len(body))
+
+    table = bytearray(_U32.pack(len(strings)))
+    for value in strings:
+        data = value.encode("utf-8")
+        table += _U32.pack(len(data)) + data
+
+    header = _LAYOUT_HEADER.pack(LAYOUT_MAGIC, LAYOUT_VERSION, 0, len(pages),
+                                 offsets[-1])
+    _write_file_atomic(path, header + b"".join(_U64.pack(o) for o in offsets)
+                       + bytes(body) + bytes(table))
+
+
+def _read_layout_strings(buf, offset):
+    (count,) = _U32.unpack_from(buf, offset)
+    offset += _U32.size
+    strings = []
+    for _ in range(count):
+        (length,) = _U32.unpack_from(buf, offset)
+        offset += _U32.size
+        strings.append(bytes(buf[offset:offset + length]).decode("utf-8"))
+        offset += length
+    return strings
+
+
+def _read_layout_page(buf, offset, strings, number):
+    (count,) = _U32.unpack_from(buf, offset)
+    offset += _U32.size
+    elements = []
+    for _ in range(count):
+        kind, *bbox = _LAYOUT_ELEMENT.unpack_from(buf, offset)
+        offset += _LAYOUT_ELEMENT.size
+        if kind == 0:
+            font_id, size, bold, length = _LAYOUT_TEXT.unpack_from(buf, offset)
+            offset += _LAYOUT_TEXT.size
+            elements.append({
+                "type": "text",
+                "bbox": bbox,
+                "text": bytes(buf[offset:offset + length]).decode("utf-8"),
+                "font": strings[font_id],
+                "size": size,
+                "weight": "bold" if bold else "normal"
+            })
+            offset += length
+        else:
+            (url_id,) = _U32.unpack_from(buf, offset)
+            offset += _U32.size
+            url = strings[url_id]
+            elements.append({
+                "type": "image",
+                "bbox": bbox,
+                "path": os.path.join(OUTPUT_FOLDER, *url.split("/")),
+                "url": url
+            })
+    return {"number": number, "elements": elements}
+
+
+def read_layout(path, page_numbers=None):
+    """
+    layout.bin を mmap で開き、{"pages", "page_count"} を返す（無い・壊れていれば None）。
+    page_numbers（0始まり）を渡すと、ページ表を使ってそのページだけ読む。
+    pages は page_numbers と同じ並びで、未抽出のページは None になる。
+    """
+    if not os.path.isfile(path):
+        return None
+    try:
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            magic, version, _, page_count, strings_offset = _LAYOUT_HEADER.unpack_from(buf, 0)
+            if magic != LAYOUT_MAGIC or version != LAYOUT_VERSION:
+                logger.warning("read_layout: unsupported layout file %s", path)
+                return None
+            strings = _read_layout_strings(buf, strings_offset)
+            if page_numbers is None:
+                page_numbers = range(page_count)
+            pages = []
+            for i in page_numbers:
+                if not 0 <= i < page_count:
+                    continue
+                (offset,) = _U64.unpack_from(buf, _LAYOUT_HEADER.size + _U64.size * i)
+                pages.append(_read_layout_page(buf, offset, strings, i) if offset else None)
+            return {"pages": pages, "page_count": page_count}
+    except Exception:
+        logger.exception("read_layout: failed to read %s", path)
+        return None
+
+
+def layout_images(pages):
+    """ギャラリー用: レイアウトに出てくる画像URLを重複なしで出現順に返す"""
+    imgs = []
+    for page in pages:
+        for el in (page["elements"] if page else []):
+            if el["type"] == "image" and el["url"] not in imgs:
+                imgs.append(el["url"])
+    return imgs
+
+
+def layout_image_urls(path):
+    """layout.bin の文字列表だけを読み、参照している画像ストアのURLを返す"""
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        magic, version, _, _, strings_offset = _LAYOUT_HEADER.unpack_from(buf, 0)
+        if magic != LAYOUT_MAGIC or version != LAYOUT_VERSION:
+            raise ValueError(f"unsupported layout file {path}")
+        prefix = IMAGE_STORE_DIR + "/"
+        return {v for v in _read_layout_strings(buf, strings_offset)
+                if v.startswith(prefix)}
+
+
+def touch_access(rel_dir):
+    """
+    出力フォルダが使われたことを記録する（LRU 削除の判断に使う）。
+    ディスクへの書き込みは ACCESS_TOUCH_INTERVAL 秒に1回まで。
+    """
+    if not rel_dir or rel_dir in (IMAGE_STORE_DIR, RETENTION_LOCK_FILE):
+        return
+    now = time.time()
+    with access_lock:
+        if now - access_touched.get(rel_dir, 0) < ACCESS_TOUCH_INTERVAL:
+            return
+        access_touched[rel_dir] = now
+    marker = os.path.join(OUTPUT_FOLDER, rel_dir, ACCESS_MARKER)
+    try:
+        if os.path.isdir(os.path.dirname(marker)):
+            with open(marker, "a"):
+                os.utime(marker, None)
+    except OSError:
+        logger.exception("touch_access: failed to touch %s", marker)
+
+
+def _dir_usage(path):
+    """フォルダ以下の合計バイト数と最終更新時刻"""
+    total, latest = 0, os.path.getmtime(path)
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                st = os.stat(os.path.join(root, name))
+            except OSError:
+                continue
+            total += st.st_size
+            latest = max(latest, st.st_mtime)
+    return total, latest
+
+
+def _last_access(path, fallback):
+    try:
+        return os.path.getmtime(os.path.join(path, ACCESS_MARKER))
+    except OSError:
+        return fallback
+
+
+def _remove_entry(path):
+    try:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+        return True
+    except OSError:
+        logger.exception("🧹 retention: failed to remove %s", path)
+        return False
+
+
+def enforce_retention():
+    """
+    OUTPUT_FOLDER の文書フォルダと UPLOAD_FOLDER のファイルを、
+    RETENTION_MAX_AGE を過ぎたもの → 容量が RETENTION_QUOTA_BYTES を超える分を使われた順が古いもの
+    の順に削除し、どの文書からも参照されなくなった画像ストアのファイルを消す。
+    直近 RETENTION_GRACE 秒に使われたもの・処理中のアップロードは消さない。
+    画像ストアは文書ごとの参照を数え、文書を消したときはその文書だけが参照していた画像の分を減らす
+    （参照の無い画像は後で消えるので容量に数えない）。
+    """
+    now = time.time()
+    with jobs_lock:
+        active_uploads = {j.get("pdf_path") for j in jobs.values()
+                          if j["status"] in ("queued", "running")}
+
+    # (最終アクセス, サイズ, パス)
+    entries = []
+    doc_images = {}  # 文書フォルダ -> 参照している画像の URL
+    image_refs = {}  # 画像の URL -> 参照している文書の数
+    for name in os.listdir(OUTPUT_FOLDER):
+        path = os.path.join(OUTPUT_FOLDER, name)
+        if name == IMAGE_STORE_DIR or not os.path.isdir(path):
+            continue
+        size, mtime = _dir_usage(path)
+        entries.append((_last_access(path, mtime), size, path))
+        layout_path = os.path.join(path, LAYOUT_FILE)
+        if os.path.isfile(layout_path):
+            try:
+                doc_images[path] = layout_image_urls(layout_path)
+            except Exception:
+                logger.exception("🧹 retention: failed to read %s", layout_path)
+                continue
+            for url in doc_images[path]:
+                image_refs[url] = image_refs.get(url, 0) + 1
+    for name in os.listdir(UPLOAD_FOLDER):
+        path = os.path.join(UPLOAD_FOLDER, name)
+        if path in active_uploads:
+            continue
+        if os.path.isdir(path):
+            size, mtime = _dir_usage(path)
+        else:
+            st = os.stat(path)
+            size, mtime = st.st_size, st.st_mtime
+        entries.append((mtime, size, path))
+
+    image_dir = os.path.join(OUTPUT_FOLDER, IMAGE_STORE_DIR)
+    image_sizes = {}  # 画像の URL -> バイト数
+    for root, _, files in os.walk(image_dir):
+        for name in files:
+            try:
+                size = os.path.getsize(os.path.join(root, name))
+            except OSError:
+                continue
+            image_sizes["/".join([IMAGE_STORE_DIR, os.path.basename(root), name])] = size
+    image_bytes = sum(image_sizes.get(url, 0) for url in image_refs)
+    total = sum(size for _, size, _ in entries) + image_bytes
+
+    removed = freed = 0
+    for last_access, size, path in sorted(entries):
+        if now - last_access < RETENTION_GRACE:
+            continue
+        expired = now - last_access > RETENTION_MAX_AGE
+        if not expired and total <= RETENTION_QUOTA_BYTES:
+            continue
+        if _remove_entry(path):
+            total -= size
+            removed += 1
+            freed += size
+            for url in doc_images.get(path, ()):
+                image_refs[url] -= 1
+                if not image_refs[url]:
+                    total -= image_sizes.get(url, 0)
+
+    # 画像ストア: 残っている文書のどれからも参照されない画像を消す
+    if os.path.isdir(image_dir):
+        referenced = set()
+        for name in os.listdir(OUTPUT_FOLDER):
+            layout_path = os.path.join(OUTPUT_FOLDER, name, LAYOUT_FILE)
+            if os.path.isfile(layout_path):
+                try:
+                    referenced |= layout_image_urls(layout_path)
+                except Exception:
+                    # 読めない文書がある間は画像を消さない（参照漏れで消すと戻せない）
+                    logger.exception("🧹 retention: failed to read %s; skipping image sweep",
+                                     layout_path)
+                    referenced = None
+                    break
+        if referenced is not None:
+            for root, _, files in os.walk(image_dir):
+                for name in files:
+                    path = os.path.join(root, name)
+                    url = "/".join([IMAGE_STORE_DIR, os.path.basename(root), name])
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    # 抽出中（layout.bin がまだ無い）の画像を消さないよう猶予を置く
+                    if url in referenced or now - st.st_mtime < RETENTION_GRACE:
+                        continue
+                    if _remove_entry(path):
+                        removed += 1
+                        freed += st.st_size
+
+    if removed:
+        logger.info("🧹 retention: removed %d entries, freed %.1f MB", removed,
+                    freed / (1024 * 1024))
+
+
+def sweep_metrics():
+    """
+    METRICS_FOLDER の <pid>.json のうち、プロセスが終了していて METRICS_STALE_AGE 以上更新のないものと、
+    書きかけのまま残った .tmp を消す（再起動を繰り返しても増え続けないように）
+    """
+    now = time.time()
+    removed = 0
+    for name in os.listdir(METRICS_FOLDER):
+        path = os.path.join(METRICS_FOLDER, name)
+        stem = name.split(".")[0]
+        try:
+            if now - os.path.getmtime(path) < METRICS_STALE_AGE:
+                continue
+            if stem.isdigit() and name.endswith(".json"):
+                try:
+                    os.kill(int(stem), 0)
+                    continue  # まだ動いているプロセス
+                except ProcessLookupError:
+                    pass
+                except PermissionError:
+                    continue
+            os.remove(path)
+            removed += 1
+        except OSError:
+            continue
+    if removed:
+        logger.info("🧹 metrics: removed %d stale files", removed)
+    return removed
+
+
+def _retention_loop():
+    # 複数の gunicorn ワーカーのうち、ロックを取れた1つだけが掃除する
+    lock_path = os.path.join(OUTPUT_FOLDER, RETENTION_LOCK_FILE)
+    while True:
+        time.sleep(RETENTION_INTERVAL)
+        try:
+            with open(lock_path, "a") as lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    continue
+                try:
+                    enforce_retention()
+                    expire_jobs()
+                    sweep_metrics()
+                    sweep_settings_stamps()
+                    cleanup_old_logs("logs", days_to_keep, logger)
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+        except Exception:
+            logger.exception("🧹 retention: sweep failed")
+
+
+def start_retention_worker():
+    """容量・期限による削除をバックグラウンドスレッドで定期実行する"""
+    thread = threading.Thread(target=_retention_loop, name="retention",
+                              daemon=True)
+    thread.start()
+    logger.info("✅ retention: quota %d MB, max age %d days, every %d s",
+                RETENTION_QUOTA_BYTES // (1024 * 1024),
+                RETENTION_MAX_AGE // 86400, RETENTION_INTERVAL)
+    return thread
+
+
+def load_result_manifest(doc_dir, render_dir):
+    """キャッシュ済みの描画結果があれば manifest を返す。無い・壊れていれば None"""
+    manifest = _read_json(os.path.join(doc_dir, render_dir, RESULT_MANIFEST))
+    if manifest is None:
+        return None
+    if not os.path.isfile(os.path.join(doc_dir, manifest.get("recreated_pdf", ""))):
+        return None
+    return manifest
+
+
+def claim_flight(key):
+    """
+    run_single_flight の前半。(Future, 自分が実行するか) を返す。
+    自分が実行する側なら、終わったら（失敗しても）必ず finish_flight を呼ぶ
+    """
+    with inflight_lock:
+        future = inflight.get(key)
+        if future is not None:
+            return future, False
+        future = inflight[key] = Future()
+        return future, True
+
+
+def finish_flight(key, future, result=None, error=None):
+    """claim_flight で引き受けた処理の結果（または例外）を待っている他スレッドに渡す"""
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+    with inflight_lock:
+        inflight.pop(key, None)
+
+
+def run_single_flight(key, fn):
+    """
+    同じ key の処理が実行中なら、その完了を待って結果を共有する。
+    実行中でなければ自分が fn() を実行し、待っている他スレッドにも結果を渡す。
+    """
+    future, leader = claim_flight(key)
+    if not leader:
+        logger.info("run_single_flight: waiting for in-flight job %s", key)
+        return future.result()
+
+    try:
+        result = fn()
+    except BaseException as e:
+        finish_flight(key, future, error=e)
+        raise
+    finish_flight(key, future, result)
+    return result
+
+
+def render_flight_key(rel_dir, render_dir):
+    """描画の single-flight のキー。process_pdf・ResultStream・render_batch で同じ render_dir を同時に書かない"""
+    return f"render:{rel_dir}/{render_dir}"
+
+
+def parse_page_range(spec, page_count):
+    """
+    "3-10,15,20-" のようなページ指定（1始まり）を、0始まりの昇順リストにする。
+    空なら全ページ。書式が不正・範囲外だけなら ValueError
+    """
+    spec = (spec or "").strip()
+    if not spec:
+        return list(range(page_count))
+    numbers = set()
+    for part in spec.replace("、", ",").split(","):
+        part = part.strip()
+        if not part:
+            continue
+        m = PAGE_RANGE_PATTERN.match(part)
+        if not m:
+            raise ValueError(f"ページ指定が不正です: {part}")
+        start = int(m.group(1))
+        stop = start if m.group(2) is None else int(m.group(3) or page_count)
+        if start < 1 or stop < start:
+            raise ValueError(f"ページ指定が不正です: {part}")
+        numbers.update(range(start - 1, min(stop, page_count)))
+    if not numbers:
+        raise ValueError(f"指定されたページがありません（全{page_count}ページ）")
+    return sorted(numbers)
+
+
+def get_page_count(pdf_source, doc_dir):
+    """保存済みレイアウトがあればそこから、無ければPDFを開いてページ数を返す"""
+    layout = read_layout(os.path.join(doc_dir, LAYOUT_FILE), [])
+    if layout is not None:
+        return layout["page_count"]
+    with open_pdf(pdf_source) as doc:
+        return len(doc)
+
+
+def _keep_source(pdf_source, source_path):
+    """
+    元PDFを source_path に残す。アップロードは UPLOAD_FOLDER のファイルなので、ハードリンクにして
+    コピーせずに済ませる（ストリーミング表示の最初のページより前にPDF全体を書き直さない）。
+    アップロードを消してもリンクは残る。別のファイルシステムでリンクできないときだけコピーする
+    """
+    if isinstance(pdf_source, (bytes, bytearray)):
+        _write_file_atomic(source_path, pdf_source)
+        return
+    tmp_path = f"{source_path}.{uuid.uuid4().hex}.tmp"
+    try:
+        os.link(pdf_source, tmp_path)
+    except OSError:
+        shutil.copyfile(pdf_source, tmp_path)
+    os.replace(tmp_path, source_path)
+
+
+def extract_document(pdf_source, doc_dir, page_numbers=None):
+    """
+    PDFの page_numbers（0始まり、省略時は全ページ）を抽出し、doc_dir/layout.bin に追記して返す。
+    抽出済みのページはやり直さない。未抽出のページが残る場合は、後から
+    抽出できるよう元PDFを doc_dir/source.pdf として残す。
+    NEO / OG / SORTED のテキストはレイアウトからいつでも作れるので、ファイルには書かない。
+    """
+    layout_path = os.path.join(doc_dir, LAYOUT_FILE)
+    # 待っている間に別ワーカーが作り終えていればそれを使う
+    layout = read_layout(layout_path, page_numbers)
+    if layout is not None and None not in layout["pages"]:
+        return layout
+
+    try:
+        with timed("fitz_open"):
+            doc = open_pdf(pdf_source)
+            assert isinstance(doc, fitz.Document)
+    except Exception as e:
+        return {"error": f"PDFを開けません: {e}"}
+
+    os.makedirs(doc_dir, exist_ok=True)
+
+    # 保存済みのページに、足りないページだけ抽出して足す
+    stored = read_layout(layout_path)
+    pages = stored["pages"] if stored else [None] * len(doc)
+    if page_numbers is None:
+        page_numbers = list(range(len(doc)))
+    missing = [i for i in page_numbers if pages[i] is None]
+
+    # ページごとの抽出（大きなPDFはページ並列）
+    for i, page_layout in zip(missing, extract_pages(doc, pdf_source, missing)):
+        pages[i] = {"number": i, "elements": page_layout["elements"]}
+    doc.close()
+
+    source_path = os.path.join(doc_dir, SOURCE_FILE)
+    if None in pages and not os.path.isfile(source_path):
+        _keep_source(pdf_source, source_path)
+
+    # layout.bin はアトミックに書くので、存在すれば抽出結果が揃っている。
+    # キャッシュヒット時と同じ値（f32 に丸めた bbox 等）にそろえるため読み直して返す
+    write_layout(layout_path, pages)
+
+    # 全ページ揃えば元PDFはもう使わない（ストリーミング表示や lazy の残りページを抽出し終えたとき）
+    if None not in pages and os.path.isfile(source_path):
+        try:
+            os.remove(source_path)
+        except OSError:
+            logger.exception("extract_document: failed to remove %s", source_path)
+    return read_layout(layout_path, page_numbers)
+
+
+def ensure_layout(pdf_source, doc_dir, rel_dir, page_numbers):
+    """
+    page_numbers（0始まり）のページが揃ったレイアウトを返す。失敗時は {"error": メッセージ}
+    layout.bin を書くのは文書ごとに1つずつにするため抽出は文書単位で single-flight にする。
+    他のリクエストの抽出を待った場合、返ってくるのはそのリクエストのページなので、
+    自分のページを読み直し、まだ足りなければ改めて抽出する。
+    """
+    layout_path = os.path.join(doc_dir, LAYOUT_FILE)
+    layout = read_layout(layout_path, page_numbers)
+    attempts = 0
+    while layout is None or None in layout["pages"]:
+        if attempts >= EXTRACT_MAX_ATTEMPTS:
+            return {"error": "ページを抽出できませんでした。"}
+        attempts += 1
+        result = run_single_flight(
+            f"extract:{rel_dir}",
+            lambda: extract_document(pdf_source, doc_dir, page_numbers))
+        if result.get("error"):
+            return result
+        layout = read_layout(layout_path, page_numbers)
+    return layout
+
+
+def render_document(layout, doc_dir, render_dir, basename, firebase_settings=None,
+                    renderer="weasyprint"):
+    """
+    抽出済みレイアウトに生徒設定を適用し、再構成PDFを doc_dir/render_dir に書き出して manifest を返す。
+    renderer は "weasyprint" か "pymupdf"（choose_renderer で決めたもの）。
+    """
+    manifest = load_result_manifest(doc_dir, render_dir)
+    if manifest is not None:
+        return manifest
+
+    os.makedirs(os.path.join(doc_dir, render_dir), exist_ok=True)
+
+    with timed("neo_generation"):
+        neo_content, _, _ = render_layout(layout["pages"], firebase_settings)
+        neo_nodes = parse_neo(neo_content)
+    report_progress("neo", neo_nodes=len(neo_nodes))
 
     # PDF再構築
-    recreated_pdf_filename = f"{basename}_recreated.pdf"
-    recreated_pdf_path = os.path.join(dir_name, recreated_pdf_filename)
-    pdf_ok, pdf_error = create_pdf_with_weasyprint(
-        neo_content,
+    recreated_pdf_file = os.path.join(render_dir, f"{basename}_recreated.pdf")
+    recreated_pdf_path = os.path.join(doc_dir, recreated_pdf_file)
+    create_pdf = create_pdf_with_pymupdf if renderer == "pymupdf" else create_pdf_with_weasyprint
+    pdf_ok, pdf_error = create_pdf(
+        neo_nodes,
         recreated_pdf_path,
         app_root,
         firebase_settings=firebase_settings)
-    recreated_pdf_url = os.path.join(basename, recreated_pdf_filename).replace(
-        "\\", "/") if pdf_ok else ""
     if not pdf_ok:
         print("❌ PDF再構成に失敗:", pdf_error)
-        recreated_pdf_url = ""
-        download_html = "<p style='color:red;'>PDFの再構成に失敗しました。</p>"
     else:
         print("✅ PDF再構成成功:", recreated_pdf_path)
-        recreated_pdf_url = os.path.join(basename,
-                                         recreated_pdf_filename).replace(
-                                             "\\", "/")
-        download_html = (
-            f'<div class="download-section"><h3>再構成されたPDF</h3>'
-            f'<a href="/outputs/{html.escape(recreated_pdf_url)}" '
-            f'class="action-link" download>ダウンロード</a></div>')
-
-    # NEOテキスト生成（追加）
-    extracted_text = "".join(neo)
-    neo_text = extracted_text
-
-    font_size = firebase_settings.get("fontSize",
-                                      16) if firebase_settings else 16
-    line_height = firebase_settings.get("lineHeight",
-                                        1.6) if firebase_settings else 1.6
-    font_select = firebase_settings.get(
-        "fontSelect", "IPAexGothic") if firebase_settings else "IPAexGothic"
-
-    # HTML生成
-    styled_neo_html = convert_neo_to_html(neo_text, font_size, line_height,
-                                          font_select, app_root)
-
-    image_gallery_html = "".join(
-        f'<a href="/outputs/{html.escape(url)}" target="_blank">'
-        f'<img src="/outputs/{html.escape(url)}" alt="image"></a>'
-        for url in imgs) or "<p>画像は抽出されませんでした。</p>"
+        inc_metric("pdfremaker_output_bytes_total",
+                   os.path.getsize(recreated_pdf_path))
+
+    settings = firebase_settings or {}
+    manifest = {
+        "recreated_pdf": recreated_pdf_file if pdf_ok else "",
+        # 未設定の値（生徒IDなし・項目なし）は書かない。NEO を作り直すときは既定値になる
+        "settings": {k: settings[k] for k in CACHE_SETTING_KEYS if settings.get(k) is not None},
+        "renderer": renderer,
+    }
+    # PDF生成に失敗した結果はキャッシュしない（次回は作り直す）
+    if pdf_ok:
+        _write_json_atomic(os.path.join(doc_dir, render_dir, RESULT_MANIFEST),
+                           manifest)
+    return manifest
+
+
+def _render_document_task(layout, doc_dir, render_dir, basename, firebase_settings,
+                          renderer="weasyprint"):
+    """プロセスプール用: render_document を実行して manifest を返す"""
+    try:
+        return render_document(layout, doc_dir, render_dir, basename, firebase_settings,
+                               renderer)
+    finally:
+        flush_metrics(force=True)
+
+
+def render_batch(layout, doc_dir, basename, renders, renderer="weasyprint"):
+    """
+    renders（{render_dir: 生徒設定}）をそれぞれ描画して {render_dir: manifest} を返す。
+    未キャッシュの描画が2つ以上あれば、ページ抽出と同じプロセスプールで並列に実行する。
+    各 render_dir は process_pdf と同じ single-flight で引き受け、別のリクエストが描画中のものはその完了を待つ。
+    """
+    global page_pool
+    rel_dir = os.path.basename(doc_dir)
+    manifests = {}
+    todo = []
+    for render_dir in renders:
+        manifest = load_result_manifest(doc_dir, render_dir)
+        if manifest is not None:
+            manifests[render_dir] = manifest
+        else:
+            todo.append(render_dir)
+
+    flights = {render_dir: claim_flight(render_flight_key(rel_dir, render_dir))
+               for render_dir in todo}
+    mine = [render_dir for render_dir in todo if flights[render_dir][1]]
+    done = 0
+    error = None
+    try:
+        if PARALLEL_WORKERS > 1 and len(mine) > 1:
+            logger.info("render_batch: rendering %d settings in parallel", len(mine))
+            try:
+                pool = _get_page_pool()
+                futures = {
+                    render_dir: pool.submit(_render_document_task, layout, doc_dir,
+                                            render_dir, basename, renders[render_dir], renderer)
+                    for render_dir in mine
+                }
+                for render_dir, future in futures.items():
+                    manifests[render_dir] = future.result()
+                    done += 1
+                    report_progress("render", renders_done=done, renders_total=len(todo))
+            except BrokenProcessPool:
+                logger.exception("render_batch: process pool broken; falling back to serial mode")
+                with page_pool_lock:
+                    page_pool = None
+
+        for render_dir in mine:
+            if render_dir not in manifests:
+                manifests[render_dir] = render_document(layout, doc_dir, render_dir, basename,
+                                                        renders[render_dir], renderer)
+                done += 1
+                report_progress("render", renders_done=done, renders_total=len(todo))
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        for render_dir in mine:
+            future = flights[render_dir][0]
+            if render_dir in manifests:
+                finish_flight(render_flight_key(rel_dir, render_dir), future,
+                              manifests[render_dir])
+            else:
+                finish_flight(render_flight_key(rel_dir, render_dir), future,
+                              error=error or RuntimeError("render_batch: not rendered"))
+
+    # 別のリクエストが描画中だったもの
+    for render_dir in todo:
+        if render_dir not in manifests:
+            manifests[render_dir] = flights[render_dir][0].result()
+            done += 1
+            report_progress("render", renders_done=done, renders_total=len(todo))
+    return manifests
+
+
+def write_batch_archive(doc_dir, basename, members):
+    """
+    members（[(生徒ID, 文書フォルダからの再構成PDFパス)]）を1つの zip にまとめ、
+    文書フォルダからの相対パスを返す。同じ組み合わせの zip があれば作り直さない。
+    """
+    key = hashlib.sha256(json.dumps(members).encode("utf-8")).hexdigest()
+    archive_name = f"{BATCH_ARCHIVE_PREFIX}{key[:12]}.zip"
+    archive_path = os.path.join(doc_dir, archive_name)
+    if os.path.isfile(archive_path):
+        return archive_name
+
+    tmp_path = f"{archive_path}.{uuid.uuid4().hex}.tmp"
+    # PDFは圧縮済みなので無圧縮で詰める
+    with zipfile.ZipFile(tmp_path, "w", zipfile.ZIP_STORED) as archive:
+        for student_id, pdf_file in members:
+            archive.write(os.path.join(doc_dir, pdf_file),
+                          f"{basename}_{secure_filename(student_id) or 'student'}.pdf")
+    os.replace(tmp_path, archive_path)
+    return archive_name
+
+
+def prepare_document(pdf_source, pages="", lazy=False, pdf_name=None, pdf_digest=None,
+                     extract=True):
+    """
+    process_pdf / process_batch 共通の前処理。出力フォルダを決め、指定ページを抽出（済みなら読み込み）して
+    {pdf_name, pdf_digest, basename, rel_dir, doc_dir, page_count, page_numbers,
+     deferred_pages, partial, layout} を返す。失敗時は {"error": メッセージ}
+    extract=False なら抽出はせず layout は None（ResultStream が少しずつ抽出する）。
+    """
+    if pdf_name is None:
+        pdf_name = os.path.basename(pdf_source)
+    if pdf_digest is None:
+        try:
+            pdf_digest = compute_pdf_digest(pdf_source)
+        except Exception as e:
+            return {"error": f"PDFを開けません: {e}"}
+
+    # 抽出結果は「ファイル名_PDFハッシュ」、描画結果はその下の「render_設定ハッシュ」に置く。
+    # 同名ファイルの上書きを防ぎ、設定が変わっても抽出はやり直さない。
+    basename = os.path.splitext(pdf_name)[0] or "document"
+    rel_dir = f"{basename}_{pdf_digest[:16]}"
+    doc_dir = os.path.join(OUTPUT_FOLDER, rel_dir)
+
+    touch_access(rel_dir)
+    try:
+        page_count = get_page_count(pdf_source, doc_dir)
+        page_numbers = parse_page_range(pages, page_count)
+    except ValueError as e:
+        return {"error": str(e)}
+    except Exception as e:
+        return {"error": f"PDFを開けません: {e}"}
+    deferred_pages = []
+    if lazy:
+        page_numbers, deferred_pages = (page_numbers[:LAZY_INITIAL_PAGES],
+                                        page_numbers[LAZY_INITIAL_PAGES:])
+
+    layout = read_layout(os.path.join(doc_dir, LAYOUT_FILE), page_numbers) if extract else None
+    if extract and (layout is None or None in layout["pages"]):
+        logger.info("prepare_document: cache miss %s (%d pages)", rel_dir, len(page_numbers))
+        layout = ensure_layout(pdf_source, doc_dir, rel_dir, page_numbers)
+        if layout.get("error"):
+            return layout
+
+    return {
+        "pdf_name": pdf_name,
+        "pdf_digest": pdf_digest,
+        "basename": basename,
+        "rel_dir": rel_dir,
+        "doc_dir": doc_dir,
+        "page_count": page_count,
+        "page_numbers": page_numbers,
+        "deferred_pages": deferred_pages,
+        "partial": len(page_numbers) < page_count,
+        "layout": layout,
+    }
+
+
+def process_pdf(pdf_source, firebase_settings: dict | None = None,
+                pages: str = "", lazy: bool = False,
+                pdf_name: str | None = None, pdf_digest: str | None = None,
+                renderer: str = ""):
+    """
+    pdf_source はPDFのパスか、メモリ上のバイト列（その場合は pdf_name を渡す）。
+    renderer は描画エンジン（weasyprint / pymupdf / auto、空なら PDF_RENDERER）。
+    pdf_digest は取り込み時に計算済みならそれを使う。
+    pages（例: "3-10,15"）を指定するとそのページだけ抽出・再構成する。
+    lazy=True なら最初の LAZY_INITIAL_PAGES ページだけ処理し、残りは /text で開いたときに抽出する。
+    """
+    prepared = prepare_document(pdf_source, pages, lazy, pdf_name, pdf_digest)
+    if prepared.get("error"):
+        return prepared["error"]
+    pdf_name, pdf_digest, basename, rel_dir, doc_dir, layout = (
+        prepared["pdf_name"], prepared["pdf_digest"], prepared["basename"],
+        prepared["rel_dir"], prepared["doc_dir"], prepared["layout"])
+    page_count, page_numbers, deferred_pages, partial = (
+        prepared["page_count"], prepared["page_numbers"], prepared["deferred_pages"],
+        prepared["partial"])
+
+    renderer = choose_renderer(renderer, len(page_numbers))
+    settings_digest = compute_settings_digest(
+        firebase_settings, page_numbers if partial else None, renderer)
+    render_dir = f"render_{settings_digest[:12]}"
+
+    manifest = load_result_manifest(doc_dir, render_dir)
+    if manifest is not None:
+        logger.info("process_pdf: cache hit %s/%s", rel_dir, render_dir)
+    else:
+        logger.info("process_pdf: rendering %s/%s", rel_dir, render_dir)
+        manifest = run_single_flight(
+            render_flight_key(rel_dir, render_dir),
+            lambda: render_document(layout, doc_dir, render_dir, basename,
+                                    firebase_settings, renderer))
+
+    imgs = layout_images(layout["pages"])
+
+    pdf_ok = bool(manifest["recreated_pdf"])
+    recreated_pdf_url = os.path.join(rel_dir, manifest["recreated_pdf"]).replace(
+        "\\", "/") if pdf_ok else ""
+
+    # 結果ページには最初のページの表示だけを埋め込み、残りはスクロールに合わせて /fragments から読む
+    # （テキストはレイアウトから作るので PyMuPDF は使わない）
+    with timed("neo_generation"):
+        first_page = next((page for page in layout["pages"] if page is not None), None)
+        fragments = {view: fragment_section(first_page["number"] + 1,
+                                            render_fragment(first_page, view, firebase_settings))
+                     for view in FRAGMENT_VIEWS} if first_page else {}
 
     download_html = (
         f'<div class="download-section"><h3>再構成されたPDF</h3>'
         f'<a href="/outputs/{html.escape(recreated_pdf_url)}" class="action-link" download>ダウンロード</a></div>'
-        if pdf_ok else "")
-
-    return render_template(
-        "result.html",
-        pdf_name=pdf_name,
-        dir_name=dir_name,
-        download_html=download_html,
-        recreated_pdf_url=recreated_pdf_url,
-        imgs=imgs,
-        styled_neo_html=sanitize_html_for_result(styled_neo_html),
-        neo_content=sanitize_html_for_result(neo_content),
-        og_tagged_content=sanitize_html_for_result(og_tagged_content),
-        sorted_content=sanitize_html_for_result(sorted_content),
-        image_gallery_html=image_gallery_html
-    )
+        if pdf_ok else "<p style='color:red;'>PDFの再構成に失敗しました。</p>")
+
+    # 一部のページだけ処理した場合の案内と、残りページ（lazy）の表示リンク
+    page_note = (f"全{page_count}ページ中 {len(page_numbers)} ページを処理しました。"
+                 if partial else "")
+
+    with timed("template"):
+        return render_template(
+            "result.html",
+            pdf_name=pdf_name,
+            dir_name=doc_dir,
+            doc_id=rel_dir,
+            page_note=page_note,
+            deferred_pages=[i + 1 for i in deferred_pages],
+            download_html=download_html,
+            recreated_pdf_url=recreated_pdf_url,
+            imgs=imgs,
+            fragments=fragments,
+            fragment_pages=[i + 1 for i in page_numbers[1:]],
+            fragment_chunk=FRAGMENT_PAGES,
+            render_dir=render_dir,
+        )
+
+
+class ResultStream:
+    """
+    ストリーミング表示用（/logs の LogPager と同じく、テンプレートが for で回しながら状態を読む）。
+    pages() はページを抽出しながら1ページずつ結果ページ用の断片を返し、全ページを出し終えたら
+    再構成PDFを作って recreated_pdf_url / error に結果を残す。
+    抽出は1ページ目から倍々に広げた範囲ごとに行い、最初のページを早く出しつつ layout.bin の書き直しを対数回に抑える。
+    close() はレスポンスを閉じたときに呼び、同時実行枠とアップロードを解放する。
+    """
+
+    def __init__(self, upload, student_id="", pages="", lazy=False, renderer=""):
+        self.upload = upload
+        self.student_id = student_id
+        self.page_spec = pages
+        self.lazy = lazy
+        self.renderer = renderer
+        self.pdf_name = upload["name"]
+        self.doc_id = ""
+        self.page_note = ""
+        self.deferred_pages = []
+        self.image_count = 0
+        self.recreated_pdf_url = ""
+        self.error = ""
+        self.closed = False
+
+    def pages(self):
+        """抽出できたページから順に {"number", "fragments"} を返す"""
+        try:
+            with timed("process_pdf_stream"):
+                yield from self._extract_pages()
+        except Exception as e:
+            logger.exception("ResultStream: error processing %s", self.pdf_name)
+            self.error = f"処理中にエラーが発生しました: {e}"
+
+    def _extract_pages(self):
+        start = time.perf_counter()
+        pdf_source = self.upload["data"] or self.upload["path"]
+        firebase_settings = None
+        if self.student_id:
+            firebase_settings = get_document("messages", self.student_id)
+
+        prepared = prepare_document(pdf_source, self.page_spec, self.lazy, self.pdf_name,
+                                    self.upload["digest"], extract=False)
+        if prepared.get("error"):
+            self.error = prepared["error"]
+            return
+        rel_dir, doc_dir, page_numbers = (prepared["rel_dir"], prepared["doc_dir"],
+                                          prepared["page_numbers"])
+        self.doc_id = rel_dir
+        self.deferred_pages = [i + 1 for i in prepared["deferred_pages"]]
+        if prepared["partial"]:
+            self.page_note = (f"全{prepared['page_count']}ページ中 {len(page_numbers)} "
+                              f"ページを処理しました。")
+
+        layout_path = os.path.join(doc_dir, LAYOUT_FILE)
+        images = set()
+        pos, chunk = 0, STREAM_FIRST_PAGES
+        while pos < len(page_numbers):
+            numbers = page_numbers[pos:pos + chunk]
+            # 同じ文書の抽出が実行中なら待ち、自分のページが揃っていなければ改めて抽出する
+            layout = ensure_layout(pdf_source, doc_dir, rel_dir, numbers)
+            if layout.get("error"):
+                self.error = layout["error"]
+                return
+
+            for page in layout["pages"]:
+                if pos == 0:
+                    observe_metric("pdfremaker_stage_seconds", time.perf_counter() - start,
+                                   stage="stream_first_page")
+                images.update(layout_images([page]))
+                self.image_count = len(images)
+                yield {"number": page["number"] + 1,
+                       "fragments": {view: render_fragment(page, view, firebase_settings)
+                                     for view in FRAGMENT_VIEWS}}
+                pos += 1
+            chunk = min(chunk * 2, STREAM_MAX_CHUNK_PAGES)
+
+        # 全ページを出し終えてから再構成PDFを作る（リンクは最後に出す）
+        layout = read_layout(layout_path, page_numbers)
+        renderer = choose_renderer(self.renderer, len(page_numbers))
+        settings_digest = compute_settings_digest(
+            firebase_settings, page_numbers if prepared["partial"] else None, renderer)
+        render_dir = f"render_{settings_digest[:12]}"
+        manifest = run_single_flight(
+            render_flight_key(rel_dir, render_dir),
+            lambda: render_document(layout, doc_dir, render_dir, prepared["basename"],
+                                    firebase_settings, renderer))
+        if manifest["recreated_pdf"]:
+            self.recreated_pdf_url = f"{rel_dir}/{manifest['recreated_pdf']}".replace("\\", "/")
+        else:
+            self.error = "PDFの再構成に失敗しました。"
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        stream_slots.release()
+        discard_upload(self.upload)
+
+
+def stream_result(upload, student_id="", pages="", lazy=False, renderer=""):
+    """
+    ストリーミング表示の結果ページを返す（stream_slots を1つ確保してから呼ぶ）。
+    ページの外枠をすぐに返し、抽出できたページから順に流して、最後に再構成PDFのリンクを出す。
+    """
+    result = ResultStream(upload, student_id, pages, lazy, renderer)
+    response = app.response_class(
+        stream_template("result_stream.html", pdf_name=upload["name"], result=result),
+        mimetype="text/html")
+    response.call_on_close(result.close)
+    # プロキシにバッファされると最初のページが届かないので、溜めないよう指示する
+    response.headers["X-Accel-Buffering"] = "no"
+    response.headers["Cache-Control"] = "no-store"
+    return response
+
+
+def process_batch(pdf_source, student_settings, pages="", pdf_name=None, pdf_digest=None,
+                  renderer=""):
+    """
+    クラス一括処理。student_settings（{生徒ID: 設定 or None}）の全員分の再構成PDFを作り、
+    生徒ごとのダウンロードリンクと一括 zip を載せた結果ページを返す。
+    抽出は1回だけ行い、同じ設定の生徒は1つの描画結果を共有する。設定が見つからない生徒は既定値で作る。
+    """
+    prepared = prepare_document(pdf_source, pages, False, pdf_name, pdf_digest)
+    if prepared.get("error"):
+        return prepared["error"]
+    doc_dir, rel_dir, basename = prepared["doc_dir"], prepared["rel_dir"], prepared["basename"]
+    page_numbers = prepared["page_numbers"] if prepared["partial"] else None
+    renderer = choose_renderer(renderer, len(prepared["page_numbers"]))
+
+    renders = {}  # render_dir -> 生徒設定
+    students = []
+    for student_id, settings in student_settings.items():
+        render_dir = f"render_{compute_settings_digest(settings, page_numbers, renderer)[:12]}"
+        renders.setdefault(render_dir, settings)
+        students.append({"student_id": student_id, "found": settings is not None,
+                         "render_dir": render_dir})
+    logger.info("process_batch: %s for %d students (%d distinct settings)",
+                rel_dir, len(students), len(renders))
+
+    manifests = render_batch(prepared["layout"], doc_dir, basename, renders, renderer)
+
+    members = []
+    for student in students:
+        pdf_file = manifests[student.pop("render_dir")]["recreated_pdf"]
+        student["pdf_url"] = os.path.join(rel_dir, pdf_file).replace(
+            "\\", "/") if pdf_file else ""
+        if pdf_file:
+            members.append((student["student_id"], pdf_file))
+
+    archive_url = ""
+    if members:
+        with timed("batch_archive"):
+            archive_url = f"{rel_dir}/{write_batch_archive(doc_dir, basename, members)}"
+
+    page_note = (f"全{prepared['page_count']}ページ中 {len(prepared['page_numbers'])} ページを処理しました。"
+                 if prepared["partial"] else "")
+
+    with timed("template"):
+        return render_template(
+            "batch_result.html",
+            pdf_name=prepared["pdf_name"],
+            page_note=page_note,
+            students=students,
+            archive_url=archive_url,
+        )
 
 
 def sanitize_html_for_result(html):
@@ -993,6 +3956,102 @@ def sanitize_html_for_result(html):
     return html.strip()
 
 
+def render_fragment(page, view, firebase_settings=None):
+    """
+    結果ページの1ページ分の表示をHTML断片で返す（view は FRAGMENT_VIEWS のどれか）。
+    sanitize_html_for_result もこのページの分だけにかけるので、ページ数が増えても1回の処理は小さい。
+    """
+    if view == "images":
+        return "".join(
+            f'<a href="/outputs/{html.escape(url)}" target="_blank">'
+            f'<img src="/outputs/{html.escape(url)}" alt="image" loading="lazy"></a>'
+            for url in layout_images([page]))
+
+    neo_content, og_tagged_content, sorted_content = render_layout([page], firebase_settings)
+    if view == "styled":
+        settings = firebase_settings or {}
+        return sanitize_html_for_result(convert_neo_to_html(
+            neo_content, settings.get("fontSize") or 16, settings.get("lineHeight") or 1.6,
+            settings.get("fontSelect") or "IPAexGothic", app_root))
+    text = {"neo": neo_content, "og": og_tagged_content, "sorted": sorted_content}[view]
+    return html.escape(sanitize_html_for_result(text))
+
+
+def fragment_section(page_number, fragment_html):
+    """ページ単位の断片を結果ページに差し込む形（data-page 付きの section）にする"""
+    return f'<section class="fragment-page" data-page="{page_number}">{fragment_html}</section>'
+
+
+def warm_up(clients=True):
+    """
+    重い依存（PyMuPDF・WeasyPrint・NumPy）の import とフォントレジストリの読み込みを済ませる。
+    clients=True なら Firestore にも接続する（fork 前のマスターでは False で呼ぶ）
+    """
+    start = time.perf_counter()
+    for module in (fitz, weasyprint, weasyprint_fonts, weasyprint_urls, np):
+        module._load()
+    get_font_registry()
+    if clients:
+        get_db()
+    logger.info("✅ ウォームアップ完了: %.3f s (clients=%s)", time.perf_counter() - start,
+                clients)
+
+
+def _warm_up_worker():
+    warm_state["started_at"] = time.time()
+    try:
+        warm_up()
+        warm_state["ready"] = True
+    except Exception as e:
+        logger.exception("warm_up: failed")
+        warm_state["error"] = str(e)
+    finally:
+        warm_state["finished_at"] = time.time()
+
+
+def start_background_workers():
+    """
+    ワーカープロセスごとのバックグラウンド処理（保持による削除・ウォームアップ）を開始する。
+    スレッドは fork で引き継がれないので、preload 時は gunicorn.conf.py の post_fork から呼ぶ。
+    """
+    global retention_thread
+    retention_thread = start_retention_worker()
+    start_metrics_flusher()
+    if WARMUP_ON_START:
+        threading.Thread(target=_warm_up_worker, name="warm_up", daemon=True).start()
+    else:
+        warm_state["ready"] = True
+
+
+# ワーカーの準備状況（ウォームアップが終わるまでは 503）
+@app.route("/ready", methods=["GET"])
+def readiness():
+    state = {
+        "ready": warm_state["ready"],
+        "pid": os.getpid(),
+        "startup_seconds": startup_seconds,
+        "warm_up_seconds": (round(warm_state["finished_at"] - warm_state["started_at"], 4)
+                            if warm_state["finished_at"] and warm_state["started_at"] else None),
+        "imports": dict(import_timings),
+        "firestore": db is not None,
+        "error": warm_state["error"],
+    }
+    return jsonify(state), 200 if warm_state["ready"] else 503
+
+
+if multiprocessing.parent_process() is not None:
+    # プロセスプールのワーカー（forkserver / spawn で main を import し直す）: 裏の処理は親に任せる
+    pass
+elif PRELOAD:
+    # マスターで import とフォント読み込みまで済ませ、fork 後のワーカーとメモリを共有する
+    warm_up(clients=False)
+else:
+    start_background_workers()
+
+startup_seconds = round(time.perf_counter() - startup_started, 4)
+logger.info("✅ 起動完了: %.3f s (pid=%d)", startup_seconds, os.getpid())
+
+
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 3000))
     print("DEBUG: Logging handlers:", logging.getLogger().handlers)
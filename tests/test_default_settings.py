@@ -0,0 +1,99 @@
+"""
+生徒IDなし（既定の設定）でアップロードした文書の NEO テキスト・結果ページ断片のテスト。
+描画結果の manifest に未設定の値が入っていても 500 にならないことを確かめる。
+"""
+import json
+import os
+import sys
+
+import pytest
+
+pytest.importorskip("flask")
+pytest.importorskip("numpy")
+
+os.environ.setdefault("WARMUP_ON_START", "0")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+DOC_ID = "doc_0123456789abcdef"
+RENDER_DIR = "render_0123456789ab"
+
+PAGE = {
+    "number": 0,
+    "elements": [
+        {"type": "text", "bbox": [10.0, 10.0, 200.0, 22.0], "text": "こんにちは",
+         "font": "IPAexGothic", "size": 12.0, "weight": "normal"},
+        {"type": "text", "bbox": [10.0, 40.0, 200.0, 52.0], "text": "二行目",
+         "font": "IPAexGothic", "size": 12.0, "weight": "bold"},
+    ],
+}
+
+
+@pytest.fixture
+def doc_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "OUTPUT_FOLDER", str(tmp_path))
+    path = tmp_path / DOC_ID
+    path.mkdir()
+    main.write_layout(str(path / main.LAYOUT_FILE), [PAGE])
+    return path
+
+
+@pytest.fixture
+def client():
+    return main.app.test_client()
+
+
+def _fake_create_pdf(neo_content, output_path, app_root, firebase_settings=None):
+    with open(output_path, "wb") as f:
+        f.write(b"%PDF-1.4\n")
+    return True, None
+
+
+def test_render_layout_accepts_unset_settings():
+    settings = {"fontSelect": None, "fontSize": None, "lineHeight": None}
+    neo, og, sorted_txt = main.render_layout([PAGE], settings)
+    assert "[サイズ:12.00]" in neo
+    assert "こんにちは" in og
+    assert "--- Page 1 ---" in sorted_txt
+
+
+def test_manifest_omits_unset_settings(doc_dir, monkeypatch):
+    monkeypatch.setattr(main, "create_pdf_with_weasyprint", _fake_create_pdf)
+    layout = main.read_layout(str(doc_dir / main.LAYOUT_FILE))
+    manifest = main.render_document(layout, str(doc_dir), RENDER_DIR, "doc", None)
+    assert manifest["settings"] == {}
+
+
+@pytest.mark.parametrize("stored", [
+    {},
+    # 以前の manifest は未設定の値を None で書いていた
+    {"fontSelect": None, "fontSize": None, "lineHeight": None},
+])
+def test_neo_text_without_student_id(doc_dir, client, stored):
+    (doc_dir / RENDER_DIR).mkdir()
+    (doc_dir / RENDER_DIR / "doc_recreated.pdf").write_bytes(b"%PDF-1.4\n")
+    (doc_dir / RENDER_DIR / main.RESULT_MANIFEST).write_text(
+        json.dumps({"recreated_pdf": f"{RENDER_DIR}/doc_recreated.pdf", "settings": stored,
+                    "renderer": "weasyprint"}),
+        encoding="utf-8")
+
+    res = client.get(f"/text/{DOC_ID}/neo?render={RENDER_DIR}")
+    assert res.status_code == 200
+
+
+@pytest.mark.parametrize("view", ["styled", "neo"])
+def test_fragments_without_student_id(doc_dir, client, monkeypatch, view):
+    monkeypatch.setattr(main, "create_pdf_with_weasyprint", _fake_create_pdf)
+    layout = main.read_layout(str(doc_dir / main.LAYOUT_FILE))
+    main.render_document(layout, str(doc_dir), RENDER_DIR, "doc", None)
+
+    res = client.get(f"/fragments/{DOC_ID}/{view}?pages=1&render={RENDER_DIR}")
+    assert res.status_code == 200
+    pages = res.get_json()["pages"]
+    assert [p["page"] for p in pages] == [1]
+    assert "こんにちは" in pages[0]["html"]
+
+    res = client.get(f"/fragments/{DOC_ID}/{view}?pages=1&render={RENDER_DIR}&format=html")
+    assert res.status_code == 200
+    assert b'data-page="1"' in res.data
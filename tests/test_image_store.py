@@ -0,0 +1,110 @@
+"""
+画像ストア（内容ハッシュでの重複排除）と、容量上限による削除での画像の数え方のテスト。
+"""
+import os
+import sys
+import time
+import zlib
+
+import pytest
+
+pytest.importorskip("flask")
+pytest.importorskip("numpy")
+fitz = pytest.importorskip("pymupdf")
+
+os.environ.setdefault("WARMUP_ON_START", "0")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+SAMPLES = zlib.compress(bytes(range(256)) * 39 + bytes(16))  # 8bit グレー 10000 画素
+
+
+@pytest.fixture
+def output_folder(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "OUTPUT_FOLDER", str(tmp_path))
+    return tmp_path
+
+
+def _image_doc(image_dict, raw=SAMPLES, palette=None, padding=0):
+    """raw を埋め込んだ画像1つの文書と、その xref を返す"""
+    doc = fitz.open()
+    doc.new_page()
+    for _ in range(padding):  # オブジェクト番号をずらす
+        doc.update_object(doc.get_new_xref(), "<<>>")
+    if palette is not None:
+        palette_xref = doc.get_new_xref()
+        doc.update_object(palette_xref, "<<>>")
+        doc.update_stream(palette_xref, palette, compress=False)
+        image_dict = image_dict.replace("PALETTE", f"{palette_xref} 0 R")
+    xref = doc.get_new_xref()
+    doc.update_object(xref, f"<</Type/XObject/Subtype/Image{image_dict}/Filter/FlateDecode>>")
+    doc.update_stream(xref, raw, compress=False)
+    return doc, xref
+
+
+def _stored(*args, **kwargs):
+    doc, xref = _image_doc(*args, **kwargs)
+    full, rel = main.store_page_image(doc, xref)
+    assert os.path.isfile(full)
+    return rel
+
+
+GRAY = "/BitsPerComponent 8/ColorSpace/DeviceGray"
+
+
+def test_same_image_is_stored_once(output_folder):
+    first = _stored(f"/Width 100/Height 100{GRAY}")
+    second = _stored(f"/Width 100/Height 100{GRAY}", padding=3)
+    assert first == second
+    assert len(list((output_folder / main.IMAGE_STORE_DIR).rglob("*.*"))) == 1
+
+
+@pytest.mark.parametrize("other", [
+    f"/Width 50/Height 200{GRAY}",
+    f"/Width 100/Height 100{GRAY}/Decode [1 0]",
+    "/Width 50/Height 50/BitsPerComponent 8/ColorSpace/DeviceRGB",
+])
+def test_same_samples_with_other_dictionary(output_folder, other):
+    assert _stored(f"/Width 100/Height 100{GRAY}") != _stored(other)
+
+
+def test_indexed_palette_is_part_of_the_digest(output_folder):
+    indexed = "/Width 8/Height 8/BitsPerComponent 8/ColorSpace [/Indexed /DeviceRGB 1 PALETTE]"
+    samples = zlib.compress(bytes(i % 2 for i in range(64)))
+    red_green = _stored(indexed, samples, palette=b"\xff\x00\x00\x00\xff\x00")
+    blue_yellow = _stored(indexed, samples, palette=b"\x00\x00\xff\xff\xff\x00")
+    moved = _stored(indexed, samples, palette=b"\xff\x00\x00\x00\xff\x00", padding=3)
+    assert red_green != blue_yellow
+    assert red_green == moved
+
+
+def _document(output_folder, name, image_urls, accessed):
+    doc_dir = output_folder / name
+    doc_dir.mkdir()
+    elements = [{"type": "image", "bbox": [0.0, 0.0, 10.0, 10.0], "path": "", "url": url}
+                for url in image_urls]
+    main.write_layout(str(doc_dir / main.LAYOUT_FILE), [{"number": 0, "elements": elements}])
+    marker = doc_dir / main.ACCESS_MARKER
+    marker.touch()
+    os.utime(marker, (accessed, accessed))
+
+
+def test_retention_counts_images_per_document(output_folder, tmp_path_factory, monkeypatch):
+    monkeypatch.setattr(main, "UPLOAD_FOLDER", str(tmp_path_factory.mktemp("uploads")))
+    monkeypatch.setattr(main, "RETENTION_QUOTA_BYTES", 1_500_000)
+    old = time.time() - 3600
+    url = f"{main.IMAGE_STORE_DIR}/ab/ab12.png"
+    image = output_folder / url
+    image.parent.mkdir(parents=True)
+    image.write_bytes(b"x" * 2_000_000)
+    os.utime(image, (old, old))
+    _document(output_folder, "doc_old", [url], old)
+    _document(output_folder, "doc_a", [], old + 1)
+    _document(output_folder, "doc_b", [], old + 2)
+
+    main.enforce_retention()
+    # 大きな画像を使っていた文書を消せば容量内に収まるので、ほかの文書は残る
+    assert sorted(p.name for p in output_folder.iterdir()) == [
+        "doc_a", "doc_b", main.IMAGE_STORE_DIR]
+    assert not image.exists()
@@ -0,0 +1,99 @@
+"""
+アップロードの取り込みと、ジョブ状態ファイルの扱い（終了したワーカーのジョブ・期限切れ）のテスト。
+"""
+import hashlib
+import io
+import json
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+pytest.importorskip("flask")
+pytest.importorskip("numpy")
+
+os.environ.setdefault("WARMUP_ON_START", "0")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+PDF = b"%PDF-1.4\n" + bytes(range(256)) * 64
+
+
+@pytest.fixture
+def upload_folder(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "UPLOAD_FOLDER", str(tmp_path))
+    return tmp_path
+
+
+@pytest.fixture
+def job_folder(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "JOB_FOLDER", str(tmp_path))
+    return tmp_path
+
+
+@pytest.fixture
+def client():
+    return main.app.test_client()
+
+
+def test_upload_is_written_while_parsing(upload_folder, client, monkeypatch):
+    submitted = []
+    monkeypatch.setattr(main, "submit_job",
+                        lambda upload, *args, **kwargs: submitted.append(upload) or "0" * 32)
+    res = client.post("/", data={"file": (io.BytesIO(PDF), "a.pdf")},
+                      content_type="multipart/form-data")
+    assert res.status_code == 202
+    upload = submitted[0]
+    assert upload["data"] is None
+    assert upload["size"] == len(PDF)
+    assert upload["digest"] == hashlib.sha256(PDF).hexdigest()
+    with open(upload["path"], "rb") as f:
+        assert f.read() == PDF
+
+
+@pytest.mark.parametrize("filename, status", [("a.txt", 200), ("a.pdf", 413)])
+def test_rejected_upload_leaves_no_file(upload_folder, client, monkeypatch, filename, status):
+    monkeypatch.setattr(main, "MAX_UPLOAD_BYTES", 100)
+    res = client.post("/", data={"file": (io.BytesIO(PDF), filename)},
+                      content_type="multipart/form-data")
+    assert res.status_code == status
+    assert list(upload_folder.iterdir()) == []
+
+
+def _dead_owner():
+    proc = subprocess.Popen([sys.executable, "-c", "pass"])
+    owner = main._process_token(proc.pid)
+    proc.wait()
+    return owner
+
+
+def _write_job(folder, job_id, status, owner, age=0):
+    path = folder / f"{job_id}.json"
+    path.write_text(json.dumps({"job_id": job_id, "status": status, "owner": owner,
+                                "error": None, "progress": None, "finished_at": None}),
+                    encoding="utf-8")
+    os.utime(path, (time.time() - age, time.time() - age))
+    return path
+
+
+def test_job_of_exited_worker_fails(job_folder, client):
+    job_id = "a" * 32
+    _write_job(job_folder, job_id, "running", _dead_owner())
+    assert main.get_job(job_id)["status"] == "error"
+    events = client.get(f"/jobs/{job_id}/events").get_data(as_text=True)
+    assert "event: error" in events
+
+
+def test_expire_jobs_uses_on_disk_status(job_folder):
+    old = main.JOB_RESULT_TTL + 60
+    live = _write_job(job_folder, "b" * 32, "queued", main._process_token(os.getppid()), old)
+    orphan = _write_job(job_folder, "c" * 32, "running", _dead_owner(), old)
+    done = _write_job(job_folder, "d" * 32, "done", None, old)
+    main.expire_jobs()
+    # 別のワーカーの待ちジョブは消さない。終了したワーカーのジョブは error にしてから期限を数える
+    assert live.exists()
+    assert json.loads(orphan.read_text(encoding="utf-8"))["status"] == "error"
+    assert not done.exists()
@@ -0,0 +1,129 @@
+"""
+ページ指定の解釈・layout.bin の書き出しと読み込み・読み順（段組み）のテスト。
+"""
+import os
+import sys
+
+import pytest
+
+pytest.importorskip("flask")
+pytest.importorskip("numpy")
+
+os.environ.setdefault("WARMUP_ON_START", "0")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+def _text(x0, y0, x1, y1, text, font="IPAexGothic", size=10.5, weight="normal"):
+    return {"type": "text", "bbox": [x0, y0, x1, y1], "text": text,
+            "font": font, "size": size, "weight": weight}
+
+
+# --- parse_page_range ---
+
+@pytest.mark.parametrize("spec, expected", [
+    ("", list(range(10))),
+    ("3", [2]),
+    ("3-5", [2, 3, 4]),
+    ("8-", [7, 8, 9]),
+    ("5,1-2,5", [0, 1, 4]),
+    ("1、3", [0, 2]),
+    ("9-20", [8, 9]),  # 範囲の終わりはページ数で切る
+])
+def test_parse_page_range(spec, expected):
+    assert main.parse_page_range(spec, 10) == expected
+
+
+@pytest.mark.parametrize("spec", ["0", "5-3", "a", "1-2-3", "11", "20-"])
+def test_parse_page_range_rejects(spec):
+    with pytest.raises(ValueError):
+        main.parse_page_range(spec, 10)
+
+
+# --- layout.bin ---
+
+def test_layout_round_trip(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "OUTPUT_FOLDER", str(tmp_path))
+    url = "images/ab/ab12.png"
+    pages = [
+        {"number": 0, "elements": [
+            _text(10.0, 10.0, 200.0, 22.0, "こんにちは"),
+            _text(10.0, 30.0, 120.0, 42.0, "Bold", font="Helvetica", size=12.0, weight="bold"),
+            {"type": "image", "bbox": [20.0, 50.0, 120.0, 150.0], "path": "", "url": url},
+        ]},
+        None,
+        {"number": 2, "elements": [_text(10.0, 10.0, 50.0, 22.0, "こんにちは")]},
+    ]
+    path = str(tmp_path / main.LAYOUT_FILE)
+    main.write_layout(path, pages)
+
+    layout = main.read_layout(path)
+    assert layout["page_count"] == 3
+    first, missing, last = layout["pages"]
+    assert missing is None
+    assert [el["text"] for el in first["elements"][:2]] == ["こんにちは", "Bold"]
+    assert first["elements"][1]["weight"] == "bold"
+    assert first["elements"][1]["font"] == "Helvetica"
+    assert first["elements"][1]["size"] == pytest.approx(12.0)
+    image = first["elements"][2]
+    assert image["url"] == url
+    assert image["path"] == os.path.join(str(tmp_path), "images", "ab", "ab12.png")
+    assert image["bbox"] == pytest.approx([20.0, 50.0, 120.0, 150.0])
+    assert last["number"] == 2
+
+    # ページ表から指定ページだけ読む。範囲外は飛ばす
+    partial = main.read_layout(path, [2, 1, 7])
+    assert [p and p["number"] for p in partial["pages"]] == [2, None]
+    assert main.layout_image_urls(path) == {url}
+
+
+def test_read_layout_rejects_other_files(tmp_path):
+    path = tmp_path / main.LAYOUT_FILE
+    path.write_bytes(b"not a layout file" * 4)
+    assert main.read_layout(str(path)) is None
+    assert main.read_layout(str(tmp_path / "missing.bin")) is None
+
+
+# --- 読み順 ---
+
+def _two_columns():
+    """見出し（段をまたぐ）と、左右2段の本文3行ずつ"""
+    title = _text(50, 20, 500, 40, "見出し")
+    left = [_text(50, 60 + 20 * i, 250, 75 + 20 * i, f"左{i}") for i in range(3)]
+    right = [_text(300, 60 + 20 * i, 500, 75 + 20 * i, f"右{i}") for i in range(3)]
+    return title, left, right
+
+
+def test_detect_columns_finds_gutter():
+    title, left, right = _two_columns()
+    boxes = main.np.array([el["bbox"] for el in [title] + left + right], dtype=float)
+    bounds = main.detect_columns(boxes)
+    assert len(bounds) == 1
+    assert 250 < bounds[0] < 300
+
+
+def test_detect_columns_single_column():
+    boxes = main.np.array([[50, 60 + 20 * i, 500, 75 + 20 * i] for i in range(5)], dtype=float)
+    assert len(main.detect_columns(boxes)) == 0
+
+
+def test_reading_order_columns():
+    title, left, right = _two_columns()
+    # 左右を交互に並べておいても、列ごとに上から読む
+    mixed = [right[2], left[1], title, right[0], left[0], left[2], right[1]]
+    order = [el["text"] for el in main.reading_order(mixed, "columns")]
+    assert order == ["見出し", "左0", "左1", "左2", "右0", "右1", "右2"]
+
+
+def test_reading_order_legacy():
+    title, left, right = _two_columns()
+    order = [el["text"] for el in main.reading_order(right + left + [title], "legacy")]
+    assert order == ["見出し", "左0", "右0", "左1", "右1", "左2", "右2"]
+
+
+def test_reading_order_same_line_left_to_right():
+    # 上下に重なる要素（ルビや表のセル）は同じ行として左から
+    cells = [_text(115, 101, 175, 115, "B"), _text(50, 100, 110, 114, "A"),
+             _text(50, 130, 110, 144, "C")]
+    assert [el["text"] for el in main.reading_order(cells, "columns")] == ["A", "B", "C"]
@@ -0,0 +1,95 @@
+"""
+ログ閲覧（末尾からの読み出し・ページ送りのカーソル）のテスト。
+"""
+import os
+import sys
+
+import pytest
+
+pytest.importorskip("flask")
+pytest.importorskip("numpy")
+
+os.environ.setdefault("WARMUP_ON_START", "0")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+def _line(n, level="INFO"):
+    return f"2026-10-17 10:00:{n:02d},000 [{level}] entry {n}\n"
+
+
+def _page(log_dir, cursor=None, limit=2, min_level=0, query=""):
+    pager = main.LogPager()
+    texts = [e["text"] for e in pager.entries(
+        main.iter_log_entries(str(log_dir), "app.log", cursor), min_level, query, limit)]
+    return texts, pager.next_cursor
+
+
+def test_iter_lines_reversed_across_blocks(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "LOG_READ_BLOCK", 7)  # 行がブロックをまたぐように小さくする
+    path = tmp_path / "app.log"
+    path.write_text("first\nsecond line\n\nthird\n", encoding="utf-8")
+    lines = list(main.iter_lines_reversed(str(path)))
+    assert [line for _, line in lines if line] == ["third", "second line", "first"]
+    data = path.read_bytes()
+    for offset, line in lines:
+        assert data[offset:offset + len(line)].decode() == line
+
+    # end を渡すとその位置より前だけ
+    offset = next(o for o, line in lines if line == "second line")
+    assert [line for _, line in main.iter_lines_reversed(str(path), offset) if line] == ["first"]
+
+
+def test_entries_join_tracebacks(tmp_path):
+    (tmp_path / "app.log").write_text(
+        _line(1) + _line(2, "ERROR") + "Traceback (most recent call last):\n  boom\n",
+        encoding="utf-8")
+    entries = list(main.iter_log_entries(str(tmp_path), "app.log"))
+    assert [level for _, level, _ in entries] == ["ERROR", "INFO"]
+    assert entries[0][2].endswith("Traceback (most recent call last):\n  boom")
+
+
+def test_pager_no_next_when_exactly_full(tmp_path):
+    (tmp_path / "app.log").write_text("".join(_line(n) for n in range(1, 5)), encoding="utf-8")
+    texts, cursor = _page(tmp_path)
+    assert [t.split()[-1] for t in texts] == ["4", "3"]
+    texts, cursor = _page(tmp_path, cursor)
+    assert [t.split()[-1] for t in texts] == ["2", "1"]
+    assert cursor is None
+
+
+def test_pager_filters_before_counting(tmp_path):
+    (tmp_path / "app.log").write_text(
+        "".join(_line(n, "ERROR" if n % 2 else "INFO") for n in range(1, 7)), encoding="utf-8")
+    texts, cursor = _page(tmp_path, min_level=main.LOG_LEVELS["ERROR"])
+    assert [t.split()[-1] for t in texts] == ["5", "3"]
+    texts, cursor = _page(tmp_path, cursor, min_level=main.LOG_LEVELS["ERROR"])
+    assert [t.split()[-1] for t in texts] == ["1"]
+    assert cursor is None
+
+
+def test_pager_cursor_survives_rotation(tmp_path):
+    (tmp_path / "app.log.1").write_text("".join(_line(n) for n in (1, 2, 3)), encoding="utf-8")
+    (tmp_path / "app.log").write_text("".join(_line(n) for n in (4, 5)), encoding="utf-8")
+    texts, cursor = _page(tmp_path)
+    assert [t.split()[-1] for t in texts] == ["5", "4"]
+
+    # RotatingFileHandler と同じく番号をずらして新しい app.log を作る
+    os.rename(tmp_path / "app.log.1", tmp_path / "app.log.2")
+    os.rename(tmp_path / "app.log", tmp_path / "app.log.1")
+    (tmp_path / "app.log").write_text(_line(6), encoding="utf-8")
+
+    texts, cursor = _page(tmp_path, cursor)
+    assert [t.split()[-1] for t in texts] == ["3", "2"]
+    texts, cursor = _page(tmp_path, cursor)
+    assert [t.split()[-1] for t in texts] == ["1"]
+    assert cursor is None
+
+
+def test_pager_cursor_for_removed_file(tmp_path):
+    (tmp_path / "app.log").write_text("".join(_line(n) for n in (1, 2, 3)), encoding="utf-8")
+    _, cursor = _page(tmp_path)
+    os.remove(tmp_path / "app.log")
+    (tmp_path / "app.log").write_text(_line(4), encoding="utf-8")
+    assert _page(tmp_path, cursor) == ([], None)
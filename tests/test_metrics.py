@@ -0,0 +1,78 @@
+"""
+メトリクス（プロセスごとのファイルへの書き出しと /metrics での合算）のテスト。
+"""
+import json
+import os
+import sys
+import time
+
+import pytest
+
+pytest.importorskip("flask")
+pytest.importorskip("numpy")
+
+os.environ.setdefault("WARMUP_ON_START", "0")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+@pytest.fixture
+def metrics_folder(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "METRICS_FOLDER", str(tmp_path))
+    main._reset_metrics()
+    yield tmp_path
+    main._reset_metrics()
+
+
+def _other_worker(folder, pid, uploads, render_seconds):
+    buckets = [int(render_seconds <= bound) for bound in main.METRIC_BUCKETS]
+    (folder / f"{pid}.json").write_text(json.dumps({
+        "counters": [["pdfremaker_uploads_total", {"status": "queued"}, uploads]],
+        "histograms": [["pdfremaker_stage_seconds", {"stage": "render"},
+                        {"buckets": buckets, "sum": render_seconds, "count": 1}]],
+    }), encoding="utf-8")
+
+
+def test_collect_metrics_sums_workers(metrics_folder):
+    _other_worker(metrics_folder, 999998, uploads=3, render_seconds=2.0)
+    (metrics_folder / "999997.json").write_text("{broken", encoding="utf-8")
+    main.inc_metric("pdfremaker_uploads_total", status="queued")
+    main.observe_metric("pdfremaker_stage_seconds", 0.2, stage="render")
+
+    text = main.collect_metrics()
+    assert 'pdfremaker_uploads_total{status="queued"} 4' in text
+    assert 'pdfremaker_stage_seconds_count{stage="render"} 2' in text
+    assert 'pdfremaker_stage_seconds_sum{stage="render"} 2.200000' in text
+    assert 'pdfremaker_stage_seconds_bucket{stage="render",le="0.25"} 1' in text
+    assert 'pdfremaker_stage_seconds_bucket{stage="render",le="2.5"} 2' in text
+    assert 'pdfremaker_stage_seconds_bucket{stage="render",le="+Inf"} 2' in text
+
+
+def test_throttled_values_are_flushed_later(metrics_folder, monkeypatch):
+    monkeypatch.setattr(main, "METRICS_FLUSH_INTERVAL", 0.05)
+    path = metrics_folder / f"{os.getpid()}.json"
+    main.inc_metric("pdfremaker_uploads_total", status="queued")
+    main.inc_metric("pdfremaker_uploads_total", status="queued")  # 間引かれる
+    assert json.loads(path.read_text(encoding="utf-8"))["counters"][0][2] == 1
+    assert main.metrics_dirty
+
+    main.start_metrics_flusher()
+    deadline = time.monotonic() + 2
+    while main.metrics_dirty and time.monotonic() < deadline:
+        time.sleep(0.02)
+    assert json.loads(path.read_text(encoding="utf-8"))["counters"][0][2] == 2
+
+
+def test_sweep_metrics_keeps_live_processes(metrics_folder, monkeypatch):
+    monkeypatch.setattr(main, "METRICS_STALE_AGE", 0)
+    live = metrics_folder / f"{os.getpid()}.json"
+    dead = metrics_folder / "999996.json"
+    leftover = metrics_folder / "123.json.tmp"
+    for path in (live, dead, leftover):
+        path.write_text("{}", encoding="utf-8")
+        os.utime(path, (time.time() - 10, time.time() - 10))
+    main.sweep_metrics()
+    assert live.exists()
+    assert not dead.exists()
+    assert not leftover.exists()